@@ -10,6 +10,9 @@ setup(
     packages=find_packages('src/py'),
     include_package_data=True,
     install_requires=['avro','bottle','redis','requests'],
+    extras_require={'cluster': ['redis-py-cluster'],
+                    'serve': ['gunicorn']},
+    entry_points={'console_scripts': ['tasr-serve = tasr.serve:main']},
 
     # metadata for upload to PyPI
     author = 'Chris Mills',
@@ -67,26 +67,528 @@ specific API endpoints should happen in the app.
 '''
 
 import time
+import json
 import redis
 import base64
 import binascii
 import io
 import sys
 import struct
-from tasr.registered_schema import RegisteredSchema
+import logging
+import threading
+import itertools
+from tasr.registered_schema import RegisteredSchema, MD5_BYTES, SHA256_BYTES
+from tasr.registered_schema import MasterState
 from tasr.group import Group, InvalidGroupException
+from tasr.cache import LRUCache, deep_size
+from tasr.validators import MASTER, DEFAULT_VALIDATORS, MasterValidator
+from tasr.validators import selected_validators, new_validator
+
+GROUP_INDEX_KEY = 'groups'
+SCHEMA_CACHE_ENTRIES = 1000
+SCHEMA_CACHE_BYTES = None
+GROUP_CACHE_ENTRIES = 10000
+GROUP_CACHE_TTL = 0
+COMPAT_CACHE_ENTRIES = 10000
+VALIDATOR_CACHE_ENTRIES = 1000
+STREAM_BATCH_VERSIONS = 100
+INVALIDATION_CHANNEL = 'tasr.invalidations'
+INVALIDATE_ALL = '*'
+LISTENER_RETRY_SECS = 5
+
+
+def create_connection_pool(host='localhost', port=6379, db=0,
+                           unix_socket_path=None, max_connections=None,
+                           socket_timeout=None, socket_connect_timeout=None,
+                           socket_keepalive=None):
+    '''Returns a Redis connection pool that can be shared by any number of
+    repository objects (and threads).  If a unix_socket_path is passed, the
+    pool connects through it rather than over TCP to the host and port.
+    '''
+    if unix_socket_path:
+        return redis.ConnectionPool(
+            connection_class=redis.UnixDomainSocketConnection,
+            path=unix_socket_path, db=db, max_connections=max_connections,
+            socket_timeout=socket_timeout)
+    return redis.ConnectionPool(host=host, port=port, db=db,
+                                max_connections=max_connections,
+                                socket_timeout=socket_timeout,
+                                socket_connect_timeout=socket_connect_timeout,
+                                socket_keepalive=socket_keepalive)
+
+
+class SchemaRepository(object):
+    '''The interface all the schema repository storage backends implement.
+    The general methods listed in the module docs are here, along with the
+    group metadata and admin methods the apps use.  The schema cache and the
+    methods that can be written in terms of the others are shared.
+
+    There are two backends: RedisSchemaRepository (the standard one, below)
+    and the embedded, file-based SqliteSchemaRepository (in tasr.embedded).
+    Each has an Avro-specific subclass, which is what the apps use.
+    '''
+    def __init__(self, schema_cache_entries=SCHEMA_CACHE_ENTRIES,
+                 schema_cache_bytes=SCHEMA_CACHE_BYTES,
+                 compat_cache_entries=COMPAT_CACHE_ENTRIES):
+        super(SchemaRepository, self).__init__()
+        if schema_cache_entries is None:
+            schema_cache_entries = SCHEMA_CACHE_ENTRIES
+        self.schema_cache = LRUCache(schema_cache_entries, schema_cache_bytes)
+        if compat_cache_entries is None:
+            compat_cache_entries = COMPAT_CACHE_ENTRIES
+        self.compat_cache = LRUCache(compat_cache_entries)
+        self.validator_cache = LRUCache(VALIDATOR_CACHE_ENTRIES)
+
+    def instantiate_registered_schema(self):
+        '''Returns a RegisteredSchema object.  Override this in subclasses
+        when a more specific class (i.e. -- RegisteredAvroSchema) is used.
+        '''
+        return RegisteredSchema()
+
+    def cache_schema(self, reg_schema):
+        '''Adds the immutable schema content of a RegisteredSchema object to
+        the schema cache and returns the cached prototype.  The prototype is a
+        separate object, so later changes to the passed object's version
+        metadata do not leak into the cache.  It is cached under the sha256
+        id, sized with everything it holds (the strings, the ordered object
+        and the parsed schema).  The md5 id is cached as an alias holding the
+        sha256 id, so it never keeps an evicted prototype alive.
+        '''
+        proto = self.instantiate_registered_schema()
+        proto.copy_schema_from(reg_schema)
+        alias = (proto.md5_id, proto.sha256_id)
+        self.schema_cache.put(proto.sha256_id, proto, deep_size(proto))
+        self.schema_cache.put(alias[0], alias[1], deep_size(alias))
+        return proto
+
+    def cached_schema(self, base64_id):
+        '''Returns the cached prototype for an md5- or sha256-based id (without
+        the 'id.' prefix), following an md5 alias to its sha256 entry, or None
+        if the schema is not cached.'''
+        proto = self.schema_cache.get(base64_id)
+        if isinstance(proto, basestring):
+            proto = self.schema_cache.get(proto)
+        return proto
+
+    def cache_schema_str(self, schema_str):
+        '''Validates (and so parses) a schema string retrieved from the store,
+        then adds it to the schema cache.  Returns the cached prototype.'''
+        if schema_str is None:
+            return None
+        reg_schema = self.instantiate_registered_schema()
+        reg_schema.schema_str = schema_str
+        if not reg_schema.is_valid:
+            logging.warn('Invalid schema in repository: %s', schema_str)
+        return self.cache_schema(reg_schema)
+
+    def after_fork(self):
+        '''Called in a forked child process (a pre-fork server worker, see
+        tasr.serve) before it serves anything.  Backends drop the connections
+        and threads inherited from the parent here, as those must not be
+        shared.  The caches only hold what the parent had read, so they stay.
+        '''
+        pass
+
+    ##########################################################################
+    # group methods
+    ##########################################################################
+    def get_groups(self, group_names=None, active_only=False):
+        '''Return a list of group objects, with the current schema set, sorted
+        by name.  If group_names is None, all the groups are included.  If
+        active_only is True, only groups with at least one schema are
+        included.'''
+        raise NotImplementedError()
+
+    def get_all_groups(self):
+        '''Return a list of current group objects.'''
+        return self.get_groups()
+
+    def get_group_names(self, active_only=False):
+        '''Return the names of all the groups, sorted as get_groups() sorts
+        them (see group_sort_key), without retrieving the groups.  If
+        active_only is True, only the names of groups with at least one schema
+        are included.'''
+        raise NotImplementedError()
+
+    @staticmethod
+    def group_sort_key(group_name):
+        '''The key groups are sorted by: the lower-cased name, then the name
+        itself, so names differing only in case still have a fixed order.'''
+        return (group_name.lower(), group_name)
+
+    def get_active_groups(self):
+        '''Return a list of current group objects with at least one schema.'''
+        return self.get_groups(active_only=True)
+
+    def get_cur_versions(self):
+        '''Return a dict of 'vid.<group>' keys to current version numbers for
+        the groups with at least one schema.'''
+        raise NotImplementedError()
+
+    def lookup_group(self, group_name):
+        '''Retrieve a Group object with the specified name or None.'''
+        raise NotImplementedError()
+
+    def register_group(self, group_name, metadata_dict=None, validators=None):
+        '''Initialize a group, optionally specifying a dict of group metadata
+        values and a set of validator class name strings.'''
+        raise NotImplementedError()
+
+    def get_group_metadata(self, group_name):
+        '''Get the full group metadata dict.'''
+        raise NotImplementedError()
+
+    def get_group_validators(self, group_name):
+        '''Get the set of validator names stored for a group.'''
+        raise NotImplementedError()
+
+    def set_group_metadata(self, group_name, entry_dict):
+        '''Set all the entries in the passed dict.  This will NOT clear
+        unmentioned keys.'''
+        raise NotImplementedError()
+
+    def set_group_metadata_entry(self, group_name, key_name, val):
+        '''Sets a specific group metadata entry.'''
+        raise NotImplementedError()
+
+    def delete_group_metadata_entry(self, group_name, key_name):
+        '''Deletes a specific group metadata entry.'''
+        raise NotImplementedError()
+
+    def delete_prefixed_group_metadata_entries(self, group_name, prefix):
+        '''Deletes all group metadata entries with keys matching the prefix.
+        '''
+        raise NotImplementedError()
+
+    def delete_group(self, group_name, remove_orphans=True):
+        '''Deletes a group and its versions.  If remove_orphans is true, the
+        schemas no longer registered for any group are removed too.'''
+        raise NotImplementedError()
+
+    ##########################################################################
+    # schema methods
+    ##########################################################################
+    def register_schema(self, group_name, schema_str):
+        '''Register a schema string as a version for a group_name.  The
+        returned RegisteredSchema has "created" set if a version was added.'''
+        raise NotImplementedError()
+
+    def get_schema_for_group_and_version(self, group_name, version):
+        '''Gets the registered schema for a group_name and version.  Note
+        that version must be a whole integer greater than 0 or -1, which is a
+        flag for the most current version.'''
+        raise NotImplementedError()
+
+    def get_schema_for_id_str(self, id_str):
+        '''Gets the registered schema with a given md5- or sha256-based id
+        string.'''
+        raise NotImplementedError()
+
+    def get_schema_for_schema_str(self, schema_str):
+        '''Gets the registered schema matching the passed schema string.'''
+        raise NotImplementedError()
+
+    def get_schemas_for_refs(self, refs):
+        '''Resolves a list of schema references.  A reference is either an
+        md5- or sha256-based id string or a (group_name, version) pair, with
+        -1 as the version for the latest one.  Returns a list holding the
+        registered schema (or None) for each reference, in order.'''
+        schemas = []
+        for ref in refs:
+            if isinstance(ref, basestring):
+                schemas.append(self.get_schema_for_id_str(ref)
+                               if self.is_id_str(ref) else None)
+            else:
+                (group_name, version) = ref
+                schemas.append(self.set_ref_version(
+                    self.get_schema_for_group_and_version(group_name,
+                                                          version), ref))
+        return schemas
+
+    @staticmethod
+    def set_ref_version(reg_schema, ref):
+        '''A schema registered more than once for a group carries the latest
+        of its versions, so for a (group_name, version) reference the version
+        asked for is set, as the version lookup endpoints do.  Returns the
+        passed schema (or None).'''
+        (group_name, version) = ref
+        if reg_schema and int(version) > 0:
+            reg_schema.gv_dict[group_name] = int(version)
+        return reg_schema
+
+    @staticmethod
+    def id_str_type(id_str):
+        '''Returns the type (MD5_BYTES or SHA256_BYTES) of a well-formed md5-
+        or sha256-based id string (with or without the 'id.' prefix), or None
+        if it is not one.'''
+        if not isinstance(id_str, basestring):
+            return None
+        base64_id = id_str[3:] if id_str.startswith('id.') else id_str
+        try:
+            id_bytes = base64.b64decode(base64_id)
+        except TypeError:
+            return None
+        if not id_bytes:
+            return None
+        id_type = struct.unpack('>b', id_bytes[:1])[0]
+        if (id_type in (MD5_BYTES, SHA256_BYTES) and
+                len(id_bytes) == id_type + 1):
+            return id_type
+        return None
+
+    @staticmethod
+    def is_id_str(id_str):
+        '''Checks that a string is a well-formed md5- or sha256-based id
+        string (with or without the 'id.' prefix).'''
+        return SchemaRepository.id_str_type(id_str) is not None
+
+    def sha256_id_for_id_str(self, id_str):
+        '''Returns the sha256 id for an md5- or sha256-based id string, if it
+        can be worked out without a call to the store (that is, the id string
+        is a sha256 one, or the schema cache holds the schema), or None.  This
+        does not say whether the schema is registered.'''
+        base64_id = id_str[3:] if id_str.startswith('id.') else id_str
+        try:
+            id_bytes = base64.b64decode(base64_id)
+        except TypeError:
+            return None
+        if (len(id_bytes) == SHA256_BYTES + 1 and
+                struct.unpack('>b', id_bytes[:1])[0] == SHA256_BYTES):
+            return base64.b64encode(id_bytes)
+        proto = self.cached_schema(base64_id)
+        return proto.sha256_id if proto else None
+
+    def get_latest_schema_for_group(self, group_name):
+        '''A convenience method'''
+        return self.get_schema_for_group_and_version(group_name, -1)
+
+    def get_latest_schema_versions_for_group(self, group_name, max_versions=5):
+        '''This retrieves the n most recent schema versions for a group.  If
+        max_versions is set to -1, it will return ALL versions for the group.
+        '''
+        raise NotImplementedError()
+
+    def get_schema_versions_for_group(self, group_name, first_version=1,
+                                      last_version=-1):
+        '''Retrieves a range of a group's schema versions, in version order.
+        A last_version of -1 means the latest version.'''
+        raise NotImplementedError()
+
+    def iter_schema_versions_for_group(self, group_name, first_version=1,
+                                       last_version=-1,
+                                       batch_size=STREAM_BATCH_VERSIONS):
+        '''Yields a range of a group's schema versions, in version order,
+        retrieving them batch_size versions at a time, so that only one batch
+        is held at once however deep the group is.  A last_version of -1 means
+        the latest version.'''
+        first = max(int(first_version), 1)
+        last = int(last_version)
+        while last < 0 or first <= last:
+            stop = first + batch_size - 1
+            if last >= 0:
+                stop = min(stop, last)
+            batch = self.get_schema_versions_for_group(group_name, first, stop)
+            for reg_schema in batch:
+                yield reg_schema
+            if len(batch) < stop - first + 1:
+                return
+            first = stop + 1
+
+    def get_version_sha256_ids_for_group(self, group_name, first_version=1,
+                                         last_version=-1):
+        '''Get the 'id.<sha256_id>' keys for a range of group versions, in
+        version order.  A last_version of -1 means the latest version.'''
+        raise NotImplementedError()
 
+    def get_all_version_sha256_ids_for_group(self, group_name):
+        '''Get the list of sha256_id values identifying group schema versions.
+        '''
+        return self.get_version_sha256_ids_for_group(group_name)
 
-class RedisSchemaRepository(object):
+    def get_versions_for_id_str_and_group(self, id_str, group_name):
+        '''Get the list of a group's versions that used the identified schema.
+        '''
+        raise NotImplementedError()
+
+    def get_master_state_str(self, group_name):
+        '''Gets the stored master state JSON for a group, or None.'''
+        raise NotImplementedError()
+
+    def set_master_state_str(self, group_name, version, state_str):
+        '''Stores the master state JSON for a group, unless a state covering
+        as many (or more) versions is already stored.'''
+        raise NotImplementedError()
+
+    def get_group_master(self, group_name):
+        '''Returns the MasterState (see tasr.registered_schema) covering all
+        the group's registered versions.  The state is stored with the group,
+        and only the versions registered since it was stored are folded in,
+        so this does not get slower as the group's history grows.  The state
+        is rebuilt from all the versions if it is missing, or if a new version
+        breaks compatibility.
+        '''
+        latest = self.get_latest_schema_for_group(group_name)
+        version = latest.current_version(group_name) if latest else None
+        if not version:
+            return MasterState()
+        state = None
+        state_str = self.get_master_state_str(group_name)
+        if state_str:
+            state = MasterState.from_json(state_str)
+        if state and state.version >= version:
+            # a newer state means our latest version lookup was stale
+            return state
+        if not state:
+            state = MasterState()
+        new_versions = self.get_schema_versions_for_group(
+            group_name, state.version + 1, version)
+        if (len(new_versions) != version - state.version or
+                not state.extend(new_versions)):
+            state = MasterState.build(
+                self.get_schema_versions_for_group(group_name))
+        if state.version:
+            self.set_master_state_str(group_name, state.version,
+                                      state.as_json())
+        return state
+
+    def get_compat_verdict_str(self, group_name, version, verdict_key):
+        '''Gets a stored compatibility verdict JSON for a group version, or
+        None.  Storing verdicts is optional, so by default there are none.'''
+        return None
+
+    def set_compat_verdict_str(self, group_name, version, verdict_key,
+                               verdict_str):
+        '''Stores a compatibility verdict JSON for a group version, if the
+        repository stores verdicts.  By default, it does not.'''
+        pass
+
+    def invalidate_compat_verdicts(self, group_name=None):
+        '''Drops the cached compatibility verdicts and compiled validators for
+        a group.  With no group (or INVALIDATE_ALL), they are all dropped.'''
+        if not group_name or group_name == INVALIDATE_ALL:
+            self.compat_cache.clear()
+            self.validator_cache.clear()
+        else:
+            self.compat_cache.pop_if(lambda verdict: verdict[0] == group_name)
+            self.validator_cache.pop_if(lambda entry: entry[0] == group_name)
+
+    def get_group_validator(self, group_name, name, latest):
+        '''Returns the named validator (see tasr.validators), compiled with
+        the group's versions up to the passed latest one.  The master rules
+        use the stored master state.  The others are compiled once and kept,
+        and only the versions registered since are compiled into a copy when
+        the group gets a new version.
+        '''
+        if name == MASTER:
+            return MasterValidator(self.get_group_master(group_name))
+        version = latest.current_version(group_name)
+        entry = self.validator_cache.get((group_name, name))
+        validator = entry[1] if entry else None
+        if validator and validator.version < version:
+            new_versions = self.get_schema_versions_for_group(
+                group_name, validator.version + 1, version)
+            if (len(new_versions) == version - validator.version and
+                    new_versions[-1].sha256_id == latest.sha256_id):
+                validator = validator.copy().add_versions(new_versions)
+            else:
+                validator = None
+        if (not validator or validator.version != version or
+                validator.latest_id != latest.sha256_id):
+            validator = new_validator(
+                name, self.get_schema_versions_for_group(group_name, 1,
+                                                         version))
+        if not entry or entry[1] is not validator:
+            self.validator_cache.put((group_name, name),
+                                     (group_name, validator))
+        return validator
+
+    def check_group_compatible(self, group_name, reg_schema):
+        '''Checks whether a schema would be a compatible new version for a
+        group, applying the validators named in the group's validators set
+        (the master rules, as MasterState.check_compatible() does, if none
+        are named).  An incompatibility the validators can explain is raised
+        as a ValueError, as is a broken history.  Producers check the
+        same schemas over and over, so the verdict (or the error, if the
+        group's versions are not compatible with each other) is cached, keyed
+        by the group's latest version (number and sha256 id) and the schema's
+        sha256 id (plus the validator names, if not the default).  A new
+        version changes the key, so a verdict is never used for a later state
+        of the group than the one it was made for.
+        '''
+        (is_compatible, error) = self.compat_verdicts(group_name,
+                                                      [reg_schema, ])[0]
+        if error:
+            raise ValueError(error)
+        return is_compatible
+
+    def compat_verdicts(self, group_name, reg_schemas):
+        '''Returns an (is_compatible, error) tuple for each of the schemas,
+        where the error is set if check_group_compatible() would raise one.
+        The group's latest version is looked up, and the master state loaded,
+        at most once for the lot, so this is the way to check many schemas.
+        Any schema is compatible with a group that has no versions yet.
+        '''
+        latest = self.get_latest_schema_for_group(group_name)
+        version = latest.current_version(group_name) if latest else None
+        if not version:
+            return [(True, None) for _ in reg_schemas]
+        names = selected_validators(self.get_group_validators(group_name))
+        validators = None
+        verdicts = []
+        for reg_schema in reg_schemas:
+            try:
+                candidate_id = reg_schema.sha256_id
+            except ValueError:
+                candidate_id = None
+            cache_key = None
+            verdict = None
+            if candidate_id:
+                verdict_key = u'%s:%s' % (latest.sha256_id, candidate_id)
+                if names != DEFAULT_VALIDATORS:
+                    verdict_key = u'%s:%s' % (verdict_key, '+'.join(names))
+                cache_key = (group_name, version, verdict_key)
+                verdict = self.compat_cache.get(cache_key)
+                if verdict is None:
+                    verdict_str = self.get_compat_verdict_str(
+                        group_name, version, verdict_key)
+                    if verdict_str:
+                        verdict = (group_name, ) + tuple(
+                            json.loads(verdict_str))
+                        self.compat_cache.put(cache_key, verdict)
+            if verdict is None:
+                if validators is None:
+                    validators = [self.get_group_validator(group_name, name,
+                                                           latest)
+                                  for name in names]
+                verdict = (group_name, True, None)
+                for validator in validators:
+                    (is_compatible, error) = validator.check(reg_schema)
+                    if not is_compatible:
+                        verdict = (group_name, False, error)
+                        break
+                if cache_key:
+                    self.set_compat_verdict_str(group_name, version,
+                                                cache_key[2],
+                                                json.dumps(verdict[1:]))
+                    self.compat_cache.put(cache_key, verdict)
+            verdicts.append(verdict[1:])
+        return verdicts
+
+
+class RedisSchemaRepository(SchemaRepository):
     '''The Redis-based implementation of the schema repository uses the
     List and Hash structures provided by Redis as the backing store.  Here is
     the overview of keys to Redis structures:
 
       'id.<sha256_id>':   hash (primary entry)
       'id.<md5_id>':      hash (basically an index of md5->sha256 ids)
-      'g.<group name>':   hash (default field values, validators)
+      'g.<group name>':   hash (default field values)
+      'validators.<group name>': set (validator names)
       'vid.<group name>': list (version sha256_id values, in order)
       'vts.<group name>': list (version timestamp values, in order)
+      'master.<group name>': hash (the group's master schema state)
+      'compat.<group name>': hash (optional compatibility verdicts)
+      'groups':           set (index of all registered group names)
 
     The primary store is a hash type, using a key in the form 'id.<sha256_id>'.
     The hash entry has, at a minimum, the following fields: 'sha256_id',
@@ -113,9 +615,9 @@ class RedisSchemaRepository(object):
     when a schema is registered for a group with no existing hash entry.  When
     the group config map is added without a specified map, it will contain only
     a "group_ts" field, holding the numeric timestamp (UTC, seconds since the
-    epoch) of when the entry was added.  Note that this is also where validator
-    class names for the group are held, with a "validators" field holding a
-    whitespace-delimited string of class names.
+    epoch) of when the entry was added.  The names of the validators to apply
+    to new versions of the group (see tasr.validators) are held separately,
+    in a 'validators.<group>' set.
 
     In addition to the hash entries, there are two lists for each group that
     has registered schemas: a 'vid.<group>' that holds the SHA256 id keys
@@ -126,26 +628,120 @@ class RedisSchemaRepository(object):
     possible for a schema to be registered, then overridden, then reverted to
     -- in which case the same id key can occur more than once in the list.
 
+    The 'master.<group>' hash holds the master schema state for the group's
+    versions (see get_group_master()), in a 'state' field, with the number of
+    versions it covers in a 'version' field.  It is derived data, so it is
+    safe to delete; it is rebuilt on next use.
+
+    Compatibility verdicts (see check_group_compatible()) are cached in each
+    process.  If compat_cache_redis is set, they are also shared through a
+    'compat.<group>' hash, with a '<latest sha256 id>:<schema sha256 id>'
+    field for each verdict and a 'version' field with the group version they
+    were made for.  Storing a verdict for a newer version drops the rest.
+
+    The 'groups' set is an index of the registered group names.  It is kept
+    up to date by register_group(), register_schema() and delete_group(), so
+    listing groups never requires a scan of the whole keyspace.  For a Redis
+    instance populated before the index existed, use rebuild_group_index() (or
+    the tasr.admin tool) once to build it from the existing 'g.*' keys.
+
     Retrieval of schemas by SHA256 ID is simple, requiring a single Redis
     operation.  However, retrieving by MD5 ID, schema string, or, more
     commonly, by topic and version, require multiple operations.  It is much
     faster to execute all the ops in a single network call, so we use the LUA
     script support in Redis to enable this. This approach allows us to avoid
     the latency of a second round-trip to Redis.
+
+    Since the 'id.*' keys are digests of the canonical schema string, the
+    schema held in an 'id.<sha256_id>' hash never changes once written.  So,
+    we keep a bounded LRU cache of the immutable schema content (including
+    anything derived from it, like the parsed schema) keyed by the sha256 id,
+    with the md5 id as an alias.  When a cached schema is retrieved, the LUA
+    scripts are asked to leave the 'schema' field out, so only the mutable
+    version and timestamp fields are transferred.  The cache is only consulted
+    for the schema text itself -- whether a schema is registered is always
+    checked in Redis.
+
+    Group lookups (the group hash and the latest version) are mutable, so they
+    are only cached when a group_cache_ttl is set.  Every change to a group --
+    a registration, a metadata change or a delete -- publishes the group name
+    on the 'tasr.invalidations' channel, and each repository with a group
+    cache runs a subscriber thread that evicts the named group.  The thread is
+    started on first use of the cache.  The TTL bounds how stale an entry can
+    get if the subscription drops, and the whole group cache is cleared
+    whenever the subscription is (re)established.
+
+    If a connection_pool (see create_connection_pool()) is passed, the Redis
+    connections come from it, and the host, port and db are ignored.  A
+    ready-made redis_client can be passed instead (see tasr.cluster).
+
+    Reads can be spread across Redis replicas by passing a list of replica
+    connection pools.  The read methods take turns using the replicas, while
+    writes (and the group cache fills, which must not race the invalidations)
+    always use the primary.  Replicas lag the primary a little, so if a
+    read_your_writes window (in seconds) is set, all reads go to the primary
+    for that long after a write made through this repository object.
     '''
-    def __init__(self, host='localhost', port=6379, db=0):
-        super(RedisSchemaRepository, self).__init__()
-        self.redis = redis.StrictRedis(host, port, db)
+    def __init__(self, host='localhost', port=6379, db=0,
+                 schema_cache_entries=SCHEMA_CACHE_ENTRIES,
+                 schema_cache_bytes=SCHEMA_CACHE_BYTES,
+                 group_cache_entries=GROUP_CACHE_ENTRIES,
+                 group_cache_ttl=GROUP_CACHE_TTL,
+                 connection_pool=None, replica_pools=None,
+                 read_your_writes=0, redis_client=None,
+                 compat_cache_entries=COMPAT_CACHE_ENTRIES,
+                 compat_cache_redis=False):
+        super(RedisSchemaRepository, self).__init__(schema_cache_entries,
+                                                    schema_cache_bytes,
+                                                    compat_cache_entries)
+        self.compat_cache_redis = bool(compat_cache_redis)
+        if redis_client:
+            self.redis = redis_client
+        elif connection_pool:
+            self.redis = redis.StrictRedis(connection_pool=connection_pool)
+        else:
+            self.redis = redis.StrictRedis(host, port, db)
+        self.replicas = [redis.StrictRedis(connection_pool=pool)
+                         for pool in (replica_pools or [])]
+        self.replica_cycle = itertools.cycle(self.replicas)
+        self.read_your_writes = read_your_writes if read_your_writes else 0
+        self.last_write = 0
+        if group_cache_entries is None:
+            group_cache_entries = GROUP_CACHE_ENTRIES
+        # without a TTL we cannot bound staleness, so no TTL means no cache
+        if not group_cache_ttl:
+            group_cache_entries = 0
+        self.group_cache = LRUCache(group_cache_entries, ttl=group_cache_ttl)
+        # bumped on every invalidation, so a lookup that raced with one does
+        # not put a stale entry back into the group cache
+        self.group_cache_gen = 0
+        self.listener = None
+        self.listener_lock = threading.Lock()
+        self.listener_ready = threading.Event()
         # register_schema lua scripts in Redis
         self.lua_get_for_md5 = None
         self.lua_get_for_group_and_version = None
         self.lua_get_cur_versions = None
         self.lua_init_group = None
+        self.lua_prune_group_index = None
+        self.lua_register_schema = None
+        self.lua_get_groups = None
+        self.lua_get_versions = None
+        self.lua_get_for_id = None
+        self.lua_set_master_state = None
+        self.lua_set_compat_verdict = None
         try:
             self.reg_lua_get_for_md5()
             self.reg_lua_get_for_group_and_version()
             self.reg_lua_get_cur_versions()
             self.reg_lua_init_group()
+            self.reg_lua_prune_group_index()
+            self.reg_lua_register_schema()
+            self.reg_lua_get_groups()
+            self.reg_lua_get_versions()
+            self.reg_lua_get_for_id()
+            self.reg_lua_set_master_state()
+            self.reg_lua_set_compat_verdict()
         except redis.exceptions.ConnectionError:
             raise Exception(u'No Redis at %s on port %s and db %s' %
                             (host, port, db))
@@ -169,27 +765,71 @@ class RedisSchemaRepository(object):
 
     def reg_lua_get_for_group_and_version(self):
         '''Registers a LUA script to retrieve a registered schema's main hash
-        data starting with a topic and version.
+        data starting with a topic and version.  If ARGV[1] is '1', the
+        'schema' field is left out of the return.
         '''
         lua = '''
         local sha256_id = redis.call('lindex', KEYS[1], KEYS[2])
         if sha256_id then
-            return redis.call('hgetall', sha256_id)
+            local rvals = redis.call('hgetall', sha256_id)
+            if ARGV[1] ~= '1' then
+                return rvals
+            end
+            local meta_vals = {}
+            for idx = 1, #rvals, 2 do
+                if rvals[idx] ~= 'schema' then
+                    meta_vals[#meta_vals+1] = rvals[idx]
+                    meta_vals[#meta_vals+1] = rvals[idx+1]
+                end
+            end
+            return meta_vals
         else
             return nil
         end
         '''
         self.lua_get_for_group_and_version = self.redis.register_script(lua)
 
+    def reg_lua_get_for_id(self):
+        '''Registers a LUA script to retrieve a registered schema's main hash
+        data starting with either an md5 or a sha256 id key.  Both hash types
+        have a 'sha256_id' field holding the primary hash key.  If ARGV[1] is
+        '1', the 'schema' field is left out of the return.
+        '''
+        lua = '''
+        local sha256_id = redis.call('hget', KEYS[1], 'sha256_id')
+        if sha256_id then
+            local rvals = redis.call('hgetall', sha256_id)
+            if ARGV[1] ~= '1' then
+                return rvals
+            end
+            local meta_vals = {}
+            for idx = 1, #rvals, 2 do
+                if rvals[idx] ~= 'schema' then
+                    meta_vals[#meta_vals+1] = rvals[idx]
+                    meta_vals[#meta_vals+1] = rvals[idx+1]
+                end
+            end
+            return meta_vals
+        else
+            return nil
+        end
+        '''
+        self.lua_get_for_id = self.redis.register_script(lua)
+
     def reg_lua_get_cur_versions(self):
         '''Registers a LUA script to get the current schema version number for
-        each of the group_names with registered schemas.'''
+        each of the group_names with registered schemas.  The group names
+        come from the 'groups' index set (KEYS[1]), so we avoid a KEYS scan.'''
         lua = '''
         local gv_list={}
-        local vid_keys=redis.call('keys', 'vid.*')
-        for _,vid_key in ipairs(vid_keys) do
-            gv_list[#gv_list+1] = vid_key
-            gv_list[#gv_list+1] = redis.call('llen', vid_key)
+        local group_names=redis.call('smembers', KEYS[1])
+        for _,group_name in ipairs(group_names) do
+            local vid_key = 'vid.' .. group_name
+            local vlen = redis.call('llen', vid_key)
+            if vlen > 0 then
+                gv_list[#gv_list+1] = vid_key
+                gv_list[#gv_list+1] = vlen
+            end
         end
         return gv_list
         '''
@@ -198,25 +838,307 @@ class RedisSchemaRepository(object):
     def reg_lua_init_group(self):
         '''Registers a LUA script to initialize a group -- meaning add a hash
         object and set the 'group_ts' field if the hash is not already present.
+        The group name (ARGV[2]) is added to the 'groups' index set (KEYS[2]).
         In every case, all the fields of the hash object are returned.
         '''
         lua = '''
         local group_ts = redis.call('hget', KEYS[1], 'group_ts')
         if not group_ts then
-            redis.call('hset', KEYS[1], 'group_ts', KEYS[2])
+            redis.call('hset', KEYS[1], 'group_ts', ARGV[1])
         end
+        redis.call('sadd', KEYS[2], ARGV[2])
         return  redis.call('hgetall', KEYS[1])
         '''
         self.lua_init_group = self.redis.register_script(lua)
 
+    def reg_lua_prune_group_index(self):
+        '''Registers a LUA script that removes a group name (ARGV[1]) from
+        the 'groups' index set (KEYS[1]) if the group hash (KEYS[2]) does not
+        exist.  The check and the removal are one atomic call, so a group
+        being registered at the same time is never dropped.  Returns 1 if the
+        name was removed.
+        '''
+        lua = '''
+        if redis.call('exists', KEYS[2]) == 1 then
+            return 0
+        end
+        return redis.call('srem', KEYS[1], ARGV[1])
+        '''
+        self.lua_prune_group_index = self.redis.register_script(lua)
+
+    def reg_lua_register_schema(self):
+        '''Registers a LUA script that does all the work of registering a
+        schema for a group in a single, atomic call.  The group hash is
+        initialized if needed, the 'id.<sha256_id>' and 'id.<md5_id>' hashes
+        are added if the schema is new, and, unless the schema is already the
+        latest version for the group, the 'vid.', 'vts.' and 'topic.' lists are
+        appended and the version fields in the schema hash are updated.
+
+        The KEYS are the group, sha256 id, md5 id, vid, vts, topic and group
+        index keys (in that order).  The ARGV values are the timestamp, the md5
+        key value to store in the sha256 id hash, the canonical schema string
+        and the group name (added to the group index).  If a version is added,
+        an invalidation for the group is published on the channel named in
+        ARGV[5].  The return is a list with a created flag (1 or 0), a
+        mismatch flag (1 if the vid.* and topic.* lists disagree on the
+        version) and then the HGETALL-style name/value pairs for the schema
+        hash.
+        '''
+        lua = '''
+        local created = 0
+        local mismatch = 0
+        if not redis.call('hget', KEYS[1], 'group_ts') then
+            redis.call('hset', KEYS[1], 'group_ts', ARGV[1])
+        end
+        redis.call('sadd', KEYS[7], ARGV[4])
+        if redis.call('exists', KEYS[2]) == 0 then
+            redis.call('hmset', KEYS[2], 'sha256_id', KEYS[2],
+                       'md5_id', ARGV[2], 'schema', ARGV[3])
+            redis.call('hset', KEYS[3], 'sha256_id', KEYS[2])
+            created = 1
+        end
+        local cur_ver = redis.call('hget', KEYS[2], KEYS[4])
+        local last_id = redis.call('lindex', KEYS[4], -1)
+        if not cur_ver or last_id ~= KEYS[2] then
+            local ver = redis.call('rpush', KEYS[4], KEYS[2])
+            local topic_ver = redis.call('rpush', KEYS[6], KEYS[2])
+            if ver ~= topic_ver then
+                mismatch = 1
+            end
+            redis.call('hset', KEYS[2], KEYS[4], ver)
+            redis.call('rpush', KEYS[5], ARGV[1])
+            redis.call('hset', KEYS[2], KEYS[5], ARGV[1])
+            redis.call('publish', ARGV[5], ARGV[4] .. ' ' .. KEYS[2])
+            created = 1
+        end
+        local rvals = {created, mismatch}
+        for _,val in ipairs(redis.call('hgetall', KEYS[2])) do
+            rvals[#rvals+1] = val
+        end
+        return rvals
+        '''
+        self.lua_register_schema = self.redis.register_script(lua)
+
+    def reg_lua_get_groups(self):
+        '''Registers a LUA script to get the group hash and the latest schema
+        hash for a set of groups in a single call.  If group names are passed
+        (ARGV[2] and on), those are used, otherwise all the group names in the
+        'groups' index set (KEYS[1]) are used.  If ARGV[1] is '1', groups with
+        no registered schemas are skipped.  The return is a list with a
+        [<group name>, <group hash pairs>, <latest schema hash pairs>] entry
+        for each group found.
+        '''
+        lua = '''
+        local rvals = {}
+        local group_names = {}
+        if #ARGV > 1 then
+            for idx = 2, #ARGV do
+                group_names[#group_names+1] = ARGV[idx]
+            end
+        else
+            group_names = redis.call('smembers', KEYS[1])
+        end
+        for _,group_name in ipairs(group_names) do
+            local group_vals = redis.call('hgetall', 'g.' .. group_name)
+            if #group_vals > 0 then
+                local vid_key = 'vid.' .. group_name
+                local sha256_key = redis.call('lindex', vid_key, -1)
+                if sha256_key then
+                    rvals[#rvals+1] = {group_name, group_vals,
+                                       redis.call('hgetall', sha256_key)}
+                elseif ARGV[1] ~= '1' then
+                    rvals[#rvals+1] = {group_name, group_vals, {}}
+                end
+            end
+        end
+        return rvals
+        '''
+        self.lua_get_groups = self.redis.register_script(lua)
+
+    def reg_lua_get_versions(self):
+        '''Registers a LUA script to retrieve a range of a group's versions in
+        a single call.  KEYS[1] is the 'vid.<group>' list and ARGV[1] and
+        ARGV[2] are the start and stop indexes (as for LRANGE).  The return is
+        a two element list: the sha256 id keys for the range, in order, and the
+        schema hash pairs for each distinct id key, in order of first
+        appearance.  Re-registered schemas are only retrieved once.
+        '''
+        lua = '''
+        local sha256_keys = redis.call('lrange', KEYS[1], ARGV[1], ARGV[2])
+        local hashes = {}
+        local seen = {}
+        for _,sha256_key in ipairs(sha256_keys) do
+            if not seen[sha256_key] then
+                seen[sha256_key] = true
+                hashes[#hashes+1] = redis.call('hgetall', sha256_key)
+            end
+        end
+        return {sha256_keys, hashes}
+        '''
+        self.lua_get_versions = self.redis.register_script(lua)
+
+    def reg_lua_set_master_state(self):
+        '''Registers a LUA script that sets the 'version' and 'state' fields
+        of a 'master.<group>' hash (KEYS[1]) to ARGV[1] and ARGV[2], unless
+        the stored version is already at least ARGV[1].  That way concurrent
+        updates never replace a state with an older one.
+        '''
+        lua = '''
+        local cur = tonumber(redis.call('hget', KEYS[1], 'version'))
+        if cur and cur >= tonumber(ARGV[1]) then
+            return 0
+        end
+        redis.call('hmset', KEYS[1], 'version', ARGV[1], 'state', ARGV[2])
+        return 1
+        '''
+        self.lua_set_master_state = self.redis.register_script(lua)
+
+    def reg_lua_set_compat_verdict(self):
+        '''Registers a LUA script that sets a verdict field (ARGV[2]) to
+        ARGV[3] in a 'compat.<group>' hash (KEYS[1]) for group version
+        ARGV[1].  If the hash holds verdicts for an older version, they are
+        dropped first.  A verdict for an older version than the hash holds is
+        not stored.
+        '''
+        lua = '''
+        local cur = tonumber(redis.call('hget', KEYS[1], 'version'))
+        local ver = tonumber(ARGV[1])
+        if cur and cur > ver then
+            return 0
+        end
+        if cur ~= ver then
+            redis.call('del', KEYS[1])
+            redis.call('hset', KEYS[1], 'version', ARGV[1])
+        end
+        redis.call('hset', KEYS[1], ARGV[2], ARGV[3])
+        return 1
+        '''
+        self.lua_set_compat_verdict = self.redis.register_script(lua)
+
     ##########################################################################
-    # util methods
+    # key layout methods -- overridden for the cluster layout (tasr.cluster)
     ##########################################################################
-    def instantiate_registered_schema(self):
-        '''Returns a RegisteredSchema object.  Override this in subclasses
-        when a more specific class (i.e. -- RegisteredAvroSchema) is used.
+    def vid_key(self, group_name):
+        '''The key for the group's list of version sha256 id keys.'''
+        return u'vid.%s' % group_name
+
+    def vts_key(self, group_name):
+        '''The key for the group's list of version timestamps.'''
+        return u'vts.%s' % group_name
+
+    def topic_key(self, group_name):
+        '''The key for the group's legacy topic.* version list.'''
+        return u'topic.%s' % group_name
+
+    def validators_key(self, group_name):
+        '''The key for the group's set of validator class names.'''
+        return u'validators.%s' % group_name
+
+    def master_key(self, group_name):
+        '''The key for the group's master schema state hash.'''
+        return u'master.%s' % group_name
+
+    def compat_key(self, group_name):
+        '''The key for the group's compatibility verdict hash.'''
+        return u'compat.%s' % group_name
+
+    def fetch_group_vals(self, group_names=None, active_only=False,
+                         client=None):
+        '''Returns a [<group name>, <group hash pairs>, <latest schema hash
+        pairs>] list for each group found, using the registered LUA script.
         '''
-        return RegisteredSchema()
+        args = ['1' if active_only else '0', ]
+        if group_names:
+            args.extend(group_names)
+        return self.lua_get_groups(keys=[GROUP_INDEX_KEY, ], args=args,
+                                   client=client or self.reader())
+
+    def fetch_version_vals(self, group_name, index, meta_only):
+        '''Returns the schema hash pairs for a 'vid.<group>' list index.'''
+        return self.lua_get_for_group_and_version(
+            keys=[self.vid_key(group_name), index, ], args=[meta_only, ],
+            client=self.reader())
+
+    def fetch_id_vals(self, id_key, meta_only):
+        '''Returns the schema hash pairs for an md5 or sha256 id key.'''
+        return self.lua_get_for_id(keys=[id_key, ], args=[meta_only, ],
+                                   client=self.reader())
+
+    def fetch_ref_vals(self, lookups):
+        '''Returns the schema hash pairs for a list of lookups, in one
+        pipelined call.  A lookup is a (key, index, meta_only, id_type)
+        tuple: an md5 or sha256 id key with a None index and the id type
+        (MD5_BYTES or SHA256_BYTES), or a 'vid.<group>' key with the index of
+        a version and a None id type.'''
+        pipe = self.reader().pipeline(transaction=False)
+        for (key, index, meta_only, _) in lookups:
+            if index is None:
+                self.lua_get_for_id(keys=[key, ], args=[meta_only, ],
+                                    client=pipe)
+            else:
+                self.lua_get_for_group_and_version(
+                    keys=[key, index, ], args=[meta_only, ], client=pipe)
+        return pipe.execute()
+
+    def fetch_version_range_vals(self, group_name, start, stop):
+        '''Returns the sha256 id keys for a range of 'vid.<group>' indexes and
+        the schema hash pairs for each distinct key, in first appearance
+        order.'''
+        return self.lua_get_versions(keys=[self.vid_key(group_name), ],
+                                     args=[start, stop, ],
+                                     client=self.reader())
+
+    def init_group_keys(self, group_name, timestamp):
+        '''Adds the group hash (and indexes the name) if it is new.  Returns
+        a true value if the group hash was added.'''
+        return self.lua_init_group(
+            keys=[self.get_group_key(group_name), GROUP_INDEX_KEY, ],
+            args=[timestamp, group_name, ])
+
+    def register_schema_vals(self, group_name, new_rs, timestamp):
+        '''Does the Redis work of registering a schema for a group.  Returns
+        a list with a created flag, a mismatch flag and then the schema hash
+        pairs.'''
+        sha256_key = u'id.%s' % new_rs.sha256_id
+        md5_key = u'id.%s' % new_rs.md5_id
+        # the whole registration happens in one atomic LUA call, so concurrent
+        # writers cannot interleave the vid.*, vts.* and topic.* appends
+        return self.lua_register_schema(
+            keys=[self.get_group_key(group_name), sha256_key, md5_key,
+                  self.vid_key(group_name), self.vts_key(group_name),
+                  self.topic_key(group_name), GROUP_INDEX_KEY, ],
+            args=[timestamp, md5_key, new_rs.canonical_schema_str,
+                  group_name, INVALIDATION_CHANNEL, ])
+
+    ##########################################################################
+    # util methods
+    ##########################################################################
+    def reader(self):
+        '''Returns the Redis client to use for a read: the next replica, or
+        the primary if there are no replicas or we wrote recently.'''
+        if not self.replicas:
+            return self.redis
+        if (self.read_your_writes and
+                time.time() - self.last_write < self.read_your_writes):
+            return self.redis
+        return next(self.replica_cycle)
+
+    def note_write(self):
+        '''Records the time of a write, for the read_your_writes window.'''
+        self.last_write = time.time()
+
+    def after_fork(self):
+        '''Drops the pooled connections inherited from the parent, so the
+        worker opens its own, and forgets the invalidation listener, which does
+        not survive a fork.  The group cache is cleared too, as nothing keeps
+        it current until the next miss starts a new listener.'''
+        super(RedisSchemaRepository, self).after_fork()
+        for client in [self.redis, ] + self.replicas:
+            client.connection_pool.reset()
+        self.listener = None
+        self.listener_lock = threading.Lock()
+        self.listener_ready = threading.Event()
+        self.invalidate_group(INVALIDATE_ALL)
 
     @staticmethod
     def pair_seq_2_dict(vlist):
@@ -237,6 +1159,158 @@ class RedisSchemaRepository(object):
             return None
         return rdict
 
+    def schema_from_hash_vals(self, rvals, proto=None):
+        '''Builds a RegisteredSchema object from HGETALL-style schema hash
+        pairs.  If the pairs have no 'schema' field, the schema content comes
+        from the passed prototype or the schema cache (falling back on a call
+        to Redis for the schema field if the cache misses).  If the pairs do
+        have the schema, the cache is populated with it.
+        '''
+        rs_d = RedisSchemaRepository.pair_seq_2_dict(rvals) if rvals else None
+        if not rs_d:
+            return None
+        schema_str = rs_d.pop('schema', None)
+        sha256_key = rs_d.get('sha256_id')
+        if not proto and self.schema_cache.enabled and sha256_key:
+            proto = self.schema_cache.get(sha256_key[3:])
+            if not proto:
+                if schema_str is None:
+                    schema_str = self.reader().hget(sha256_key, 'schema')
+                proto = self.cache_schema_str(schema_str)
+        retrieved_rs = self.instantiate_registered_schema()
+        if proto:
+            retrieved_rs.copy_schema_from(proto)
+        else:
+            retrieved_rs.schema_str = schema_str
+        retrieved_rs.update_from_dict(rs_d)
+        return retrieved_rs
+
+    ##########################################################################
+    # group cache methods
+    ##########################################################################
+    def get_group_cache_entry(self, group_name):
+        '''Returns the cached (group dict, latest schema dict, prototype)
+        entry for a group, fetching it from Redis (in one call) on a miss.  The
+        latest schema dict does not hold the schema itself; that is in the
+        prototype.  Returns None if the group does not exist.
+        '''
+        entry = self.group_cache.get(group_name)
+        if entry:
+            return entry
+        self.start_invalidation_listener()
+        gen = self.group_cache_gen
+        # this reads from the primary, as an invalidation can arrive before a
+        # replica has the change, and that would cache the stale value
+        rvals = self.fetch_group_vals([group_name, ], client=self.redis)
+        if not rvals:
+            return None
+        (_, group_vals, schema_vals) = rvals[0]
+        group_d = RedisSchemaRepository.pair_seq_2_dict(group_vals)
+        rs_d = RedisSchemaRepository.pair_seq_2_dict(schema_vals)
+        proto = None
+        if rs_d:
+            schema_str = rs_d.pop('schema', None)
+            proto = self.schema_cache.get(rs_d['sha256_id'][3:])
+            if not proto:
+                proto = self.cache_schema_str(schema_str)
+        entry = (group_d, rs_d, proto)
+        with self.listener_lock:
+            if gen == self.group_cache_gen:
+                self.group_cache.put(group_name, entry)
+        return entry
+
+    def group_from_cache_entry(self, group_name, entry):
+        '''Builds a new Group object (with the current schema set) from a
+        group cache entry.  The cached dicts are copied, so callers are free
+        to change the returned objects.
+        '''
+        (group_d, rs_d, proto) = entry
+        group = Group(group_name, dict(group_d) if group_d else None)
+        if rs_d:
+            group.current_schema = self.instantiate_registered_schema()
+            group.current_schema.copy_schema_from(proto)
+            group.current_schema.update_from_dict(dict(rs_d))
+        return group
+
+    def invalidate_group(self, group_name, sha256_key=None):
+        '''Evicts a group from the local group cache.  If a sha256 key is
+        passed, any group whose cached latest version is that schema is also
+        evicted (the schema hash holds the version fields for every group it
+        is registered for).  INVALIDATE_ALL (or None) clears the whole cache.
+        '''
+        with self.listener_lock:
+            self.group_cache_gen += 1
+        self.invalidate_compat_verdicts(group_name)
+        if not group_name or group_name == INVALIDATE_ALL:
+            self.group_cache.clear()
+            return
+        self.group_cache.pop(group_name)
+        if sha256_key:
+            self.group_cache.pop_if(
+                lambda entry: entry[1] and entry[1]['sha256_id'] == sha256_key)
+
+    def publish_invalidation(self, group_name, sha256_key=None):
+        '''Evicts the group locally, then publishes the invalidation so that
+        every other TASR process evicts it too.  Every write to a group ends
+        with this, so it also notes the write.'''
+        self.note_write()
+        self.invalidate_group(group_name, sha256_key)
+        message = group_name
+        if sha256_key:
+            message = u'%s %s' % (group_name, sha256_key)
+        self.redis.publish(INVALIDATION_CHANNEL, message)
+
+    def handle_invalidation(self, message):
+        '''Applies an invalidation message ("<group> [<sha256 key>]").'''
+        parts = message.split()
+        if parts:
+            self.invalidate_group(*parts[:2])
+
+    def start_invalidation_listener(self):
+        '''Starts the daemon thread that subscribes to invalidations, unless
+        the group cache is disabled or the thread is already running.  This
+        waits (briefly) for the subscription, so nothing gets cached before
+        we can hear about changes to it.'''
+        if not self.group_cache.enabled:
+            return
+        with self.listener_lock:
+            if self.listener and self.listener.is_alive():
+                return
+            self.listener_ready.clear()
+            self.listener = threading.Thread(
+                target=self.listen_for_invalidations,
+                name='tasr-invalidations')
+            self.listener.daemon = True
+            self.listener.start()
+        self.listener_ready.wait(LISTENER_RETRY_SECS)
+
+    def listen_for_invalidations(self):
+        '''The subscriber thread's loop.  If the subscription drops, the whole
+        group cache is cleared (messages may have been missed) and we try to
+        subscribe again after a pause.  The TTL covers the gap.
+        '''
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                # wait for Redis to confirm the subscription
+                pubsub.get_message(timeout=LISTENER_RETRY_SECS)
+                # anything cached before now could have missed a message
+                self.invalidate_group(INVALIDATE_ALL)
+                self.listener_ready.set()
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.handle_invalidation(message['data'])
+            except redis.exceptions.RedisError as err:
+                logging.warn('Invalidation subscription dropped: %s', err)
+            finally:
+                try:
+                    pubsub.close()
+                except redis.exceptions.RedisError:
+                    pass
+            self.invalidate_group(INVALIDATE_ALL)
+            time.sleep(LISTENER_RETRY_SECS)
+
     ##########################################################################
     # low-level retrieval methods
     ##########################################################################
@@ -246,7 +1320,7 @@ class RedisSchemaRepository(object):
         sha256 id and return it as a dict.
         '''
         sha256_key = u'id.%s' % sha256_base64_id
-        hash_d = self.redis.hgetall(sha256_key)
+        hash_d = self.reader().hgetall(sha256_key)
         if len(hash_d) == 0:
             return None
         return hash_d
@@ -256,12 +1330,13 @@ class RedisSchemaRepository(object):
         md5 id, using a registered LUA script, and return it as a dict.
         '''
         md5_key = u'id.%s' % md5_base64_id
-        rvals = self.lua_get_for_md5(keys=[md5_key, ])
+        rvals = self.lua_get_for_md5(keys=[md5_key, ], client=self.reader())
         return RedisSchemaRepository.pair_seq_2_dict(rvals)
 
     def get_cur_versions(self):
         '''A low-level method to get current version numbers for each group'''
-        rvals = self.lua_get_cur_versions(keys=[])
+        rvals = self.lua_get_cur_versions(keys=[GROUP_INDEX_KEY, ],
+                                          client=self.reader())
         rdict = RedisSchemaRepository.pair_seq_2_dict(rvals)
         return rdict if rdict else {}
 
@@ -269,27 +1344,38 @@ class RedisSchemaRepository(object):
     # exposed, API methods
     ##########################################################################
 
-    def get_all_groups(self):
-        '''Return a set of current group objects.'''
-        group_names = []
-        for group_key in self.redis.keys('g.*'):
-            group_name = group_key[2:]
-            group = self.lookup_group(group_name)
-            group.current_schema = self.get_latest_schema_for_group(group_name)
-            group_names.append(group)
-        group_names.sort(key=lambda x: x.name.lower(), reverse=False)
-        return group_names
-
-    def get_active_groups(self):
-        '''Return a set of current group objects with at least one schema.'''
-        group_names = []
-        for group_key in self.get_cur_versions():
-            group_name = group_key[4:]
-            group = self.lookup_group(group_name)
-            group.current_schema = self.get_latest_schema_for_group(group_name)
-            group_names.append(group)
-        group_names.sort(key=lambda x: x.name.lower(), reverse=False)
-        return group_names
+    def get_groups(self, group_names=None, active_only=False):
+        '''Return a list of group objects, with the current schema set, sorted
+        by name.  If group_names is None, all the indexed groups are included.
+        If active_only is True, only groups with at least one schema are
+        included.  This takes a single call to Redis, however many groups
+        there are.
+        '''
+        if group_names is not None and len(group_names) == 0:
+            return []
+        rvals = self.fetch_group_vals(group_names, active_only)
+        groups = []
+        for (group_name, group_vals, schema_vals) in rvals:
+            group_d = RedisSchemaRepository.pair_seq_2_dict(group_vals)
+            group = Group(group_name, group_d)
+            rs_d = RedisSchemaRepository.pair_seq_2_dict(schema_vals)
+            if rs_d:
+                group.current_schema = self.instantiate_registered_schema()
+                group.current_schema.update_from_dict(rs_d)
+            groups.append(group)
+        groups.sort(key=lambda x: self.group_sort_key(x.name))
+        return groups
+
+    def get_group_names(self, active_only=False):
+        '''Return the names in the group index set, sorted by
+        group_sort_key.  If active_only is True, the names are limited to the
+        groups with a version list (using get_cur_versions).'''
+        names = self.reader().smembers(GROUP_INDEX_KEY)
+        if active_only:
+            cur_versions = self.get_cur_versions()
+            names = [name for name in names
+                     if self.vid_key(name) in cur_versions]
+        return sorted(names, key=self.group_sort_key)
 
     def get_group_key(self, group_name):
         '''A util method to get the redis key used for the group hash.'''
@@ -302,48 +1388,59 @@ class RedisSchemaRepository(object):
         names starting with "group_" should set group level attributes.  The
         field names starting with "default_" should set field defaults for the
         group schemas.'''
-        group_key = self.get_group_key(group_name)
-        group_dict = self.redis.hgetall(group_key)
-        if group_dict:
-            group = Group(group_name, group_dict)
-            group.current_schema = self.get_latest_schema_for_group(group_name)
-            return group
+        self.get_group_key(group_name)  # raises if the name is bad
+        if self.group_cache.enabled:
+            entry = self.get_group_cache_entry(group_name)
+            if entry:
+                return self.group_from_cache_entry(group_name, entry)
+            return None
+        groups = self.get_groups([group_name, ])
+        if groups:
+            return groups[0]
 
     def register_group(self, group_name, metadata_dict=None, validators=None):
         '''Initialize a group, optionally specifying a dict of group metadata
         values and a set of validator class name strings.'''
-        group_key = self.get_group_key(group_name)
+        self.get_group_key(group_name)  # raises if the name is bad
         timestamp = long(time.time())
-        rvals = self.lua_init_group(keys=[group_key, timestamp, ])
+        rvals = self.init_group_keys(group_name, timestamp)
+        self.note_write()
         if rvals:
             # this will update the hash fields and validators if provided
             if metadata_dict:
                 self.set_group_metadata(group_name, metadata_dict)
             if validators:
-                validators_key = 'validators.%s' % group_name
-                self.redis.sadd(validators_key, validators)
+                self.redis.sadd(self.validators_key(group_name), *validators)
 
     def get_group_metadata(self, group_name):
         '''Get the full group metadata dict from the redis hash.'''
         group_key = self.get_group_key(group_name)
-        return self.redis.hgetall(group_key)
+        return self.reader().hgetall(group_key)
+
+    def get_group_validators(self, group_name):
+        '''Get the set of validator names from the redis set.'''
+        self.get_group_key(group_name)  # raises if the name is bad
+        return self.reader().smembers(self.validators_key(group_name))
 
     def set_group_metadata(self, group_name, entry_dict):
         '''Set all the entries in the passed dict in the redis hash.  This will
         NOT clear unmentioned keys.'''
         group_key = self.get_group_key(group_name)
         self.redis.hmset(group_key, entry_dict)
+        self.publish_invalidation(group_name)
 
     def set_group_metadata_entry(self, group_name, key_name, val):
         '''Sets a specific group metadata entry in the redis hash.'''
         group_key = self.get_group_key(group_name)
         self.redis.hset(group_key, key_name, val)
+        self.publish_invalidation(group_name)
 
     def delete_group_metadata_entry(self, group_name, key_name):
         '''Deletes a specific group metadata entry in the redis hash.'''
         group_key = self.get_group_key(group_name)
         field_key = key_name
         self.redis.hdel(group_key, field_key)
+        self.publish_invalidation(group_name)
 
     def delete_prefixed_group_metadata_entries(self, group_name, prefix):
         '''Deletes all group metadata entries in the redis hash having keys
@@ -353,9 +1450,12 @@ class RedisSchemaRepository(object):
         for field in self.redis.hkeys(group_key):
             if field.startswith(prefix):
                 self.redis.hdel(group_key, field)
+        self.publish_invalidation(group_name)
 
     def register_schema(self, group_name, schema_str):
-        '''Register a schema string as a version for a group_name.'''
+        '''Register a schema string as a version for a group_name.  This uses
+        the registered LUA script, so it takes a single round-trip to Redis.
+        '''
         if not Group.validate_group_name(group_name):
             raise InvalidGroupException('Bad group name: %s' % group_name)
         new_rs = self.instantiate_registered_schema()
@@ -363,66 +1463,27 @@ class RedisSchemaRepository(object):
         if not new_rs.validate_schema_str():
             raise ValueError(u'Cannot register_schema invalid schema.')
 
-        # make sure the group_name is registered first
-        self.register_group(group_name)
-
-        # the key values are what we use as Redis keys
-        sha256_key = u'id.%s' % new_rs.sha256_id
-        md5_key = u'id.%s' % new_rs.md5_id
-        vid_key = u'vid.%s' % group_name
-        vts_key = u'vts.%s' % group_name
+        # we also need to support the old topic.* lists as well for Vadim, so
+        # those are appended along with the vid.* and vts.* lists
         now = long(time.time())
-        # we also need to support the old topic.* lists as well for Vadim
-        topic_key = u'topic.%s' % group_name
-
-        old_d = self.get_schema_dict_for_sha256_id(new_rs.sha256_id)
-        if old_d:
-            # schema registered for some group already, so make sure gv_dict
-            # and ts_dict are copied from old_d to new_rs so current_version()
-            # call will work
-            new_rs.update_from_dict(old_d)
-        else:
-            self.redis.hmset(sha256_key, new_rs.as_dict())
-            self.redis.hset(md5_key, 'sha256_id', sha256_key)
-            new_rs.created = True
-
-        # now that we know the schema is in the hashes, reg for the group_name
-        if not new_rs.current_version(group_name):
-            # no version for this group_name, so add it
-            ver = self.redis.rpush(vid_key, sha256_key)
-            # ensure we append the topic.* list as well for back-compatibility
-            topic_ver = self.redis.rpush(topic_key, sha256_key)
-            if ver != topic_ver:
-                sys.stderr.write('vid.* and topic.* version mismatch')
-            self.redis.hset(sha256_key, vid_key, ver)
-            new_rs.gv_dict[group_name] = ver
-            self.redis.rpush(vts_key, now)
-            self.redis.hset(sha256_key, vts_key, now)
-            new_rs.ts_dict[group_name] = now
-            new_rs.created = True
-        else:
-            last_ver_sha256_key = self.redis.lrange(vid_key, -1, -1)[0]
-            if not last_ver_sha256_key == sha256_key:
-                # need to override outdated version entry with new one
-                ver = self.redis.rpush(vid_key, sha256_key)
-                # ensure we append the topic.* list as well (for now)
-                topic_ver = self.redis.rpush(topic_key, sha256_key)
-                if ver != topic_ver:
-                    sys.stderr.write('vid.* and topic.* version mismatch')
-                self.redis.hset(sha256_key, vid_key, ver)
-                new_rs.gv_dict[group_name] = ver
-                self.redis.rpush(vts_key, now)
-                self.redis.hset(sha256_key, vts_key, now)
-                new_rs.ts_dict[group_name] = now
-                # since we are creating a version entry, it counts as creation
-                new_rs.created = True
-
+        rvals = self.register_schema_vals(group_name, new_rs, now)
+        self.note_write()
+        if rvals[1]:
+            sys.stderr.write('vid.* and topic.* version mismatch')
+        rs_d = RedisSchemaRepository.pair_seq_2_dict(rvals[2:])
+        new_rs.update_from_dict(rs_d)
+        new_rs.created = bool(rvals[0])
+        if new_rs.created:
+            # the script published, but don't wait on our own subscriber
+            self.invalidate_group(group_name, u'id.%s' % new_rs.sha256_id)
+        if not new_rs.sha256_id in self.schema_cache:
+            self.cache_schema(new_rs)
         return new_rs
 
     def delete_group(self, group_name, remove_orphans=True):
-        '''Deletes a group, including it's "g.", "vid.", "vts.", "topic." keys.
-        If remove_orphans is true, it also removes the "id." keys for schemas
-        orphaned by the group removal.
+        '''Deletes a group, including it's "g.", "vid.", "vts.", "topic." and
+        "validators." keys.  If remove_orphans is true, it also removes the
+        "id." keys for schemas orphaned by the group removal.
 
         Note that we DO NOT test for group name validity here.  This allows the
         method to be used to delete malformed groups, and is an intentional
@@ -448,6 +1509,10 @@ class RedisSchemaRepository(object):
         g_pipe.delete(k_vid)
         g_pipe.delete('vts.%s' % group_name)
         g_pipe.delete('topic.%s' % group_name)
+        g_pipe.delete(self.validators_key(group_name))
+        g_pipe.delete(self.master_key(group_name))
+        g_pipe.delete(self.compat_key(group_name))
+        g_pipe.srem(GROUP_INDEX_KEY, group_name)
         g_pipe.execute()
 
         # now step through the schemas, removing references to the group, and,
@@ -476,8 +1541,35 @@ class RedisSchemaRepository(object):
                     id_pipe.unwatch()
             else:
                 id_pipe.unwatch()
+        # other groups' cached latest versions may hold fields for the deleted
+        # group, so everyone clears their whole group cache
+        self.publish_invalidation(INVALIDATE_ALL)
         return
 
+    def rebuild_group_index(self, batch_size=1000):
+        '''Builds (or repairs) the 'groups' index set from the existing 'g.*'
+        keys.  This uses SCAN, not KEYS, so it does not block Redis for other
+        clients.  Index entries without a matching 'g.*' hash are removed at
+        the end, each checked and removed in one atomic LUA call, so it is
+        safe to run against a live repository.  Returns the number of indexed
+        group names.
+        '''
+        pipe = self.redis.pipeline(transaction=False)
+        scanned = 0
+        for group_key in self.redis.scan_iter('g.*', count=batch_size):
+            pipe.sadd(GROUP_INDEX_KEY, group_key[2:])
+            scanned += 1
+            if scanned % batch_size == 0:
+                pipe.execute()
+        pipe.execute()
+        for group_name in self.redis.smembers(GROUP_INDEX_KEY):
+            if self.lua_prune_group_index(
+                    keys=[GROUP_INDEX_KEY, 'g.%s' % group_name, ],
+                    args=[group_name, ]):
+                logging.info('Removed stale group index entry %s.',
+                             group_name)
+        return self.redis.scard(GROUP_INDEX_KEY)
+
     def get_schema_for_group_and_version(self, group_name, version):
         '''Gets the registered schema for a group_name and version using the
         registered LUA script.  Note that version must be a whole integer
@@ -485,7 +1577,6 @@ class RedisSchemaRepository(object):
         '''
         if not Group.validate_group_name(group_name):
             raise InvalidGroupException('Bad group name: %s' % group_name)
-        vid_key = u'vid.%s' % group_name
         index = int(version)
         if index == 0:
             # 0 is an invalid version here, we count from 1, not 0
@@ -495,12 +1586,11 @@ class RedisSchemaRepository(object):
             return
         elif index > 0:
             index -= 1  # ver counts from 1, index from 0
-        rvals = self.lua_get_for_group_and_version(keys=[vid_key, index, ])
-        if rvals:
-            rs_d = RedisSchemaRepository.pair_seq_2_dict(rvals)
-            retrieved_rs = self.instantiate_registered_schema()
-            retrieved_rs.update_from_dict(rs_d)
-            return retrieved_rs
+        # we can't know which schema we will get back, so if we are caching
+        # we ask for the metadata only and expect the schema to be cached
+        meta_only = '1' if self.schema_cache.enabled else '0'
+        rvals = self.fetch_version_vals(group_name, index, meta_only)
+        return self.schema_from_hash_vals(rvals)
 
     def get_schema_for_id_str(self, id_str):
         '''Gets the registered schema with a given md5- or sha256-based id
@@ -510,16 +1600,55 @@ class RedisSchemaRepository(object):
         id_bytes = base64.b64decode(base64_id)
         buff = io.BytesIO(id_bytes)
         id_type = struct.unpack('>b', buff.read(1))[0]
-        if id_type == 32:
-            rs_d = self.get_schema_dict_for_sha256_id(id_str)
-        elif id_type == 16:
-            rs_d = self.get_schema_dict_for_md5_id(id_str)
-
-        if rs_d:
-            retrieved_rs = self.instantiate_registered_schema()
-            retrieved_rs.update_from_dict(rs_d)
-            return retrieved_rs
-        return None
+        if not id_type in (MD5_BYTES, SHA256_BYTES):
+            return None
+        # both id types are cache keys, so skip the schema field on a hit
+        proto = self.cached_schema(base64_id)
+        rvals = self.fetch_id_vals(u'id.%s' % base64_id,
+                                   '1' if proto else '0')
+        return self.schema_from_hash_vals(rvals, proto)
+
+    def get_schemas_for_refs(self, refs):
+        '''Resolves a list of schema references (id strings or (group_name,
+        version) pairs) with a single pipelined call to Redis.  As for the
+        single lookups, schemas already in the schema cache are not fetched
+        again, just their metadata.  Bad id strings and versions resolve to
+        None.'''
+        lookups = []
+        protos = []
+        for ref in refs:
+            lookup = None
+            proto = None
+            if isinstance(ref, basestring):
+                id_type = self.id_str_type(ref)
+                if id_type:
+                    base64_id = ref[3:] if ref.startswith('id.') else ref
+                    proto = self.cached_schema(base64_id)
+                    lookup = (u'id.%s' % base64_id, None,
+                              '1' if proto else '0', id_type)
+            else:
+                (group_name, version) = ref
+                if not Group.validate_group_name(group_name):
+                    raise InvalidGroupException('Bad group name: %s' %
+                                                group_name)
+                index = int(version)
+                if index > 0 or index == -1:
+                    meta_only = '1' if self.schema_cache.enabled else '0'
+                    lookup = (self.vid_key(group_name),
+                              index - 1 if index > 0 else index, meta_only,
+                              None)
+            lookups.append(lookup)
+            protos.append(proto)
+        rvals_iter = iter(self.fetch_ref_vals([lookup for lookup in lookups
+                                               if lookup]))
+        schemas = []
+        for (ref, lookup, proto) in zip(refs, lookups, protos):
+            rvals = next(rvals_iter) if lookup else None
+            reg_schema = self.schema_from_hash_vals(rvals, proto)
+            if not isinstance(ref, basestring):
+                reg_schema = self.set_ref_version(reg_schema, ref)
+            schemas.append(reg_schema)
+        return schemas
 
     def get_schema_for_schema_str(self, schema_str):
         '''Passing in a schema string, retrieve the RegisteredSchema object
@@ -532,49 +1661,89 @@ class RedisSchemaRepository(object):
         target_rs.schema_str = schema_str
         if not target_rs.validate_schema_str():
             raise ValueError(u'Cannot register_schema invalid schema.')
-        rs_d = self.get_schema_dict_for_sha256_id(target_rs.sha256_id)
-        if rs_d:
-            retrieved_rs = self.instantiate_registered_schema()
-            retrieved_rs.update_from_dict(rs_d)
-            return retrieved_rs
-        return None
+        # the target has the schema content already, so just get metadata
+        sha256_key = u'id.%s' % target_rs.sha256_id
+        rvals = self.fetch_id_vals(sha256_key, '1')
+        if not rvals:
+            return None
+        proto = self.schema_cache.get(target_rs.sha256_id)
+        if not proto:
+            proto = self.cache_schema(target_rs)
+        return self.schema_from_hash_vals(rvals, proto)
 
     def get_latest_schema_for_group(self, group_name):
-        '''A convenience method'''
+        '''A convenience method.  This is answered from the group cache if it
+        is enabled.'''
+        if self.group_cache.enabled:
+            if not Group.validate_group_name(group_name):
+                raise InvalidGroupException('Bad group name: %s' % group_name)
+            entry = self.get_group_cache_entry(group_name)
+            if entry:
+                return self.group_from_cache_entry(group_name,
+                                                   entry).current_schema
         return self.get_schema_for_group_and_version(group_name, -1)
 
     def get_latest_schema_versions_for_group(self, group_name, max_versions=5):
         '''This retrieves the n most recent schema versions for a group.  If
         max_versions is set to -1, it will return ALL versions for the group.
-        Note that this is iterative, and will generate a call for each version
-        returned, so keep the depth reasonable.
+        All the versions are retrieved with a single LUA call.
+        '''
+        if max_versions < 0:
+            return self.get_schema_versions_for_group(group_name)
+        # we always return at least the latest version
+        start = -max(max_versions, 1)
+        return self._get_schema_version_range(group_name, start, -1)
+
+    def get_schema_versions_for_group(self, group_name, first_version=1,
+                                      last_version=-1):
+        '''Retrieves the schema versions for a group from first_version to
+        last_version (inclusive, counting from 1), in version order.  A
+        last_version of -1 means the latest version.  As with the single
+        version retrieval, a schema's version metadata reflects the version
+        _last_registered_ for the group.
+        '''
+        start = max(int(first_version), 1) - 1  # ver counts from 1
+        stop = int(last_version)
+        stop = -1 if stop < 0 else stop - 1
+        return self._get_schema_version_range(group_name, start, stop)
+
+    def _get_schema_version_range(self, group_name, start, stop):
+        '''Gets the schemas for a range of 'vid.<group>' list indexes using the
+        registered LUA script, then assembles the objects in version order.
+        Each distinct schema hash is only transferred and parsed once.
         '''
         if not Group.validate_group_name(group_name):
             raise InvalidGroupException('Bad group name: %s' % group_name)
+        (sha256_keys, hashes) = self.fetch_version_range_vals(group_name,
+                                                              start, stop)
+        # the hashes are in order of first appearance in the id key list
+        rs_dicts = dict()
+        for sha256_key in sha256_keys:
+            if not sha256_key in rs_dicts:
+                hash_vals = hashes[len(rs_dicts)]
+                rs_d = RedisSchemaRepository.pair_seq_2_dict(hash_vals)
+                rs_dicts[sha256_key] = rs_d
         versions = []
-        rs = self.get_latest_schema_for_group(group_name)
-        if rs:
-            # there is a latest version
-            versions.insert(0, rs)
-            cur_ver = rs.current_version(group_name)
-            if max_versions < 0:
-                first_ver = 1
-            else:
-                first_ver = cur_ver - max_versions + 1  # counting from 1
-                first_ver = 1 if first_ver < 1 else first_ver
-            for ver_num in sorted(range(first_ver, cur_ver), reverse=True):
-                schema = self.get_schema_for_group_and_version(group_name,
-                                                               ver_num)
-                versions.insert(0, schema)
+        for sha256_key in sha256_keys:
+            if rs_dicts[sha256_key]:
+                retrieved_rs = self.instantiate_registered_schema()
+                # update_from_dict pops the schema, so pass a copy
+                retrieved_rs.update_from_dict(dict(rs_dicts[sha256_key]))
+                versions.append(retrieved_rs)
         return versions
 
-    def get_all_version_sha256_ids_for_group(self, group_name):
-        '''Get the list of sha256_id values identifying group schema versions.
-        '''
+    def get_version_sha256_ids_for_group(self, group_name, first_version=1,
+                                         last_version=-1):
+        '''Get the 'id.<sha256_id>' keys for a range of group versions, in
+        version order, with a single LRANGE on the 'vid.<group>' list.'''
         if not Group.validate_group_name(group_name):
             raise InvalidGroupException('Bad group name: %s' % group_name)
-        vid_key = u'vid.%s' % group_name
-        return self.redis.lrange(vid_key, 0, -1)
+        start = max(int(first_version), 1) - 1  # ver counts from 1
+        stop = int(last_version)
+        stop = -1 if stop < 0 else stop - 1
+        if stop >= 0 and stop < start:
+            return []
+        return self.reader().lrange(self.vid_key(group_name), start, stop)
 
     def get_versions_for_id_str_and_group(self, id_str, group_name):
         '''Given an id_str and a group, we should be able to figure out which
@@ -595,16 +1764,44 @@ class RedisSchemaRepository(object):
         elif len(base64_id) == 24:
             # we have an md5 id, so get the sha256 id from redis
             md5_key = u'id.%s' % base64_id
-            sha256_key = self.redis.hget(md5_key, 'sha256_id')
-        vid_key = u'vid.%s' % group_name
+            sha256_key = self.reader().hget(md5_key, 'sha256_id')
         vlist = []
         version = 0
-        for vid in self.redis.lrange(vid_key, 0, -1):
+        for vid in self.reader().lrange(self.vid_key(group_name), 0, -1):
             version += 1
             if vid == sha256_key:
                 vlist.append(version)
         return vlist
 
+    def get_master_state_str(self, group_name):
+        '''Gets the stored master state JSON for a group, or None.'''
+        return self.reader().hget(self.master_key(group_name), 'state')
+
+    def set_master_state_str(self, group_name, version, state_str):
+        '''Stores the master state JSON for a group, unless a state covering
+        as many (or more) versions is already stored.'''
+        self.lua_set_master_state(keys=[self.master_key(group_name), ],
+                                  args=[version, state_str, ])
+
+    def get_compat_verdict_str(self, group_name, version, verdict_key):
+        '''Gets a shared compatibility verdict JSON, if compat_cache_redis is
+        set and the hash holds verdicts for the group version.'''
+        if not self.compat_cache_redis:
+            return None
+        (cur, verdict_str) = self.reader().hmget(self.compat_key(group_name),
+                                                 'version', verdict_key)
+        if cur and long(cur) == version:
+            return verdict_str
+
+    def set_compat_verdict_str(self, group_name, version, verdict_key,
+                               verdict_str):
+        '''Shares a compatibility verdict JSON, if compat_cache_redis is set.
+        '''
+        if self.compat_cache_redis:
+            self.lua_set_compat_verdict(keys=[self.compat_key(group_name), ],
+                                        args=[version, verdict_key,
+                                              verdict_str, ])
+
 
 from tasr.registered_schema import RegisteredAvroSchema
 
@@ -612,8 +1809,26 @@ from tasr.registered_schema import RegisteredAvroSchema
 class AvroSchemaRepository(RedisSchemaRepository):
     '''This is an Avro-specific schema repository class.
     '''
-    def __init__(self, host='localhost', port=6379, db=0):
-        super(AvroSchemaRepository, self).__init__(host=host, port=port, db=db)
+    def __init__(self, host='localhost', port=6379, db=0,
+                 schema_cache_entries=SCHEMA_CACHE_ENTRIES,
+                 schema_cache_bytes=SCHEMA_CACHE_BYTES,
+                 group_cache_entries=GROUP_CACHE_ENTRIES,
+                 group_cache_ttl=GROUP_CACHE_TTL,
+                 connection_pool=None, replica_pools=None,
+                 read_your_writes=0,
+                 compat_cache_entries=COMPAT_CACHE_ENTRIES,
+                 compat_cache_redis=False):
+        super(AvroSchemaRepository, self).__init__(
+            host=host, port=port, db=db,
+            schema_cache_entries=schema_cache_entries,
+            schema_cache_bytes=schema_cache_bytes,
+            group_cache_entries=group_cache_entries,
+            group_cache_ttl=group_cache_ttl,
+            connection_pool=connection_pool,
+            replica_pools=replica_pools,
+            read_your_writes=read_your_writes,
+            compat_cache_entries=compat_cache_entries,
+            compat_cache_redis=compat_cache_redis)
 
     def instantiate_registered_schema(self):
         '''Returns a RegisteredAvroSchema object, overriding the parent.
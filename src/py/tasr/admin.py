@@ -0,0 +1,59 @@
+'''
+Command-line admin tasks for a TASR Redis instance.  These are operations we
+do not want exposed through the REST app, like one-off data migrations.  Run
+from the project root (so the tasr.cfg file is found) like this:
+
+    python src/py/tasr/admin.py --env local build_group_index
+
+Available commands:
+
+  build_group_index -- builds the 'groups' index set from existing 'g.*' keys
+                       (required once for repositories predating the index)
+  migrate_to_cluster_layout -- renames the group keys of a single node Redis
+                       to the hash-tagged Redis Cluster layout (see the
+                       tasr.cluster module), before moving it into a cluster
+'''
+import sys
+import argparse
+import logging
+import tasr
+import tasr.cluster
+from tasr.tasr_config import CONFIG
+
+COMMANDS = ['build_group_index', 'migrate_to_cluster_layout', ]
+
+
+def build_group_index(asr):
+    '''Build the group name index using a SCAN of the 'g.*' keys.'''
+    count = asr.rebuild_group_index()
+    sys.stdout.write('Indexed %s groups.\n' % count)
+
+
+def migrate_to_cluster_layout(asr):
+    '''Rename the group keys to the hash-tagged cluster layout.'''
+    count = tasr.cluster.migrate_to_cluster_layout(asr.redis)
+    sys.stdout.write('Migrated %s groups.\n' % count)
+
+
+def main(argv=None):
+    '''Parse the args and run the requested admin command.'''
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--env', default='standard')
+    arg_parser.add_argument('--redis_host', default=None)
+    arg_parser.add_argument('--redis_port', type=int, default=None)
+    arg_parser.add_argument('command', choices=COMMANDS)
+    args = arg_parser.parse_args(argv)
+
+    CONFIG.set_mode(args.env)
+    rhost = args.redis_host if args.redis_host else CONFIG.redis_host
+    rport = args.redis_port if args.redis_port else CONFIG.redis_port
+    logging.basicConfig(level=CONFIG.log_level)
+    asr = tasr.AvroSchemaRepository(host=rhost, port=rport)
+    if args.command == 'build_group_index':
+        build_group_index(asr)
+    elif args.command == 'migrate_to_cluster_layout':
+        migrate_to_cluster_layout(asr)
+
+
+if __name__ == "__main__":
+    main()
@@ -33,8 +33,9 @@ For running the app in standalone mode, please see the app_standalone module.
 '''
 import tasr.app_wsgi
 from tasr.app_core import TASR_COLLECTION_APP, TASR_ID_APP, TASR_SCHEMA_APP
+from tasr.app_core import TASR_SCHEMAS_APP, TASR_STATS_APP
 from tasr.app_topic import TASR_TOPIC_APP
-from tasr.app_subject import TASR_SUBJECT_APP
+from tasr.app_subject import TASR_SUBJECT_APP, TASR_SUBJECTS_APP
 
 
 TASR_APP = tasr.app_wsgi.TASRApp()
@@ -42,5 +43,8 @@ TASR_APP = tasr.app_wsgi.TASRApp()
 TASR_APP.mount('/tasr/collection', TASR_COLLECTION_APP)
 TASR_APP.mount('/tasr/id', TASR_ID_APP)
 TASR_APP.mount('/tasr/schema', TASR_SCHEMA_APP)
+TASR_APP.mount('/tasr/schemas', TASR_SCHEMAS_APP)
 TASR_APP.mount('/tasr/topic', TASR_TOPIC_APP)
 TASR_APP.mount('/tasr/subject', TASR_SUBJECT_APP)
+TASR_APP.mount('/tasr/subjects', TASR_SUBJECTS_APP)
+TASR_APP.mount('/tasr/stats', TASR_STATS_APP)
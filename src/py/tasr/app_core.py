@@ -6,10 +6,14 @@ Created on November 18, 2014
 The endpoints beginning with /id, /schema and /list are defined here.  These
 are meant to be mounted by an umbrella instance of TASRApp.  This
 
+The /schemas, /collection and /stats endpoints are defined here as well.
 '''
 import avro.schema
 import bottle
+import json
 import tasr.app_wsgi
+import tasr.group
+import tasr.registered_schema
 from tasr.registered_schema import MasterAvroSchema
 from tasr.headers import SchemaHeaderBot
 
@@ -37,12 +41,18 @@ def schema_for_id_str(base64_id_str=None):
     This access method is not currently supported in the S+V API, or by the
     standard Avro (1124-type) schema repository.  It is only really possible
     with the multi-type ID.
+
+    The schema for an ID never changes, so the response can be cached for a
+    long time.  A request with the ETag in If-None-Match gets a 304 without a
+    call to Redis, if the ID is a sha256 one (or the schema is cached).
     '''
     if base64_id_str == None or base64_id_str == '':
         TASR_ID_APP.abort(400, 'Missing base64 ID string.')
+    TASR_ID_APP.abort_if_not_modified(
+        TASR_ID_APP.ASR.sha256_id_for_id_str(base64_id_str), immutable=True)
     reg_schema = TASR_ID_APP.ASR.get_schema_for_id_str(base64_id_str)
     if reg_schema:
-        return TASR_ID_APP.schema_response(reg_schema)
+        return TASR_ID_APP.schema_response(reg_schema, immutable=True)
     # return nothing if there is no schema registered for the topic name
     TASR_ID_APP.abort(404, 'No schema registered with id %s' % base64_id_str)
 
@@ -98,19 +108,132 @@ def schema_for_schema_str():
         TASR_SCHEMA_APP.abort(400, 'Invalid schema.  Failed to consider.')
 
 
+##############################################################################
+# /schemas app - resolve many schema references at once
+##############################################################################
+TASR_SCHEMAS_APP = tasr.app_wsgi.TASRApp()
+MAX_RESOLVE_REFS = 1000
+
+
+def ref_for_item(item):
+    '''Returns the repository reference (an id string or a (subject name,
+    version) pair) for an item in a resolve request, raising a ValueError for
+    a bad item.  An item is an id string, an {"id": <id string>} object or a
+    {"subject": <name>, "version": <version>} object.  The version is
+    optional, with the latest version as the default.'''
+    if isinstance(item, dict) and 'id' in item:
+        item = item['id']
+    if isinstance(item, basestring):
+        if not TASR_SCHEMAS_APP.ASR.is_id_str(item):
+            raise ValueError('Bad id string.')
+        return item
+    if isinstance(item, dict) and 'subject' in item:
+        subject_name = item['subject']
+        if not (isinstance(subject_name, basestring) and
+                tasr.group.Group.validate_group_name(subject_name)):
+            raise ValueError('Bad subject name.')
+        version = item.get('version', -1)
+        try:
+            version = -1 if version == 'latest' else int(version)
+        except (TypeError, ValueError):
+            version = 0
+        if version < 1 and version != -1:
+            raise ValueError('Bad version.')
+        return (subject_name, version)
+    raise ValueError('Expected an id string or a subject and version.')
+
+
+@TASR_SCHEMAS_APP.post('/resolve')
+def resolve_schemas():
+    '''Resolves a list of schema references in one request, where a consumer
+    would otherwise make an /id or a /subject/<subject>/version request for
+    each one.  The body is a JSON list of references, each an id string (md5
+    or sha256 based), an {"id": <id string>} object or a {"subject": <name>,
+    "version": <version>} object (the version defaulting to the latest).
+
+    The response is a JSON object with a "results" list holding an object for
+    each reference, in order.  Each has the "ref" as passed, a "found" flag
+    and an "error" message (null unless the reference was bad).  A found
+    schema adds the fields of the schema's dict: the "schema" itself, its
+    "sha256_id" and "md5_id" and the "vid.<subject>" and "vts.<subject>"
+    version and timestamp entries.  The references are all resolved in one
+    pipelined pass through the repository, using the schema cache.
+    '''
+    c_type = str(bottle.request.content_type).split(';')[0].strip()
+    if not tasr.app_wsgi.is_json_type(c_type):
+        TASR_SCHEMAS_APP.abort(406, 'Content-Type not JSON.')
+    try:
+        items = json.loads(bottle.request.body.read())
+    except ValueError:
+        TASR_SCHEMAS_APP.abort(400, 'Invalid JSON')
+    if not isinstance(items, list):
+        TASR_SCHEMAS_APP.abort(400, 'Expected a JSON list.')
+    if len(items) > MAX_RESOLVE_REFS:
+        TASR_SCHEMAS_APP.abort(400, 'More than %s references.' %
+                               MAX_RESOLVE_REFS)
+    results = []
+    refs = []
+    for item in items:
+        result = {'ref': item, 'found': False, 'error': None}
+        results.append(result)
+        try:
+            refs.append((result, ref_for_item(item)))
+        except ValueError as err:
+            result['error'] = str(err)
+    schemas = TASR_SCHEMAS_APP.ASR.get_schemas_for_refs(
+        [ref for (_, ref) in refs])
+    for ((result, _), reg_schema) in zip(refs, schemas):
+        if reg_schema:
+            result.update(reg_schema.as_dict())
+            result['found'] = True
+    body = {'results': results}
+    return TASR_SCHEMAS_APP.object_response(json.dumps(body), body,
+                                            'application/json')
+
+
 ##############################################################################
 # /collection app - get lists of objects in the repo
 ##############################################################################
 TASR_COLLECTION_APP = tasr.app_wsgi.TASRApp()
 
 
-def subject_list_response(sub_list):
-    '''Given a list of subjects (Group objects), construct a response with all
-    the subjects represented.'''
+def subject_list_response(active_only=False):
+    '''Construct a response with all the subjects (or only the active ones)
+    represented.  The subjects, with their current schemas, are retrieved in a
+    single bulk call to the repository.
+
+    The after and limit query args select a page of the subjects (in the
+    repository's group order): up to limit subjects with names after the
+    passed one.  For the active list, the inactive subjects are dropped before
+    the page is taken, so a page is only short at the end.  If there are more,
+    the X-TASR-SUBJECT-NEXT-AFTER header has the after value for the next
+    page: the name of the last subject returned.  A subject name header is
+    added per subject for lists short enough.  For NDJSON, each line is a
+    subject's JSON dict.'''
+    asr = TASR_COLLECTION_APP.ASR
     hbot = tasr.headers.SubjectHeaderBot(bottle.response)
+    limit = TASR_COLLECTION_APP.query_int('limit')
+    after = bottle.request.query.get('after')
+    if limit is None and not after:
+        sub_list = asr.get_groups(active_only=active_only)
+    else:
+        names = asr.get_group_names(active_only)
+        if after:
+            after_key = asr.group_sort_key(after)
+            names = [name for name in names
+                     if asr.group_sort_key(name) > after_key]
+        page = names if limit is None else names[:limit]
+        sub_list = asr.get_groups(page, active_only)
+        if len(page) < len(names):
+            hbot.set_next_after(sub_list[-1].name if sub_list else page[-1])
+    if tasr.app_wsgi.is_ndjson():
+        return TASR_COLLECTION_APP.stream_response(
+            json.dumps(subject.as_dict()) for subject in sub_list)
+    if TASR_COLLECTION_APP.list_headers_allowed(len(sub_list)):
+        for subject in sub_list:
+            hbot.add_subject_name(subject)
     s_dicts = dict()
     for subject in sub_list:
-        hbot.add_subject_name(subject)
         s_dicts[subject.name] = subject.as_dict()
     return TASR_COLLECTION_APP.object_response(sub_list, s_dicts)
 
@@ -126,8 +249,7 @@ def all_subject_names():
     If text/json or application/json is specified, the return body will be a
     JSON document containing current metadata for each subject.
     '''
-    subjects = TASR_COLLECTION_APP.ASR.get_all_groups()
-    return subject_list_response(subjects)
+    return subject_list_response()
 
 
 @TASR_COLLECTION_APP.get('/subjects/active')
@@ -136,5 +258,28 @@ def active_subject_names():
     line (using '\n' as delimiters).  We add X-TASR headers with the subject
     names as well.
     '''
-    subjects = TASR_COLLECTION_APP.ASR.get_active_groups()
-    return subject_list_response(subjects)
+    return subject_list_response(active_only=True)
+
+
+##############################################################################
+# /stats app - in-process cache counters
+##############################################################################
+TASR_STATS_APP = tasr.app_wsgi.TASRApp()
+
+
+@TASR_STATS_APP.get('/')
+def cache_stats():
+    '''Returns the counters (entries, bytes, hits, misses and hit rate) for
+    the in-process caches of the serving process as a JSON doc.  Each process
+    has its own caches, so under mod_wsgi this only covers the process that
+    handled the request.'''
+    asr = TASR_STATS_APP.ASR
+    stats = {'response': TASR_STATS_APP.response_cache.stats(),
+             'schema': asr.schema_cache.stats(),
+             'compat': asr.compat_cache.stats(),
+             'validator': asr.validator_cache.stats(),
+             'parsed': tasr.registered_schema.PARSED_CACHE.stats(),
+             'canonical': tasr.registered_schema.CANONICAL_CACHE.stats()}
+    if hasattr(asr, 'group_cache'):
+        stats['group'] = asr.group_cache.stats()
+    return TASR_STATS_APP.object_response(None, stats, 'application/json')
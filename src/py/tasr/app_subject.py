@@ -16,12 +16,18 @@ import bottle
 import json
 import re
 import requests
+import threading
 import tasr.app_core
 import tasr.app_wsgi
 import tasr.group
 import tasr.headers
 import tasr.registered_schema
+import tasr.validators
+from multiprocessing.pool import ThreadPool
 
+BATCH_THREADS = 8
+BATCH_POOL = None
+BATCH_POOL_LOCK = threading.Lock()
 
 ##############################################################################
 # TASR Subject API endpoints -- mount to /tasr/subject
@@ -57,6 +63,22 @@ def abort_if_body_empty():
         TASR_SUBJECT_APP.abort(400, 'Expected a non-empty request body.')
 
 
+def validators_from_value(val):
+    '''Gets the set of validator names from a "validators" config value, a
+    comma- or whitespace-delimited string (or a JSON list).  Unknown names
+    are a 400.'''
+    if val is None:
+        return None
+    if isinstance(val, basestring):
+        val = [name for name in re.split(r'[\s,]+', val) if name]
+    names = set()
+    for name in val:
+        if not tasr.validators.is_validator_name(name):
+            TASR_SUBJECT_APP.abort(400, 'Unknown validator: %s' % name)
+        names.add(name.upper())
+    return names
+
+
 def get_subject(subject_name):
     '''Getting the subject object is common enough to be a method'''
     abort_if_subject_bad(subject_name)
@@ -133,11 +155,23 @@ def register_subject(subject_name=None):
     If a config map is defined and it matches the one stored for an existing
     subject, a 200 is returned.  However, if a config map conflicts with a pre-
     existing one for the subject, a 409 (conflict) status will be returned.
+
+    A "validators" entry is not config.  It names the compatibility validators
+    (see tasr.validators) new versions of a new subject must pass.  For an
+    existing subject, it must match the ones the subject has.
     '''
     abort_if_subject_bad(subject_name)
     config_dict = request_data_to_dict()
+    validators = validators_from_value(config_dict.pop('validators', None))
     subject = TASR_SUBJECT_APP.ASR.lookup_group(subject_name)
     if subject:
+        if validators is not None:
+            cur = tasr.validators.selected_validators(
+                TASR_SUBJECT_APP.ASR.get_group_validators(subject_name))
+            if set(cur) != validators:
+                _msg = ('Conflict.  Mismatched validators: %s' %
+                        ', '.join(sorted(cur)))
+                TASR_SUBJECT_APP.abort(409, _msg)
         # subject already there, so check for conflicts
         diff_set = set(subject.config.keys()) ^ set(config_dict.keys())
         if len(diff_set) > 0:
@@ -159,7 +193,8 @@ def register_subject(subject_name=None):
         for key, val in config_dict.iteritems():
             ckey = 'config.%s' % key
             metadata_dict[ckey] = val
-        TASR_SUBJECT_APP.ASR.register_group(subject_name, metadata_dict)
+        TASR_SUBJECT_APP.ASR.register_group(subject_name, metadata_dict,
+                                            validators)
         subject = TASR_SUBJECT_APP.ASR.lookup_group(subject_name)
         if not subject:
             TASR_SUBJECT_APP.abort(500, ('Failed to create subject %s.'
@@ -257,6 +292,20 @@ def subject_integral(subject_name=None):
     return TASR_SUBJECT_APP.object_response(False)
 
 
+def version_page(hbot, subject):
+    '''Returns the (first, last) versions to list, from the from_version and
+    limit query args (defaulting to all the versions).  If there are versions
+    after the page, the first of them is set in the next version header.  The
+    last version is less than the first when the page is empty.'''
+    first = TASR_SUBJECT_APP.query_int('from_version', 1)
+    limit = TASR_SUBJECT_APP.query_int('limit')
+    current = int(subject.current_version or 0)
+    last = current if limit is None else min(current, first + limit - 1)
+    if last < current:
+        hbot.set_next_version(last + 1)
+    return (first, last)
+
+
 @TASR_SUBJECT_APP.get('/<subject_name>/all_ids')
 def all_subject_ids(subject_name=None):
     '''For this subject, get the SHA256 IDs, in order, of all the registered
@@ -265,17 +314,30 @@ def all_subject_ids(subject_name=None):
 
     For a JSON response, we return a list of ID string values.  The first in
     the list is version number 1.  For text/plain, we return one ID string per
-    line.  The standard subject headers are included in all cases.
+    line.  For NDJSON (the stream query arg or an application/x-ndjson Accept
+    header), each line is a JSON string.  The standard subject headers are
+    included in all cases, and a header per ID for lists short enough.
+
+    The from_version and limit query args select a page of the versions.  If
+    there are more, the X-TASR-SUBJECT-NEXT-VERSION header has the
+    from_version for the next page.
     '''
     subject = get_subject(subject_name)
     hbot = tasr.headers.SubjectHeaderBot(bottle.response)
     hbot.standard_headers(subject)
-    tasr.app_wsgi.log_request(bottle.response.status_code)
+    (first, last) = version_page(hbot, subject)
     asr = TASR_SUBJECT_APP.ASR
     id_list = []
-    for sha256_id in asr.get_all_version_sha256_ids_for_group(subject_name):
-        hbot.add_subject_sha256_id_to_list(sha256_id[3:])
-        id_list.append(sha256_id[3:])
+    if first <= last:
+        id_list = [sha256_key[3:] for sha256_key in
+                   asr.get_version_sha256_ids_for_group(subject_name, first,
+                                                        last)]
+    if tasr.app_wsgi.is_ndjson():
+        return TASR_SUBJECT_APP.stream_response(json.dumps(sha256_id)
+                                                for sha256_id in id_list)
+    if TASR_SUBJECT_APP.list_headers_allowed(len(id_list)):
+        for sha256_id in id_list:
+            hbot.add_subject_sha256_id_to_list(sha256_id)
     return TASR_SUBJECT_APP.object_response(id_list)
 
 
@@ -288,35 +350,41 @@ def all_subject_schemas(subject_name=None):
     For a JSON response, we return a list of schema objects (JSON dicts).  The
     first in the list is version number 1.  For text/plain, we return one
     schema (a JSON dict) per line.  The standard subject headers are included
-    in all cases.
+    in all cases, and a header per ID for lists short enough.
+
+    The from_version and limit query args select a page of the versions, as
+    for all_ids.  For NDJSON (the stream query arg or an application/x-ndjson
+    Accept header), the schemas are streamed one per line as they are
+    retrieved in batches, so the whole list is never held in memory.
     '''
     subject = get_subject(subject_name)
     asr = TASR_SUBJECT_APP.ASR
     hbot = tasr.headers.SubjectHeaderBot(bottle.response)
     hbot.standard_headers(subject)
-    tasr.app_wsgi.log_request(bottle.response.status_code)
-
-    schema_list = []
-    jobj_list = []
-    for schema in asr.get_latest_schema_versions_for_group(subject_name, -1):
-        hbot.add_subject_sha256_id_to_list(schema.sha256_id)
-        schema_list.append(schema.canonical_schema_str)
-        jobj_list.append(schema.ordered)
+    (first, last) = version_page(hbot, subject)
+    if tasr.app_wsgi.is_ndjson():
+        versions = asr.iter_schema_versions_for_group(subject_name, first,
+                                                      last)
+        return TASR_SUBJECT_APP.stream_response(schema.canonical_schema_str
+                                                for schema in versions)
+    versions = []
+    if first <= last:
+        versions = asr.get_schema_versions_for_group(subject_name, first,
+                                                     last)
+    if TASR_SUBJECT_APP.list_headers_allowed(len(versions)):
+        for schema in versions:
+            hbot.add_subject_sha256_id_to_list(schema.sha256_id)
+    schema_list = [schema.canonical_schema_str for schema in versions]
+    jobj_list = [schema.ordered for schema in versions]
     return TASR_SUBJECT_APP.object_response(schema_list, jobj_list)
 
 
 def recursive_master_schema(versions):
     '''Takes a list of versions and creates a "master", containing all the
-    fields from the most recent compatible versions. It tries on the whole
-    list, and if it fails it recurses, trying on the list minus its head.
+    fields from the most recent compatible versions.  Returns a (depth, master)
+    tuple.  See tasr.registered_schema.longest_compatible_master().
     '''
-    try:
-        mas = tasr.registered_schema.MasterAvroSchema(versions)
-        return (len(versions), mas)
-    except Exception:
-        if len(versions) > 1:
-            return recursive_master_schema(versions[1:])
-        return (0, None)
+    return tasr.registered_schema.longest_compatible_master(versions)
 
 
 @TASR_SUBJECT_APP.get('/<subject_name>/master')
@@ -326,48 +394,51 @@ def subject_master_schema(subject_name=None):
     build the Hive tables that cover all the versions.
 
     Note that if the versions are incompatible, the master will be composed
-    from the most recent compatible versions.'''
+    from the most recent compatible versions, and a 409 is returned with it.
+    The number of versions included is in the X-TASR-SUBJECT-MASTER-DEPTH
+    header.  The master is kept up to date with each registration, so this
+    does not rebuild it from the versions.'''
     abort_if_subject_bad(subject_name)
     asr = TASR_SUBJECT_APP.ASR
-    versions = asr.get_latest_schema_versions_for_group(subject_name, -1)
-    if not versions or len(versions) == 0:
+    state = asr.get_group_master(subject_name)
+    if not state.version:
         TASR_SUBJECT_APP.abort(404, ('No versions registered for %s.'
                                      % subject_name))
-    (depth, mas) = recursive_master_schema(versions)
-    # we might want to add a response header to indicate master depth
-    if depth < len(versions):
+    hbot = tasr.headers.SubjectHeaderBot(bottle.response)
+    hbot.set_subject_master_depth(state.depth)
+    if state.depth < state.version:
         # master based on an incomplete set of versions
         bottle.response.status = 409
-    return TASR_SUBJECT_APP.object_response(mas.canonical_schema_str,
-                                            mas.ordered,
+    return TASR_SUBJECT_APP.object_response(state.master.canonical_schema_str,
+                                            state.master.ordered,
                                             'application/json')
 
 
 def is_back_compatible(subject_name, schema_str):
     '''A convenience method that checks whether a given schema string is back
     compatible with all the previously registered schema versions.  This is
-    used whenever we are considering registering a new schema version.'''
+    used whenever we are considering registering a new schema version.  The
+    subject's validators are compiled from the registered versions once, so
+    the check only walks the fields of the new schema, however many versions
+    there are, and the verdict is cached until the subject gets a new version.
+    '''
     asr = TASR_SUBJECT_APP.ASR
     # instantiate a RAS object with the passed schema string
     unreg_schema = asr.instantiate_registered_schema()
     unreg_schema.schema_str = schema_str
-    # now grab all the previous schemas up to the latest
-    olds = asr.get_latest_schema_versions_for_group(subject_name, -1)
-    # check that the new schema will be back-compatible -- note that by using
-    # the MAS, we are allowing exceptions to bubble up.  This is to allow more
-    # informative, field-specific errors to make it to the response.
-    if olds and len(olds) > 0:
-        mas = tasr.registered_schema.MasterAvroSchema(olds)
-        return mas.is_compatible(unreg_schema)
-    return True
+    # check that the new schema will be back-compatible -- note that if the
+    # previous versions are not compatible with each other, or a validator
+    # can say why the schema is not compatible, a ValueError is raised.  This
+    # is to allow more informative, field-specific errors to make it to the
+    # response.
+    return asr.check_group_compatible(subject_name, unreg_schema)
 
 
 def update_hdfs_master(subject_name):
     if not TASR_SUBJECT_APP.config.push_masters_to_hdfs:
         return None
     app = TASR_SUBJECT_APP
-    versions = app.ASR.get_latest_schema_versions_for_group(subject_name, -1)
-    mas = recursive_master_schema(versions)[1]
+    mas = app.ASR.get_group_master(subject_name).master
     normalized_subject_name = re.sub(r"^s_", "", subject_name)
     base_url = '%s%s/%s' % (app.config.webhdfs_url,
                             app.config.hdfs_master_path,
@@ -409,6 +480,9 @@ def register_subject_schema(subject_name=None):
             TASR_SUBJECT_APP.abort(400, 'Invalid schema.')
         if reg_schema.created:
             bottle.response.status = 201
+            # fold the new version into the stored master state now, rather
+            # than on the next compatibility check
+            asr.get_group_master(subject_name)
             update_hdfs_master(subject_name)
         return TASR_SUBJECT_APP.schema_response(reg_schema, subject_name)
     except avro.schema.SchemaParseException:
@@ -482,7 +556,7 @@ def lookup_by_schema_str(subject_name=None):
         # the raised exception will abort on a 400 right away
         unreg_schema = asr.instantiate_registered_schema()
         unreg_schema.schema_str = schema_str
-        tasr.registered_schema.MasterAvroSchema([unreg_schema, ])
+        check_schema_rules(uses_master_rules(subject_name), unreg_schema)
         # since the schema is OK, check back-compat
         try:
             if not is_back_compatible(subject_name, schema_str):
@@ -506,10 +580,156 @@ def lookup_by_schema_str(subject_name=None):
         TASR_SUBJECT_APP.abort(400, 'Invalid schema.  Failed to consider.')
 
 
+def batch_pool():
+    '''Returns the thread pool used to check batches of candidate schemas,
+    creating it on first use.'''
+    global BATCH_POOL
+    with BATCH_POOL_LOCK:
+        if BATCH_POOL is None:
+            threads = TASR_SUBJECT_APP.config.batch_threads
+            BATCH_POOL = ThreadPool(threads if threads else BATCH_THREADS)
+        return BATCH_POOL
+
+
+def reset_batch_pool():
+    '''Forgets the batch thread pool in a forked worker process, as its
+    threads stay behind in the parent.  A new one is created on first use.'''
+    global BATCH_POOL, BATCH_POOL_LOCK
+    BATCH_POOL = None
+    BATCH_POOL_LOCK = threading.Lock()
+
+
+def uses_master_rules(subject_name):
+    '''Checks whether the subject's new versions are held to the master
+    schema rules (see tasr.validators), which is the default.'''
+    names = TASR_SUBJECT_APP.ASR.get_group_validators(subject_name)
+    return (tasr.validators.MASTER in
+            tasr.validators.selected_validators(names))
+
+
+def check_schema_rules(master_rules, unreg_schema):
+    '''Raises a ValueError if an unregistered schema is not valid or, if the
+    master rules apply, lacks the required fields and defaults.  Subjects
+    with other validators only need a valid schema, as for a registration.
+    '''
+    if not unreg_schema.validate_schema_str():
+        raise ValueError()
+    if master_rules:
+        tasr.registered_schema.MasterAvroSchema([unreg_schema, ])
+
+
+def check_candidates(subject_name, candidates):
+    '''Checks a list of candidate schemas (schema objects or strings) as the
+    next version for a subject.  Returns a list with a dict for each, holding
+    the candidate's IDs, a compatible flag and an error message (or None).
+    The subject's validators are loaded once for the whole list.'''
+    asr = TASR_SUBJECT_APP.ASR
+    master_rules = uses_master_rules(subject_name)
+    results = []
+    valid = []
+    for candidate in candidates:
+        result = {'sha256_id': None, 'md5_id': None,
+                  'compatible': False, 'error': None}
+        results.append(result)
+        unreg_schema = asr.instantiate_registered_schema()
+        try:
+            if isinstance(candidate, basestring):
+                unreg_schema.schema_str = candidate
+            else:
+                unreg_schema.schema_str = json.dumps(candidate)
+            # the same checks that a lookup by schema string does
+            check_schema_rules(master_rules, unreg_schema)
+        except (ValueError, avro.schema.SchemaParseException) as err:
+            result['error'] = ('Invalid schema: %s' % err if str(err)
+                               else 'Invalid schema.')
+            continue
+        result['sha256_id'] = unreg_schema.sha256_id
+        result['md5_id'] = unreg_schema.md5_id
+        valid.append((result, unreg_schema))
+    verdicts = asr.compat_verdicts(subject_name,
+                                   [unreg for (_, unreg) in valid])
+    for ((result, _), (is_compatible, error)) in zip(valid, verdicts):
+        result['compatible'] = is_compatible
+        if error:
+            result['error'] = error
+        elif not is_compatible:
+            result['error'] = 'Schema not compatible with previous versions.'
+    return results
+
+
+def check_candidate_batches(batches):
+    '''Checks a (subject name, candidate list) list of batches, using the
+    batch thread pool.  Returns a list of result lists, in the same order.'''
+    if len(batches) == 1:
+        return [check_candidates(*batches[0]), ]
+    return batch_pool().map(lambda batch: check_candidates(*batch), batches)
+
+
+def request_json_body(expected_type):
+    '''Returns the parsed JSON request body, aborting on a 400 if it is not
+    valid JSON of the expected type.  The body is read rather than taken
+    with getvalue(), as bottle spools bodies over MEMFILE_MAX to a file.'''
+    abort_if_content_type_not_json()
+    body = bottle.request.body.read()
+    if not body:
+        TASR_SUBJECT_APP.abort(400, 'Expected a non-empty request body.')
+    try:
+        body = json.loads(body)
+    except ValueError:
+        TASR_SUBJECT_APP.abort(400, 'Invalid JSON')
+    if not isinstance(body, expected_type):
+        TASR_SUBJECT_APP.abort(400, 'Expected a JSON %s.' %
+                               expected_type.__name__)
+    return body
+
+
+@TASR_SUBJECT_APP.post('/<subject_name>/compatibility/batch')
+def subject_compatibility_batch(subject_name=None):
+    '''Checks many candidate schemas as the next version for a subject, as
+    a lookup by schema string would, but in one request.  The body is a JSON
+    list of candidates (schema objects or schema strings).  The response is
+    a JSON object with the subject name and a "results" list, with an object
+    for each candidate (in order) holding its "sha256_id" and "md5_id", a
+    "compatible" flag and an "error" message (null if compatible).  Unlike
+    the lookup, this does not check whether the candidates are registered.
+    '''
+    abort_if_subject_bad(subject_name)
+    candidates = request_json_body(list)
+    results = check_candidate_batches([(subject_name, candidates), ])[0]
+    body = {'subject': subject_name, 'results': results}
+    return TASR_SUBJECT_APP.object_response(json.dumps(body), body,
+                                            'application/json')
+
+
+@TASR_SUBJECT_APP.post('/compatibility/batch')
+def compatibility_batch():
+    '''The cross-subject version of subject_compatibility_batch().  The body
+    is a JSON object mapping subject names to lists of candidates, and the
+    response maps each subject name to its list of results.  The subjects
+    are checked in parallel, by the batch thread pool.
+    '''
+    subject_candidates = request_json_body(dict)
+    batches = []
+    for (subject_name, candidates) in subject_candidates.iteritems():
+        abort_if_subject_bad(subject_name)
+        if not isinstance(candidates, list):
+            TASR_SUBJECT_APP.abort(400, 'Expected a list of candidates for '
+                                   '%s.' % subject_name)
+        batches.append((subject_name, candidates))
+    results = check_candidate_batches(batches) if batches else []
+    body = dict()
+    for ((subject_name, _), subject_results) in zip(batches, results):
+        body[subject_name] = subject_results
+    return TASR_SUBJECT_APP.object_response(json.dumps(body), body,
+                                            'application/json')
+
+
 @TASR_SUBJECT_APP.get('/<subject_name>/version/<version>')
 def lookup_by_subject_and_version(subject_name=None, version=None):
     '''Retrieves the registered schema for the specified group_name with the
-    specified version number.  Note that versions count from 1, not 0.
+    specified version number.  Note that versions count from 1, not 0.  A
+    version never changes, so the response can be cached for a long time,
+    except for version -1 (the latest), which gets the short max-age.
     '''
     abort_if_subject_bad(subject_name)
     abort_if_value_bad(version, 'version')
@@ -525,28 +745,37 @@ def lookup_by_subject_and_version(subject_name=None, version=None):
     here to be the expected one.
     '''
     reg_schema.gv_dict[subject_name] = version
-    return TASR_SUBJECT_APP.schema_response(reg_schema, subject_name)
+    immutable = tasr.app_wsgi.is_fixed_version(version)
+    return TASR_SUBJECT_APP.schema_response(reg_schema, subject_name,
+                                            immutable=immutable)
 
 
 @TASR_SUBJECT_APP.get('/<subject_name>/id/<id_str:path>')
 def lookup_by_subject_and_id_str(subject_name=None, id_str=None):
     '''Retrieves the latest version of a schema registered for the specified
-    group_name having the provided multi-type ID.
+    group_name having the provided multi-type ID.  As with /tasr/id, a
+    request with the ETag in If-None-Match can get a 304 without a call to
+    Redis.
     '''
     abort_if_subject_bad(subject_name)
     abort_if_value_bad(id_str, 'multi-type ID string')
-    reg_schema = TASR_SUBJECT_APP.ASR.get_schema_for_id_str(id_str)
+    asr = TASR_SUBJECT_APP.ASR
+    TASR_SUBJECT_APP.abort_if_not_modified(asr.sha256_id_for_id_str(id_str),
+                                           immutable=True)
+    reg_schema = asr.get_schema_for_id_str(id_str)
     if not reg_schema:
         msg = ('No schema with a multi-type ID %s registered for subject %s.' %
                (id_str, subject_name))
         TASR_SUBJECT_APP.abort(404, msg)
-    return TASR_SUBJECT_APP.schema_response(reg_schema, subject_name)
+    return TASR_SUBJECT_APP.schema_response(reg_schema, subject_name,
+                                            immutable=True)
 
 
 @TASR_SUBJECT_APP.get('/<subject_name>/latest')
 def lookup_latest(subject_name=None):
     '''Retrieves the registered schema for the specified group with the highest
-    version number.
+    version number.  This changes with each new version, so the response only
+    gets a short Cache-Control max-age.
     '''
     abort_if_subject_bad(subject_name)
     reg_schema = TASR_SUBJECT_APP.ASR.get_latest_schema_for_group(subject_name)
@@ -554,3 +783,62 @@ def lookup_latest(subject_name=None):
         msg = 'No schema registered for subject %s.' % subject_name
         TASR_SUBJECT_APP.abort(404, msg)
     return TASR_SUBJECT_APP.schema_response(reg_schema, subject_name)
+
+
+##############################################################################
+# TASR multi-subject API endpoints -- mount to /tasr/subjects
+##############################################################################
+TASR_SUBJECTS_APP = tasr.app_wsgi.TASRApp()
+MAX_LATEST_SUBJECTS = 1000
+
+
+def latest_many_response(subject_names):
+    '''Returns the latest schemas for a list of subjects, retrieved with a
+    single bulk call to the repository.  The body is a JSON object mapping
+    each subject name to its dict (the subject_name, config and current
+    schema version, ids and timestamp) plus the "schema" itself, or to null
+    if the subject is not registered or has no schema.'''
+    for subject_name in subject_names:
+        if not (isinstance(subject_name, basestring) and
+                tasr.group.Group.validate_group_name(subject_name)):
+            TASR_SUBJECTS_APP.abort(400, 'Bad subject name: %s.' %
+                                    subject_name)
+    if len(subject_names) > MAX_LATEST_SUBJECTS:
+        TASR_SUBJECTS_APP.abort(400, 'More than %s subjects.' %
+                                MAX_LATEST_SUBJECTS)
+    subjects = TASR_SUBJECTS_APP.ASR.get_groups(list(set(subject_names)),
+                                                active_only=True)
+    hbot = tasr.headers.SubjectHeaderBot(bottle.response)
+    add_headers = TASR_SUBJECTS_APP.list_headers_allowed(len(subjects))
+    body = dict((subject_name, None) for subject_name in subject_names)
+    for subject in subjects:
+        if add_headers:
+            hbot.add_subject_name_current_version(subject)
+        s_dict = subject.as_dict()
+        s_dict['schema'] = subject.current_schema.canonical_schema_str
+        body[subject.name] = s_dict
+    return TASR_SUBJECTS_APP.object_response(json.dumps(body), body,
+                                             'application/json')
+
+
+@TASR_SUBJECTS_APP.post('/latest')
+def lookup_latest_many():
+    '''Retrieves the latest registered schemas for many subjects at once,
+    where a producer would otherwise make a /subject/<subject>/latest request
+    for each one.  The body is a JSON list of subject names.  See
+    latest_many_response() for the response.'''
+    subject_names = request_json_body(list)
+    return latest_many_response(subject_names)
+
+
+@TASR_SUBJECTS_APP.get('/latest')
+def get_latest_many():
+    '''The GET version of lookup_latest_many(), with the subject names passed
+    as repeated subject query args.  As for a single subject's latest schema,
+    the response only gets a short Cache-Control max-age.'''
+    subject_names = bottle.request.query.getall('subject')
+    if not subject_names:
+        TASR_SUBJECTS_APP.abort(400, 'Expected subject query args.')
+    for (key, val) in TASR_SUBJECTS_APP.cache_headers().iteritems():
+        bottle.response.set_header(key, val)
+    return latest_many_response(subject_names)
@@ -85,12 +85,7 @@ def latest_schema_for_topic(topic_name=None):
     reg_schema = TASR_TOPIC_APP.ASR.get_latest_schema_for_group(topic_name)
     if reg_schema:
         # we leave out the topic_name to get back ver & ts for all assoc topics
-        tasr.headers.SchemaHeaderBot(bottle.response,
-                                     reg_schema).legacy_headers()
-        #jobj = json.loads(reg_schema.canonical_schema_str)
-        return TASR_TOPIC_APP.object_response(reg_schema.canonical_schema_str,
-                                              reg_schema.ordered,
-                                              'application/json')
+        return TASR_TOPIC_APP.schema_response(reg_schema, legacy=True)
     # return nothing if there is no schema registered for the group name
     TASR_TOPIC_APP.abort(404, 'No schema for topic %s.' % topic_name)
 
@@ -112,12 +107,9 @@ def schema_for_topic_and_version(topic_name=None, version=None):
         '''
         reg_schema.gv_dict[topic_name] = version
         # we leave out the topic_name to get back ver & ts for all assoc topics
-        tasr.headers.SchemaHeaderBot(bottle.response,
-                                     reg_schema).legacy_headers()
-        #jobj = json.loads(reg_schema.canonical_schema_str)
-        return TASR_TOPIC_APP.object_response(reg_schema.canonical_schema_str,
-                                              reg_schema.ordered,
-                                              'application/json')
+        immutable = tasr.app_wsgi.is_fixed_version(version)
+        return TASR_TOPIC_APP.schema_response(reg_schema, legacy=True,
+                                              immutable=immutable)
     # return nothing if there is no schema registered for the group name
     TASR_TOPIC_APP.abort(404, ('No version %s registered for topic %s.' %
                                (version, topic_name)))
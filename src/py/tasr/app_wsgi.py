@@ -14,17 +14,171 @@ the subapp is added to a dict of mounted apps and, if the subapp is a TASRApp,
 the ASR is updated to use the ASR of the umbrella instance.  This allows mode
 changes applied to the unbrella object to cascade down automatically.
 
+The ASR objects themselves are shared.  All the TASRApp objects configured
+with the same Redis and cache settings get the same AvroSchemaRepository, and
+so the same Redis connection pool, caches and invalidation subscriber.  A mode
+change only builds a new ASR if the settings for the new mode are new.  If the
+storage_backend is "sqlite", the ASR is an embedded one reading a local file.
+The cache of rendered schema response bodies is shared the same way, by all
+the TASRApp objects with the same cache settings.
+
+Response bodies are compressed (gzip or deflate, as negotiated with the
+Accept-Encoding header) when they are at least compress_min_bytes long.  The
+compressed schema bodies are kept in the rendered response cache alongside the
+plain ones, so a schema is only compressed once per coding.
+
+The list endpoints add a header per list item for clients to check the body
+against.  Those are only added for lists of up to max_list_headers items, as
+very long header blocks break proxies, and clients can page or stream long
+lists instead.  A streamed (NDJSON) body is yielded a line at a time.
+
 This module also includes some general purpose util methods used by many of the
 subapps.
 '''
 import bottle
+import gzip
 import json
 import logging
 import StringIO
 import tasr.tasr_config
+import tasr.cluster
+import tasr.embedded
+import tasr.headers
 import re
+import threading
+import zlib
+from tasr.cache import LRUCache
 
 TASR_VERSION = 2
+ASR_INSTANCES = dict()
+ASR_LOCK = threading.Lock()
+RESPONSE_CACHE_ENTRIES = 10000
+RESPONSE_CACHE_BYTES = 64 * 1024 * 1024
+RESPONSE_CACHES = dict()
+COMPRESS_MIN_BYTES = 1024
+# the content codings we compress with, in order of preference
+ENCODINGS = ('gzip', 'deflate')
+MAX_LIST_HEADERS = 100
+NDJSON_TYPE = 'application/x-ndjson'
+
+
+def replica_pool_args(pool_args, replica):
+    '''Returns the pool args for a "<host>:<port>" or unix socket path
+    replica, otherwise matching the primary's pool args.'''
+    rargs = dict(pool_args)
+    if replica.startswith('/'):
+        rargs['unix_socket_path'] = replica
+    else:
+        (rhost, rport) = replica.rsplit(':', 1)
+        rargs.update(host=rhost, port=int(rport), unix_socket_path=None)
+    return rargs
+
+
+def cluster_asr(pool_args, asr_args, cluster_nodes):
+    '''Returns a cluster layout ASR.  With no cluster nodes configured, the
+    Redis host and port are used as the (only) startup node.'''
+    nodes = []
+    for node in cluster_nodes:
+        (nhost, nport) = node.rsplit(':', 1)
+        nodes.append({'host': nhost, 'port': int(nport)})
+    if not nodes:
+        nodes.append({'host': pool_args['host'], 'port': pool_args['port']})
+    return tasr.cluster.ClusterAvroSchemaRepository(
+        startup_nodes=nodes,
+        max_connections=pool_args['max_connections'],
+        socket_timeout=pool_args['socket_timeout'],
+        socket_connect_timeout=pool_args['socket_connect_timeout'],
+        socket_keepalive=pool_args['socket_keepalive'],
+        **asr_args)
+
+
+def embedded_asr(config):
+    '''Returns the (shared) embedded sqlite ASR for the passed TASRConfig.
+    '''
+    key = ('sqlite', config.sqlite_path, bool(config.sqlite_read_only),
+           config.schema_cache_entries, config.schema_cache_bytes,
+           config.compat_cache_entries)
+    with ASR_LOCK:
+        asr = ASR_INSTANCES.get(key)
+        if asr is None:
+            asr = tasr.embedded.SqliteAvroSchemaRepository(
+                config.sqlite_path,
+                read_only=bool(config.sqlite_read_only),
+                schema_cache_entries=config.schema_cache_entries,
+                schema_cache_bytes=config.schema_cache_bytes,
+                compat_cache_entries=config.compat_cache_entries)
+            ASR_INSTANCES[key] = asr
+        return asr
+
+
+def shared_asr(config):
+    '''Returns the AvroSchemaRepository for the current settings of the passed
+    TASRConfig, creating it (with its own connection pools) on first use.
+    '''
+    pool_args = {'host': config.redis_host,
+                 'port': config.redis_port,
+                 'db': config.redis_db if config.redis_db else 0,
+                 'unix_socket_path': config.redis_unix_socket_path,
+                 'max_connections': config.redis_max_connections,
+                 'socket_timeout': config.redis_socket_timeout,
+                 'socket_connect_timeout': config.redis_socket_connect_timeout,
+                 'socket_keepalive': config.redis_socket_keepalive}
+    if config.storage_backend == 'sqlite':
+        return embedded_asr(config)
+    asr_args = {'schema_cache_entries': config.schema_cache_entries,
+                'schema_cache_bytes': config.schema_cache_bytes,
+                'group_cache_entries': config.group_cache_entries,
+                'group_cache_ttl': config.group_cache_ttl,
+                'compat_cache_entries': config.compat_cache_entries,
+                'compat_cache_redis': bool(config.compat_cache_redis),
+                'read_your_writes': config.redis_read_your_writes}
+    replicas = tuple(config.redis_replicas)
+    cluster_nodes = tuple(config.redis_cluster_nodes)
+    key = (tuple(sorted(pool_args.items())) +
+           tuple(sorted(asr_args.items())) + replicas)
+    if config.redis_cluster:
+        key += ('cluster', ) + cluster_nodes
+    with ASR_LOCK:
+        asr = ASR_INSTANCES.get(key)
+        if asr is None and config.redis_cluster:
+            asr = cluster_asr(pool_args, asr_args, cluster_nodes)
+            ASR_INSTANCES[key] = asr
+        elif asr is None:
+            pool = tasr.create_connection_pool(**pool_args)
+            replica_pools = [
+                tasr.create_connection_pool(**replica_pool_args(pool_args, r))
+                for r in replicas]
+            asr = tasr.AvroSchemaRepository(connection_pool=pool,
+                                            replica_pools=replica_pools,
+                                            **asr_args)
+            ASR_INSTANCES[key] = asr
+        return asr
+
+
+def reset_after_fork():
+    '''Resets the shared repositories in a forked worker process (see
+    tasr.serve), so no connection or lock is shared with the parent.'''
+    global ASR_LOCK
+    ASR_LOCK = threading.Lock()
+    for asr in ASR_INSTANCES.values():
+        asr.after_fork()
+
+
+def shared_response_cache(config):
+    '''Returns the (shared) cache of rendered schema responses for the passed
+    TASRConfig's settings.'''
+    entries = config.response_cache_entries
+    if entries is None:
+        entries = RESPONSE_CACHE_ENTRIES
+    max_bytes = config.response_cache_bytes
+    if max_bytes is None:
+        max_bytes = RESPONSE_CACHE_BYTES
+    with ASR_LOCK:
+        cache = RESPONSE_CACHES.get((entries, max_bytes))
+        if cache is None:
+            cache = LRUCache(entries, max_bytes)
+            RESPONSE_CACHES[(entries, max_bytes)] = cache
+        return cache
 
 
 class TASRApp(bottle.Bottle):
@@ -36,8 +190,13 @@ class TASRApp(bottle.Bottle):
         self.config = config
         self.mounted = dict()
         self.mounted_path = '/'
-        self.ASR = tasr.AvroSchemaRepository(host=config.redis_host,
-                                             port=config.redis_port)
+        self.ASR = self.instantiate_asr()
+        self.response_cache = shared_response_cache(self.config)
+
+    def instantiate_asr(self):
+        '''Returns the (shared) AvroSchemaRepository configured by the
+        TASRConfig.'''
+        return shared_asr(self.config)
 
     def set_config_mode(self, mode):
         '''Sets the mode of the associated TASRConfig.  If the app has any
@@ -45,8 +204,8 @@ class TASRApp(bottle.Bottle):
         '''
         self.config.set_mode(mode)
         # update the ASR to ensure we're pointing at the right Redis
-        self.ASR = tasr.AvroSchemaRepository(host=self.config.redis_host,
-                                             port=self.config.redis_port)
+        self.ASR = self.instantiate_asr()
+        self.response_cache = shared_response_cache(self.config)
         # now update any submodule ASRs
         for (_, subapp) in self.mounted.iteritems():
             if isinstance(subapp, TASRApp):
@@ -58,6 +217,7 @@ class TASRApp(bottle.Bottle):
         self.mounted[path] = subapp
         if isinstance(subapp, TASRApp):
             subapp.ASR = self.ASR
+            subapp.response_cache = self.response_cache
             subapp.mounted_path = path
 
     def error_dict(self, status_code=500, message='Error'):
@@ -95,13 +255,14 @@ class TASRApp(bottle.Bottle):
                 self.abort(400, 'Invalid JSONP callback function name')
 
         log_request(bottle.response.status_code)
+        body = None
         if callback_fn:
             # return a JSONP wrapped response
             jbod = json_body(obj if json_obj == None else json_obj)
-            return ("/**/typeof %s==='function' && %s(%s);" %
+            body = ("/**/typeof %s==='function' && %s(%s);" %
                     (callback_fn, callback_fn, jbod))
         elif is_json_type(rctype):
-            return json_body(obj if json_obj == None else json_obj)
+            body = json_body(obj if json_obj == None else json_obj)
         elif not obj == None:
             # if we're not returning JSON and obj is not None, return as lines
             buff = StringIO.StringIO()
@@ -112,7 +273,57 @@ class TASRApp(bottle.Bottle):
                 buff.write('%s\n' % obj)
             body = buff.getvalue()
             buff.close()
-            return body
+        return self.encode_body(body)
+
+    def stream_response(self, lines):
+        '''Returns a generator for an NDJSON body, yielding a line for each
+        JSON string from the passed iterable as it is produced.'''
+        bottle.response.content_type = NDJSON_TYPE
+        log_request(bottle.response.status_code)
+        return ('%s\n' % line for line in lines)
+
+    def list_headers_allowed(self, count):
+        '''Checks whether a list of count items is short enough to get a
+        header per item.  A negative max_list_headers removes the limit.'''
+        max_headers = self.config.max_list_headers
+        if max_headers is None:
+            max_headers = MAX_LIST_HEADERS
+        return max_headers < 0 or count <= max_headers
+
+    def query_int(self, name, default=None):
+        '''Returns a positive int query arg (or the default if it is not
+        passed), with a 400 for anything else.'''
+        val = bottle.request.query.get(name)
+        if val is None or val == '':
+            return default
+        try:
+            val = int(val)
+        except ValueError:
+            val = 0
+        if val < 1:
+            self.abort(400, 'Bad %s: %s' % (name, bottle.request.query[name]))
+        return val
+
+    def compression(self, body):
+        '''Returns the content coding to compress a body with, or None if the
+        body is too small to bother or the client does not accept one.  A
+        negative compress_min_bytes turns compression off.'''
+        min_bytes = self.config.compress_min_bytes
+        if min_bytes is None:
+            min_bytes = COMPRESS_MIN_BYTES
+        if body is None or min_bytes < 0 or len(body) < min_bytes:
+            return None
+        add_vary('Accept-Encoding')
+        return accepted_encoding()
+
+    def encode_body(self, body):
+        '''Compresses a response body, if the client accepts a coding and the
+        body is big enough, setting the Content-Encoding header.'''
+        coding = self.compression(body)
+        if coding:
+            body = compress_body(body, coding)
+            bottle.response.set_header('Content-Encoding', coding)
+        return body
 
     def subject_response(self, subject):
         '''Returns a subject dict in JSON if JSON is accepted.  Standard
@@ -148,17 +359,122 @@ class TASRApp(bottle.Bottle):
             return self.object_response(val, {key: val})
         return self.object_response(None, subject.as_dict())
 
-    def schema_response(self, reg_schema, subject_name=None):
+    def cache_headers(self, etag=None, immutable=False):
+        '''Returns the caching headers for a response as a dict.  Immutable
+        responses (a schema looked up by id or by subject and version) get a
+        long max-age, others (like the latest schema for a subject) a short
+        one.  The body depends on the Accept and Accept-Encoding headers, so
+        caches must key on them.
+        '''
+        if immutable:
+            max_age = self.config.immutable_max_age
+        else:
+            max_age = self.config.mutable_max_age
+        headers = {'Vary': 'Accept, Accept-Encoding'}
+        if max_age:
+            headers['Cache-Control'] = 'public, max-age=%s' % max_age
+        else:
+            headers['Cache-Control'] = 'no-cache'
+        if etag:
+            headers['ETag'] = etag
+        return headers
+
+    def abort_if_not_modified(self, sha256_id, immutable=False, found=False):
+        '''Raises a 304 (Not Modified) response if the request's If-None-Match
+        holds the ETag for the schema with the sha256 id.  A schema's body
+        never changes, so this can be called before the schema is retrieved
+        when the id is known up front.  Only a found schema matches "*", as
+        the id alone does not say whether the schema exists.'''
+        etag = None
+        if sha256_id:
+            etag = etag_matches(schema_etag(sha256_id), wildcard=found)
+        if etag:
+            log_request(304)
+            raise bottle.HTTPResponse(status=304,
+                                      headers=self.cache_headers(etag,
+                                                                 immutable))
+
+    def rendered_schema(self, reg_schema, rctype, legacy=False, coding=None):
+        '''Returns the rendered (body, static headers) for a schema response.
+        The body and the headers that only depend on the schema (the content
+        type, the ids and the ETag) never change for a schema, so they are
+        rendered once and cached, keyed by the sha256 id, the content type,
+        the pretty flag, whether the headers are the legacy ones and the
+        content coding (None for the plain body).  The version and timestamp
+        headers are not cached.'''
+        pretty = is_pretty()
+        key = (reg_schema.sha256_id, rctype, pretty, legacy, coding)
+        rendered = self.response_cache.get(key)
+        if rendered is None and coding:
+            (body, headers) = self.rendered_schema(reg_schema, rctype, legacy)
+            body = compress_body(body, coding)
+            headers = tuple((name, val) for (name, val) in headers
+                            if name != 'ETag')
+            headers += (('ETag', schema_etag(reg_schema.sha256_id, coding)),
+                        ('Content-Encoding', coding))
+            rendered = (body, headers)
+            self.response_cache.put(key, rendered, len(body))
+        elif rendered is None:
+            bot = tasr.headers.SchemaHeaderBot
+            if legacy:
+                id_names = (bot.LH_MD5, bot.LH_SHA256)
+            else:
+                id_names = (bot.H_MD5, bot.H_SHA256)
+            headers = (('Content-Type', rctype),
+                       (id_names[0], reg_schema.md5_id),
+                       (id_names[1], reg_schema.sha256_id),
+                       ('ETag', schema_etag(reg_schema.sha256_id)))
+            body = json_body(reg_schema.ordered)
+            rendered = (body, headers)
+            self.response_cache.put(key, rendered, len(body))
+        return rendered
+
+    def schema_response(self, reg_schema, subject_name=None,
+                        immutable=False, legacy=False):
         '''Return the schema JSON for a registered schema.  The body will
         _ALWAYS_ be JSON, even if the client does not specifically accept it.
-        Standard schema headers.
+        Standard (or legacy) schema headers, plus a strong ETag (from the
+        sha256 id) and Cache-Control for GETs.  If the request's If-None-Match
+        holds the ETag, a 304 is returned instead.  Apart from JSONP
+        responses, the body comes from the rendered response cache.
         '''
+        is_get = bottle.request.method in ('GET', 'HEAD')
+        if is_get:
+            self.abort_if_not_modified(reg_schema.sha256_id, immutable,
+                                       found=True)
         rctype = response_content_type(default_type='application/json')
-        bottle.response.content_type = rctype
         bot = tasr.headers.SchemaHeaderBot(bottle.response, reg_schema)
-        bot.standard_headers(subject_name=subject_name)
-        return self.object_response(reg_schema.canonical_schema_str,
-                                    reg_schema.ordered, rctype)
+        if get_jsonp_callback():
+            bottle.response.content_type = rctype
+            if legacy:
+                bot.legacy_headers(subject_name=subject_name)
+            else:
+                bot.standard_headers(subject_name=subject_name)
+            body = None
+        else:
+            (body, headers) = self.rendered_schema(reg_schema, rctype, legacy)
+            coding = self.compression(body)
+            if coding:
+                (body, headers) = self.rendered_schema(reg_schema, rctype,
+                                                       legacy, coding)
+            for (key, val) in headers:
+                bottle.response.set_header(key, val)
+            if legacy:
+                bot.leg_add_current_versions(reg_schema, subject_name)
+                bot.leg_add_current_timestamps(reg_schema, subject_name)
+            else:
+                bot.add_current_versions(reg_schema, subject_name)
+                bot.add_current_timestamps(reg_schema, subject_name)
+        if is_get:
+            etag = bottle.response.get_header('ETag')
+            for (key, val) in self.cache_headers(etag,
+                                                 immutable).iteritems():
+                bottle.response.set_header(key, val)
+        if body is None:
+            return self.object_response(reg_schema.canonical_schema_str,
+                                        reg_schema.ordered, rctype)
+        log_request(bottle.response.status_code)
+        return body
 
 
 def log_request(code=200):
@@ -177,6 +493,109 @@ def log_request(code=200):
                 code)
 
 
+def is_fixed_version(version):
+    '''Checks that a version (as passed in a URL) always names the same
+    schema.  Versions count from 1, and -1 means the latest, which changes.
+    '''
+    try:
+        return int(version) > 0
+    except (TypeError, ValueError):
+        return False
+
+
+def schema_etag(sha256_id, coding=None):
+    '''A strong ETag for a schema body, from the schema's sha256 id.  Each
+    content coding of the body is a different representation, so it gets a
+    different ETag.'''
+    if coding:
+        return '"%s-%s"' % (sha256_id, coding)
+    return '"%s"' % sha256_id
+
+
+def etag_matches(etag, wildcard=True):
+    '''Checks whether the request's If-None-Match header holds the ETag (or
+    is "*", if wildcard is set), returning the matching tag, or None.  Weak
+    comparison is used, as If-None-Match calls for, and the tags for the
+    compressed representations match the plain one.'''
+    header = bottle.request.get_header('If-None-Match')
+    if not header:
+        return None
+    for tag in header.split(','):
+        tag = tag.strip()
+        base = tag[2:] if tag.startswith('W/') else tag
+        for coding in ENCODINGS:
+            if base.endswith('-%s"' % coding):
+                base = '%s"' % base[:-len(coding) - 2]
+        if base == '*' and wildcard:
+            return etag
+        if base == etag:
+            return tag
+    return None
+
+
+def add_vary(name):
+    '''Adds a header name to the response's Vary header.'''
+    vary = bottle.response.get_header('Vary')
+    names = [val.strip() for val in vary.split(',')] if vary else []
+    if not name in names:
+        names.append(name)
+        bottle.response.set_header('Vary', ', '.join(names))
+
+
+def accepted_encoding():
+    '''Returns the content coding to compress a response with ('gzip' or
+    'deflate'), as negotiated with the request's Accept-Encoding header, or
+    None if neither is acceptable.'''
+    header = bottle.request.get_header('Accept-Encoding')
+    if not header:
+        return None
+    qvals = dict()
+    for item in header.split(','):
+        parts = item.split(';')
+        qval = 1.0
+        for param in parts[1:]:
+            (pname, _, pval) = param.partition('=')
+            if pname.strip().lower() == 'q':
+                try:
+                    qval = float(pval)
+                except ValueError:
+                    qval = 0.0
+        qvals[parts[0].strip().lower()] = qval
+    best = (None, 0.0)
+    for coding in ENCODINGS:
+        qval = qvals.get(coding, qvals.get('*', 0.0))
+        if qval > best[1]:
+            best = (coding, qval)
+    return best[0]
+
+
+def compress_body(body, coding):
+    '''Compresses a body with a content coding.  The gzip header gets a zero
+    mtime, so the same body always compresses to the same bytes.'''
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    if coding == 'gzip':
+        buff = StringIO.StringIO()
+        gz_file = gzip.GzipFile(fileobj=buff, mode='wb', mtime=0)
+        gz_file.write(body)
+        gz_file.close()
+        body = buff.getvalue()
+        buff.close()
+        return body
+    return zlib.compress(body)
+
+
+def is_ndjson():
+    '''Checks for a stream query arg or an Accept header asking for NDJSON.'''
+    for qk in bottle.request.query.dict.keys():
+        if qk.strip().lower() == 'stream':
+            return True
+    for a_type in str(bottle.request.get_header('Accept')).split(','):
+        if a_type.split(';')[0].strip().lower() == NDJSON_TYPE:
+            return True
+    return False
+
+
 def is_pretty():
     for qk in bottle.request.query.dict.keys():
         if qk.strip().lower() == 'pretty':
@@ -0,0 +1,159 @@
+'''
+In-process caches used by TASR.  Registered schema content never changes once
+written (the keys are digests of the canonical schema string), so a lot of the
+repeated work of serving schemas -- Redis round-trips, JSON parsing, Avro
+parsing -- can be done once per process and then reused.  Under mod_wsgi a
+process serves many threads, so the caches here are all thread-safe.
+'''
+import collections
+import sys
+import threading
+import time
+import types
+
+# shared by everything, so never counted as part of an entry
+SHARED_TYPES = (type, types.ClassType, types.ModuleType, types.FunctionType,
+                types.BuiltinFunctionType, types.MethodType)
+
+
+def deep_size(obj):
+    '''Estimates the memory (in bytes) held by an object and everything it
+    refers to, through containers, instance dicts and slots.  Each object is
+    counted once.  Classes, modules and functions are shared, so they are
+    not counted.  This walks the whole object graph, so it suits entries that
+    are sized once, when they are put.'''
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        cur = stack.pop()
+        if id(cur) in seen or cur is None or isinstance(cur, SHARED_TYPES):
+            continue
+        seen.add(id(cur))
+        size += sys.getsizeof(cur)
+        if isinstance(cur, basestring):
+            continue
+        if isinstance(cur, dict):
+            stack.extend(cur.iterkeys())
+            stack.extend(cur.itervalues())
+        elif isinstance(cur, (list, tuple, set, frozenset)):
+            stack.extend(cur)
+        if hasattr(cur, '__dict__'):
+            stack.append(cur.__dict__)
+        for cls in type(cur).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                stack.append(getattr(cur, name, None))
+    return size
+
+
+class LRUCache(object):
+    '''A bounded, thread-safe, least-recently-used cache.  The cache can be
+    limited by the number of entries, the total size of the entries, or both.
+    Entry sizes are whatever the caller says they are when the entry is put
+    (usually a byte count), so the size limit is only as accurate as that.
+
+    A max_entries value of 0 (or less) disables the cache entirely; gets will
+    always miss and puts are ignored.  A max_bytes value of None means there
+    is no size limit.  If a ttl (in seconds) is set, entries older than that
+    are treated as missing, which bounds how stale a cached value can get.
+    '''
+    def __init__(self, max_entries=1000, max_bytes=None, ttl=None):
+        self.max_entries = max_entries if max_entries else 0
+        self.max_bytes = max_bytes
+        self.ttl = ttl if ttl else None
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        '''The cache is enabled if it can hold at least one entry.'''
+        return self.max_entries > 0
+
+    def get(self, key, default=None):
+        '''Returns the value for the key (marking it as recently used) or the
+        default if the key is not in the cache.'''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[2] and entry[2] < time.time():
+                # expired, so drop it and treat it as a miss
+                self.total_bytes -= entry[1]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            # re-insert to move the entry to the most recently used end
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, val, size=0):
+        '''Adds or replaces the value for the key, then evicts the least
+        recently used entries until the cache is back within its limits.  A
+        value too large to ever fit is not added.'''
+        if not self.enabled:
+            return
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self.total_bytes -= old_entry[1]
+            expires = (time.time() + self.ttl) if self.ttl else None
+            self._entries[key] = (val, size, expires)
+            self.total_bytes += size
+            while (len(self._entries) > self.max_entries or
+                   (self.max_bytes is not None and
+                    self.total_bytes > self.max_bytes)):
+                (_, old_entry) = self._entries.popitem(last=False)
+                self.total_bytes -= old_entry[1]
+
+    def pop(self, key, default=None):
+        '''Removes the entry for the key, returning its value (or default).'''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self.total_bytes -= entry[1]
+            return entry[0]
+
+    def pop_if(self, predicate):
+        '''Removes every entry whose value satisfies the predicate.  This
+        walks the whole cache, so it is meant for infrequent invalidations.
+        Returns the number of entries removed.'''
+        with self._lock:
+            keys = [key for (key, entry) in self._entries.iteritems()
+                    if predicate(entry[0])]
+            for key in keys:
+                self.total_bytes -= self._entries.pop(key)[1]
+            return len(keys)
+
+    def clear(self):
+        '''Removes all the entries (the hit and miss counts are kept).'''
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        '''Returns a dict of the cache counters and current usage.'''
+        with self._lock:
+            lookups = self.hits + self.misses
+            hit_rate = (float(self.hits) / lookups) if lookups else 0.0
+            return {'entries': len(self._entries),
+                    'max_entries': self.max_entries,
+                    'bytes': self.total_bytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'ttl': self.ttl,
+                    'hit_rate': hit_rate}
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -10,6 +10,7 @@ example).  The older TASR API remains available through the client_legacy
 module.
 '''
 
+import json
 import requests
 import tasr.app
 import webtest
@@ -194,12 +195,15 @@ def get_active_subject_names(host=TASR_HOST, port=TASR_PORT, timeout=TIMEOUT):
         raise TASRError('Failed to get active subjects (status code: %s)' %
                         resp.status_code)
     subject_metas = SubjectHeaderBot.extract_metadata(resp)
-    # check that subject_metas.keys() matches the body list
+    # check that subject_metas.keys() matches the body list (long lists have
+    # no name headers to check)
     buff = StringIO.StringIO(resp.content)
     name_list = []
     for line in buff:
         name_list.append(line.strip())
     buff.close()
+    if not subject_metas:
+        return name_list
     if len(subject_metas.keys()) != len(name_list):
         raise TASRError('Header-body mismatch for subject name lists.')
     if sorted(subject_metas.keys()) != sorted(name_list):
@@ -221,12 +225,15 @@ def get_all_subject_names(host=TASR_HOST, port=TASR_PORT, timeout=TIMEOUT):
         raise TASRError('Failed to get all subjects (status code: %s)' %
                         resp.status_code)
     subject_metas = SubjectHeaderBot.extract_metadata(resp)
-    # check that subject_metas.keys() matches the body list
+    # check that subject_metas.keys() matches the body list (long lists have
+    # no name headers to check)
     buff = StringIO.StringIO(resp.content)
     name_list = []
     for line in buff:
         name_list.append(line.strip())
     buff.close()
+    if not subject_metas:
+        return name_list
     if len(subject_metas.keys()) != len(name_list):
         raise TASRError('Header-body mismatch for subject name lists.')
     if sorted(subject_metas.keys()) != sorted(name_list):
@@ -248,12 +255,15 @@ def get_all_subject_schema_ids(subject_name, host=TASR_HOST,
         raise TASRError('Failed to get all subject IDs (status code: %s)' %
                         resp.status_code)
     meta = SubjectHeaderBot.extract_metadata(resp)[subject_name]
-    # check that the sha256_list matches the body list
+    # check that the sha256_list matches the body list (long lists have no ID
+    # headers to check)
     buff = StringIO.StringIO(resp.content)
     sha256_ids = []
     for line in buff:
         sha256_ids.append(line.strip())
     buff.close()
+    if meta.sha256_id_list is None:
+        return sha256_ids
     if len(meta.sha256_id_list) != len(sha256_ids):
         raise TASRError('Header-body mismatch for sha256_id lists.')
     if meta.sha256_id_list != sha256_ids:
@@ -284,7 +294,8 @@ def get_all_subject_schemas(subject_name,
         ras = RegisteredAvroSchema()
         ras.schema_str = schema_str.strip()
         ras.gv_dict[subject_name] = version
-        if ras.sha256_id != meta.sha256_id_list[version - 1]:
+        if (meta.sha256_id_list and
+                ras.sha256_id != meta.sha256_id_list[version - 1]):
             raise TASRError('Generated SHA256 ID did not match passed ID.')
         schemas.append(ras)
         version += 1
@@ -369,6 +380,79 @@ def lookup_latest(subject_name,
     return reg_schema_from_url(url, timeout=timeout,
                                err_404='No such version.')
 
+
+def resolve_schemas(refs, host=TASR_HOST, port=TASR_PORT, timeout=TIMEOUT):
+    ''' POST /tasr/schemas/resolve
+    Resolves a list of schema references in one request.  A reference is
+    either a multi-type ID string or a (subject name, version) pair, with -1
+    as the version for the latest one.  Returns a list holding a
+    RegisteredAvroSchema (or None, if nothing matched) for each reference, in
+    order.
+    '''
+    items = []
+    for ref in refs:
+        if isinstance(ref, basestring):
+            items.append(ref)
+        else:
+            (subject_name, version) = ref
+            items.append({'subject': subject_name, 'version': version})
+    url = 'http://%s:%s/tasr/schemas/resolve' % (host, port)
+    headers = {'Content-Type': 'application/json',
+               'Accept': 'application/json'}
+    resp = requests.post(url, data=json.dumps(items), headers=headers,
+                         timeout=timeout)
+    if resp == None:
+        raise TASRError('Timeout for resolve schemas request.')
+    if resp.status_code != 200:
+        raise TASRError('Failed to resolve schemas (status code: %s)' %
+                        resp.status_code)
+    schemas = []
+    for result in json.loads(resp.content)['results']:
+        if result['error']:
+            raise TASRError('Bad schema reference %s: %s' %
+                            (result['ref'], result['error']))
+        if not result['found']:
+            schemas.append(None)
+            continue
+        ras = RegisteredAvroSchema()
+        ras.update_from_dict(result)
+        if ras.sha256_id != result['sha256_id'][3:]:
+            raise TASRError('Schema was modified in transit.')
+        schemas.append(ras)
+    return schemas
+
+
+def lookup_latest_many(subject_names,
+                       host=TASR_HOST, port=TASR_PORT, timeout=TIMEOUT):
+    ''' POST /tasr/subjects/latest
+    Get the most recent RegisteredAvroSchema for each of a list of subject
+    names, in one request.  Returns a dict mapping each subject name to its
+    latest schema, or to None if the subject has no registered schema.
+    '''
+    url = 'http://%s:%s/tasr/subjects/latest' % (host, port)
+    headers = {'Content-Type': 'application/json',
+               'Accept': 'application/json'}
+    resp = requests.post(url, data=json.dumps(list(subject_names)),
+                         headers=headers, timeout=timeout)
+    if resp == None:
+        raise TASRError('Timeout for lookup latest many request.')
+    if resp.status_code != 200:
+        raise TASRError('Failed to get latest schemas (status code: %s)' %
+                        resp.status_code)
+    schemas = dict()
+    for (subject_name, s_dict) in json.loads(resp.content).iteritems():
+        if not s_dict:
+            schemas[subject_name] = None
+            continue
+        ras = RegisteredAvroSchema()
+        ras.schema_str = s_dict['schema']
+        if ras.sha256_id != s_dict['current_schema_sha256_id']:
+            raise TASRError('Schema was modified in transit.')
+        ras.gv_dict[subject_name] = s_dict['current_schema_version']
+        ras.ts_dict[subject_name] = s_dict['current_schema_timestamp']
+        schemas[subject_name] = ras
+    return schemas
+
 #############################################################################
 # Wrapped in a class
 #############################################################################
@@ -456,3 +540,14 @@ class TASRClientSV(object):
     def lookup_latest(self, subject_name):
         '''Get the latest registered schema for the subject.'''
         return lookup_latest(subject_name, self.host, self.port, self.timeout)
+
+    def lookup_latest_many(self, subject_names):
+        '''Get the latest registered schemas for many subjects, as a dict, in
+        one request.'''
+        return lookup_latest_many(subject_names,
+                                  self.host, self.port, self.timeout)
+
+    def resolve_schemas(self, refs):
+        '''Get the registered schemas (or None) for a list of multi-type ID
+        strings and (subject name, version) pairs, in one request.'''
+        return resolve_schemas(refs, self.host, self.port, self.timeout)
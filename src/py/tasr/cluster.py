@@ -0,0 +1,453 @@
+'''
+A Redis Cluster compatible layout for the schema repository.  The standard
+layout (see RedisSchemaRepository) assumes a single Redis node, as its LUA
+scripts touch the group keys, the schema hashes and the group index in one
+call.  In a cluster every key a script touches must hash to the same slot, so
+the cluster layout changes two things:
+
+  - The group keys use a hash tag, so all the keys for one group land in the
+    same slot: 'g.{<group>}', 'vid.{<group>}', 'vts.{<group>}',
+    'topic.{<group>}', 'validators.{<group>}', 'master.{<group>}' and
+    'compat.{<group>}'.  The 'id.<sha256_id>' and 'id.<md5_id>' hashes and
+    the 'groups' index keep their names (and so are spread across the
+    cluster).  The hash fields are unchanged, so a schema hash still has
+    'vid.<group>' and 'vts.<group>' fields.
+
+  - Every LUA script only touches keys in one slot.  Work that spans slots,
+    like getting a group's latest schema hash, is done client-side instead:
+    a slot-local call for the group keys, then a (pipelined) call for the
+    schema hashes.  That costs a round-trip or two more than the standard
+    layout, in exchange for memory and throughput that scale with the nodes.
+
+Registration is no longer one atomic call.  The steps are ordered so a failure
+part way through never leaves a version pointing at a missing schema hash:
+the schema hash is added first, then the md5 index, then the version is
+appended to the group lists (atomically, in the group's slot) and finally the
+version fields in the schema hash are set.  A retried registration repairs
+missing version fields.
+
+The cluster client comes from the optional redis-py-cluster package.  A single
+Redis node can hold the cluster layout too (that is how the tests run), so a
+plain StrictRedis client can be passed instead.  Use
+migrate_to_cluster_layout() (or the tasr.admin tool) to rename the keys of an
+existing single node repository before moving its data into a cluster.
+'''
+from tasr import RedisSchemaRepository, GROUP_INDEX_KEY, INVALIDATION_CHANNEL
+from tasr import INVALIDATE_ALL
+from tasr.registered_schema import RegisteredAvroSchema, MD5_BYTES
+from tasr.registered_schema import SHA256_BYTES
+
+try:
+    import rediscluster
+except ImportError:
+    rediscluster = None
+
+GROUP_KEY_PREFIXES = ['g.', 'vid.', 'vts.', 'topic.', 'validators.',
+                      'master.', 'compat.']
+
+
+def dict_2_pair_seq(hash_d):
+    '''Turns a dict (as returned by HGETALL in redis-py) back into the
+    "[<name0>,<value0>,<name1>, ...]" pair list returned by the LUA scripts.
+    '''
+    pairs = []
+    for (key, val) in hash_d.iteritems():
+        pairs.append(key)
+        pairs.append(val)
+    return pairs
+
+
+class ClusterSchemaRepository(RedisSchemaRepository):
+    '''The Redis Cluster compatible version of the schema repository.  See
+    the module docs for how the layout differs from the standard one.  The
+    startup_nodes are a list of {'host': <host>, 'port': <port>} dicts.
+    '''
+    def __init__(self, startup_nodes=None,
+                 schema_cache_entries=None, schema_cache_bytes=None,
+                 group_cache_entries=None, group_cache_ttl=None,
+                 max_connections=None, socket_timeout=None,
+                 socket_connect_timeout=None, socket_keepalive=None,
+                 redis_client=None, replica_pools=None, read_your_writes=0,
+                 compat_cache_entries=None, compat_cache_redis=False):
+        if not redis_client:
+            if rediscluster is None:
+                raise Exception(u'The cluster layout needs the '
+                                'redis-py-cluster package.')
+            redis_client = rediscluster.RedisCluster(
+                startup_nodes=startup_nodes,
+                max_connections=max_connections,
+                socket_timeout=socket_timeout,
+                socket_connect_timeout=socket_connect_timeout,
+                socket_keepalive=socket_keepalive)
+        super(ClusterSchemaRepository, self).__init__(
+            schema_cache_entries=schema_cache_entries,
+            schema_cache_bytes=schema_cache_bytes,
+            group_cache_entries=group_cache_entries,
+            group_cache_ttl=group_cache_ttl,
+            replica_pools=replica_pools,
+            read_your_writes=read_your_writes,
+            redis_client=redis_client,
+            compat_cache_entries=compat_cache_entries,
+            compat_cache_redis=compat_cache_redis)
+        self.lua_add_schema = None
+        self.lua_append_version = None
+        self.lua_set_version = None
+        self.lua_delete_group_keys = None
+        self.lua_remove_group_fields = None
+        self.reg_lua_add_schema()
+        self.reg_lua_append_version()
+        self.reg_lua_set_version()
+        self.reg_lua_delete_group_keys()
+        self.reg_lua_remove_group_fields()
+
+    ##########################################################################
+    # slot-local LUA script registrations
+    ##########################################################################
+    def reg_lua_add_schema(self):
+        '''Registers a LUA script that adds a schema hash (KEYS[1]) if it is
+        new.  The ARGV values are the md5 key value and the canonical schema
+        string, then the 'vid.<group>' field name.  The return is a created
+        flag and a flag for whether the hash already has the version field.
+        '''
+        lua = '''
+        local created = 0
+        if redis.call('exists', KEYS[1]) == 0 then
+            redis.call('hmset', KEYS[1], 'sha256_id', KEYS[1],
+                       'md5_id', ARGV[1], 'schema', ARGV[2])
+            created = 1
+        end
+        return {created, redis.call('hexists', KEYS[1], ARGV[3])}
+        '''
+        self.lua_add_schema = self.redis.register_script(lua)
+
+    def reg_lua_append_version(self):
+        '''Registers a LUA script that appends a version to a group's lists,
+        unless the schema is already the latest version.  The KEYS are the
+        group, vid, vts and topic keys (all in the group's slot).  The ARGV
+        values are the timestamp and the sha256 id key.  The return is an
+        added flag, the version and a vid/topic mismatch flag.
+        '''
+        lua = '''
+        if not redis.call('hget', KEYS[1], 'group_ts') then
+            redis.call('hset', KEYS[1], 'group_ts', ARGV[1])
+        end
+        if redis.call('lindex', KEYS[2], -1) == ARGV[2] then
+            return {0, redis.call('llen', KEYS[2]), 0}
+        end
+        local ver = redis.call('rpush', KEYS[2], ARGV[2])
+        local topic_ver = redis.call('rpush', KEYS[4], ARGV[2])
+        redis.call('rpush', KEYS[3], ARGV[1])
+        if ver ~= topic_ver then
+            return {1, ver, 1}
+        end
+        return {1, ver, 0}
+        '''
+        self.lua_append_version = self.redis.register_script(lua)
+
+    def reg_lua_set_version(self):
+        '''Registers a LUA script that sets the version fields of a schema
+        hash (KEYS[1]) if ARGV[5] is '1'.  ARGV[1] to ARGV[4] are the vid
+        field, the version, the vts field and the timestamp.  The return is
+        the HGETALL-style pairs for the schema hash.
+        '''
+        lua = '''
+        if ARGV[5] == '1' then
+            redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+            redis.call('hset', KEYS[1], ARGV[3], ARGV[4])
+        end
+        return redis.call('hgetall', KEYS[1])
+        '''
+        self.lua_set_version = self.redis.register_script(lua)
+
+    def reg_lua_delete_group_keys(self):
+        '''Registers a LUA script that deletes a group's keys (the group, vid,
+        vts, topic, validators, master and compat keys, all in the group's
+        slot) and returns the sha256 id keys that were in the vid list.
+        '''
+        lua = '''
+        local id_list = redis.call('lrange', KEYS[2], 0, -1)
+        redis.call('del', unpack(KEYS))
+        return id_list
+        '''
+        self.lua_delete_group_keys = self.redis.register_script(lua)
+
+    def reg_lua_remove_group_fields(self):
+        '''Registers a LUA script that removes a group's version fields
+        (ARGV[1] and ARGV[2]) from a schema hash (KEYS[1]).  If ARGV[3] is '1'
+        and no other group has the schema, the whole hash is deleted and the
+        md5 id key is returned (so the caller can delete it).
+        '''
+        lua = '''
+        if redis.call('hexists', KEYS[1], ARGV[1]) == 0 then
+            return nil
+        end
+        local vid_fields = 0
+        for _,field in ipairs(redis.call('hkeys', KEYS[1])) do
+            if string.sub(field, 1, 4) == 'vid.' then
+                vid_fields = vid_fields + 1
+            end
+        end
+        if vid_fields == 1 and ARGV[3] == '1' then
+            local md5_key = redis.call('hget', KEYS[1], 'md5_id')
+            redis.call('del', KEYS[1])
+            return md5_key
+        end
+        redis.call('hdel', KEYS[1], ARGV[1], ARGV[2])
+        return nil
+        '''
+        self.lua_remove_group_fields = self.redis.register_script(lua)
+
+    ##########################################################################
+    # key layout methods
+    ##########################################################################
+    def get_group_key(self, group_name):
+        '''The group hash key, hash tagged with the group name.'''
+        super(ClusterSchemaRepository, self).get_group_key(group_name)
+        return u'g.{%s}' % group_name
+
+    def vid_key(self, group_name):
+        return u'vid.{%s}' % group_name
+
+    def vts_key(self, group_name):
+        return u'vts.{%s}' % group_name
+
+    def topic_key(self, group_name):
+        return u'topic.{%s}' % group_name
+
+    def validators_key(self, group_name):
+        return u'validators.{%s}' % group_name
+
+    def master_key(self, group_name):
+        return u'master.{%s}' % group_name
+
+    def compat_key(self, group_name):
+        return u'compat.{%s}' % group_name
+
+    def fetch_group_vals(self, group_names=None, active_only=False,
+                         client=None):
+        '''Gets the group hashes and latest ids with one pipelined call (which
+        the cluster client fans out to the nodes), then the latest schema
+        hashes with a second.'''
+        client = client or self.reader()
+        if group_names is None:
+            group_names = list(client.smembers(GROUP_INDEX_KEY))
+        pipe = client.pipeline(transaction=False)
+        for group_name in group_names:
+            pipe.hgetall(u'g.{%s}' % group_name)
+            pipe.lindex(self.vid_key(group_name), -1)
+        group_rvals = pipe.execute()
+        sha256_keys = [key for key in group_rvals[1::2] if key]
+        pipe = client.pipeline(transaction=False)
+        for sha256_key in sha256_keys:
+            pipe.hgetall(sha256_key)
+        schema_hashes = dict(zip(sha256_keys, pipe.execute()))
+        rvals = []
+        for (idx, group_name) in enumerate(group_names):
+            (group_d, sha256_key) = group_rvals[idx * 2:idx * 2 + 2]
+            if not group_d:
+                continue
+            if sha256_key:
+                rvals.append([group_name, dict_2_pair_seq(group_d),
+                              dict_2_pair_seq(schema_hashes[sha256_key])])
+            elif not active_only:
+                rvals.append([group_name, dict_2_pair_seq(group_d), []])
+        return rvals
+
+    def fetch_version_vals(self, group_name, index, meta_only):
+        '''Gets the id key from the group's slot, then the schema hash.'''
+        client = self.reader()
+        sha256_key = client.lindex(self.vid_key(group_name), index)
+        if not sha256_key:
+            return None
+        return self.lua_get_for_id(keys=[sha256_key, ], args=[meta_only, ],
+                                   client=client)
+
+    def fetch_id_vals(self, id_key, meta_only):
+        '''An md5 id key is resolved to the sha256 id key first, as the two
+        hashes are (usually) in different slots.'''
+        client = self.reader()
+        if len(id_key) == 27:
+            id_key = client.hget(id_key, 'sha256_id')
+            if not id_key:
+                return None
+        return self.lua_get_for_id(keys=[id_key, ], args=[meta_only, ],
+                                   client=client)
+
+    def fetch_ref_vals(self, lookups):
+        '''Resolves the version indexes and md5 id keys to sha256 id keys with
+        one pipelined call, then gets the schema hashes with a second.  The
+        whole hash is fetched, as the meta_only flag needs a LUA call.'''
+        client = self.reader()
+        pipe = client.pipeline(transaction=False)
+        for (key, index, _, id_type) in lookups:
+            if index is not None:
+                pipe.lindex(key, index)
+            elif id_type == MD5_BYTES:
+                pipe.hget(key, 'sha256_id')
+        resolved = iter(pipe.execute())
+        sha256_keys = [key if id_type == SHA256_BYTES else next(resolved)
+                       for (key, _, _, id_type) in lookups]
+        pipe = client.pipeline(transaction=False)
+        for sha256_key in sha256_keys:
+            if sha256_key:
+                pipe.hgetall(sha256_key)
+        hashes = iter(pipe.execute())
+        return [dict_2_pair_seq(next(hashes)) if sha256_key else None
+                for sha256_key in sha256_keys]
+
+    def fetch_version_range_vals(self, group_name, start, stop):
+        '''Gets the id keys from the group's slot, then pipelines the
+        retrieval of each distinct schema hash.'''
+        client = self.reader()
+        sha256_keys = client.lrange(self.vid_key(group_name), start, stop)
+        distinct_keys = []
+        for sha256_key in sha256_keys:
+            if not sha256_key in distinct_keys:
+                distinct_keys.append(sha256_key)
+        pipe = client.pipeline(transaction=False)
+        for sha256_key in distinct_keys:
+            pipe.hgetall(sha256_key)
+        hashes = [dict_2_pair_seq(hash_d) for hash_d in pipe.execute()]
+        return (sha256_keys, hashes)
+
+    def init_group_keys(self, group_name, timestamp):
+        group_key = self.get_group_key(group_name)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hsetnx(group_key, 'group_ts', timestamp)
+        pipe.sadd(GROUP_INDEX_KEY, group_name)
+        pipe.execute()
+        return True
+
+    def register_schema_vals(self, group_name, new_rs, timestamp):
+        '''Registers the schema in four slot-local steps.  See the module
+        docs for why they are in this order.'''
+        sha256_key = u'id.%s' % new_rs.sha256_id
+        md5_key = u'id.%s' % new_rs.md5_id
+        vid_field = u'vid.%s' % group_name
+        vts_field = u'vts.%s' % group_name
+        (created, has_version) = self.lua_add_schema(
+            keys=[sha256_key, ],
+            args=[md5_key, new_rs.canonical_schema_str, vid_field, ])
+        if created:
+            self.redis.hset(md5_key, 'sha256_id', sha256_key)
+        (added, version, mismatch) = self.lua_append_version(
+            keys=[self.get_group_key(group_name), self.vid_key(group_name),
+                  self.vts_key(group_name), self.topic_key(group_name), ],
+            args=[timestamp, sha256_key, ])
+        self.redis.sadd(GROUP_INDEX_KEY, group_name)
+        # set the fields for a new version, or repair them if they're missing
+        update = '1' if added or not has_version else '0'
+        hash_vals = self.lua_set_version(
+            keys=[sha256_key, ],
+            args=[vid_field, version, vts_field, timestamp, update, ])
+        if added:
+            self.redis.publish(INVALIDATION_CHANNEL,
+                               u'%s %s' % (group_name, sha256_key))
+        return [1 if created or added else 0, mismatch] + hash_vals
+
+    ##########################################################################
+    # methods needing more than slot-local hooks
+    ##########################################################################
+    def get_schema_dict_for_md5_id(self, md5_base64_id):
+        sha256_key = self.reader().hget(u'id.%s' % md5_base64_id, 'sha256_id')
+        if not sha256_key:
+            return None
+        return self.get_schema_dict_for_sha256_id(sha256_key[3:])
+
+    def get_cur_versions(self):
+        client = self.reader()
+        group_names = list(client.smembers(GROUP_INDEX_KEY))
+        pipe = client.pipeline(transaction=False)
+        for group_name in group_names:
+            pipe.llen(self.vid_key(group_name))
+        rdict = dict()
+        for (group_name, vlen) in zip(group_names, pipe.execute()):
+            if vlen > 0:
+                rdict[self.vid_key(group_name)] = vlen
+        return rdict
+
+    def delete_group(self, group_name, remove_orphans=True):
+        '''Deletes a group as RedisSchemaRepository.delete_group() does.  The
+        group keys are deleted in one slot-local call, then each schema hash
+        is cleaned up with a slot-local call of its own.
+        '''
+        group_keys = [u'%s{%s}' % (prefix, group_name)
+                      for prefix in GROUP_KEY_PREFIXES]
+        if not self.redis.exists(group_keys[0]):
+            raise ValueError("%s not registered." % group_name)
+        id_list = self.lua_delete_group_keys(keys=group_keys)
+        self.redis.srem(GROUP_INDEX_KEY, group_name)
+        vid_field = u'vid.%s' % group_name
+        vts_field = u'vts.%s' % group_name
+        for sha256_key in set(id_list):
+            md5_key = self.lua_remove_group_fields(
+                keys=[sha256_key, ],
+                args=[vid_field, vts_field, '1' if remove_orphans else '0'])
+            if md5_key:
+                self.redis.delete(md5_key)
+        self.publish_invalidation(INVALIDATE_ALL)
+
+    def rebuild_group_index(self, batch_size=1000):
+        '''Builds (or repairs) the 'groups' index from the 'g.{*}' keys.  The
+        index and a group hash are in different slots, so a stale entry can
+        not be checked and removed atomically.  Instead, it is removed, then
+        put back if the group hash exists by then, so a group registered at
+        the same time is never left out of the index.'''
+        scanned = []
+        for group_key in self.redis.scan_iter('g.{*', count=batch_size):
+            scanned.append(group_key[3:-1])
+            if len(scanned) == batch_size:
+                self.redis.sadd(GROUP_INDEX_KEY, *scanned)
+                scanned = []
+        if scanned:
+            self.redis.sadd(GROUP_INDEX_KEY, *scanned)
+        for group_name in self.redis.smembers(GROUP_INDEX_KEY):
+            group_key = u'g.{%s}' % group_name
+            if not self.redis.exists(group_key):
+                self.redis.srem(GROUP_INDEX_KEY, group_name)
+                if self.redis.exists(group_key):
+                    self.redis.sadd(GROUP_INDEX_KEY, group_name)
+        return self.redis.scard(GROUP_INDEX_KEY)
+
+
+class ClusterAvroSchemaRepository(ClusterSchemaRepository):
+    '''This is an Avro-specific cluster layout schema repository class.
+    '''
+    def instantiate_registered_schema(self):
+        '''Returns a RegisteredAvroSchema object, overriding the parent.
+        '''
+        return RegisteredAvroSchema()
+
+
+def migrate_to_cluster_layout(redis_client, batch_size=1000):
+    '''Renames the group keys of a standard layout repository to the cluster
+    layout (e.g. -- 'vid.<group>' becomes 'vid.{<group>}').  This runs
+    against the single Redis node holding the repository, before the data
+    is moved into a cluster.  The renames for each group are done in one LUA
+    call, and groups already migrated are skipped, so it is safe to rerun.
+    Stop the TASR processes (or switch them to the cluster layout) first, as
+    they can only use one layout at a time.  Returns the number of groups
+    migrated.
+    '''
+    lua = '''
+    local half = #KEYS / 2
+    for idx = 1, half do
+        if redis.call('exists', KEYS[idx]) == 1 then
+            redis.call('renamenx', KEYS[idx], KEYS[idx + half])
+        end
+    end
+    redis.call('sadd', ARGV[1], ARGV[2])
+    return half
+    '''
+    migrate = redis_client.register_script(lua)
+    group_names = []
+    for group_key in redis_client.scan_iter('g.*', count=batch_size):
+        if not group_key.startswith('g.{'):
+            group_names.append(group_key[2:])
+    for group_name in group_names:
+        old_keys = [u'%s%s' % (prefix, group_name)
+                    for prefix in GROUP_KEY_PREFIXES]
+        new_keys = [u'%s{%s}' % (prefix, group_name)
+                    for prefix in GROUP_KEY_PREFIXES]
+        migrate(keys=old_keys + new_keys, args=[GROUP_INDEX_KEY, group_name])
+    return len(group_names)
@@ -0,0 +1,478 @@
+'''
+An embedded schema repository backend, keeping everything in a local sqlite
+database file instead of Redis.  It implements the same SchemaRepository
+interface, so the apps can use it in place of the Redis-based repository.
+
+This is meant for two things.  First, read-only edge nodes: copy (or sync) the
+database file to the node and every lookup is a local file read with no
+network hops.  Second, tests and benchmarks that need a repository but not a
+Redis instance.
+
+The database is opened in WAL mode, so readers never block the (single)
+writer, and many processes can read the same file at once.  Each thread gets
+its own connection.  The tables mirror the Redis structures:
+
+  'schemas':         sha256_id, md5_id and the canonical schema string
+  'groups':          the group names
+  'group_metadata':  the group hash fields (including 'group_ts')
+  'versions':        group, version, sha256_id and timestamp for each version
+  'validators':      the validator names for each group (see tasr.validators)
+  'master_state':    the master schema state for each group
+
+The ids are stored as the base64 strings, without the 'id.' key prefix.
+'''
+import base64
+import contextlib
+import io
+import sqlite3
+import struct
+import threading
+import time
+from tasr import SchemaRepository, SCHEMA_CACHE_ENTRIES, SCHEMA_CACHE_BYTES
+from tasr import COMPAT_CACHE_ENTRIES
+from tasr.group import Group, InvalidGroupException
+from tasr.registered_schema import RegisteredAvroSchema, MD5_BYTES
+from tasr.registered_schema import SHA256_BYTES
+
+BUSY_TIMEOUT_SECS = 10
+DDL = ['''CREATE TABLE IF NOT EXISTS schemas (
+            sha256_id TEXT PRIMARY KEY,
+            md5_id TEXT NOT NULL UNIQUE,
+            schema TEXT NOT NULL)''',
+       '''CREATE TABLE IF NOT EXISTS groups (
+            name TEXT PRIMARY KEY)''',
+       '''CREATE TABLE IF NOT EXISTS group_metadata (
+            group_name TEXT NOT NULL,
+            field TEXT NOT NULL,
+            val TEXT,
+            PRIMARY KEY (group_name, field))''',
+       '''CREATE TABLE IF NOT EXISTS versions (
+            group_name TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            sha256_id TEXT NOT NULL,
+            ts INTEGER NOT NULL,
+            PRIMARY KEY (group_name, version))''',
+       '''CREATE INDEX IF NOT EXISTS versions_by_id
+            ON versions (sha256_id, group_name)''',
+       '''CREATE TABLE IF NOT EXISTS validators (
+            group_name TEXT NOT NULL,
+            validator TEXT NOT NULL,
+            PRIMARY KEY (group_name, validator))''',
+       '''CREATE TABLE IF NOT EXISTS master_state (
+            group_name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            state TEXT NOT NULL)''']
+
+
+class SqliteSchemaRepository(SchemaRepository):
+    '''The sqlite-based implementation of the schema repository.  If
+    read_only is True, the tables are not created and any attempt to write
+    raises a sqlite3.OperationalError.
+    '''
+    def __init__(self, path, read_only=False,
+                 schema_cache_entries=SCHEMA_CACHE_ENTRIES,
+                 schema_cache_bytes=SCHEMA_CACHE_BYTES,
+                 compat_cache_entries=COMPAT_CACHE_ENTRIES):
+        super(SqliteSchemaRepository, self).__init__(schema_cache_entries,
+                                                     schema_cache_bytes,
+                                                     compat_cache_entries)
+        self.path = path
+        self.read_only = read_only
+        self.local = threading.local()
+        if not read_only:
+            with self.transaction() as conn:
+                for statement in DDL:
+                    conn.execute(statement)
+
+    ##########################################################################
+    # util methods
+    ##########################################################################
+    def after_fork(self):
+        '''A sqlite connection must not be used across a fork, so the
+        parent's connections are dropped and the worker opens its own.'''
+        super(SqliteSchemaRepository, self).after_fork()
+        self.local = threading.local()
+
+    def connection(self):
+        '''Returns this thread's connection, opening it if needed.'''
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # autocommit mode, as we manage the transactions ourselves
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_SECS,
+                                   isolation_level=None)
+            conn.text_factory = str
+            if self.read_only:
+                conn.execute('PRAGMA query_only = ON')
+            else:
+                conn.execute('PRAGMA journal_mode = WAL')
+                conn.execute('PRAGMA synchronous = NORMAL')
+            self.local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self, mode='IMMEDIATE'):
+        '''Runs the body in a transaction.  Writes should use the default
+        IMMEDIATE mode, which takes the write lock up front, so a read then
+        write sequence cannot be interleaved with another writer.  Reads that
+        take more than one statement can use DEFERRED for a consistent view.
+        '''
+        conn = self.connection()
+        conn.execute('BEGIN %s' % mode)
+        try:
+            yield conn
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    @staticmethod
+    def validate_group_name(group_name):
+        '''Raises an InvalidGroupException for a bad group name.'''
+        if not Group.validate_group_name(group_name):
+            raise InvalidGroupException('Bad group name: %s' % group_name)
+
+    def schema_for_sha256_id(self, conn, sha256_id, proto=None):
+        '''Builds a RegisteredSchema object, with the version metadata for
+        every group the schema is registered for, or returns None.  As with
+        Redis, the version for a group is the one _last_registered_.
+        '''
+        row = conn.execute('SELECT md5_id, schema FROM schemas '
+                           'WHERE sha256_id = ?', (sha256_id, )).fetchone()
+        if not row:
+            return None
+        rs_d = {'sha256_id': u'id.%s' % sha256_id,
+                'md5_id': u'id.%s' % row[0]}
+        # sqlite returns the ts from the row with the MAX(version)
+        for (group_name, version, ts) in conn.execute(
+                'SELECT group_name, MAX(version), ts FROM versions '
+                'WHERE sha256_id = ? GROUP BY group_name', (sha256_id, )):
+            rs_d[u'vid.%s' % group_name] = version
+            rs_d[u'vts.%s' % group_name] = ts
+        if not proto:
+            proto = self.schema_cache.get(sha256_id)
+        if not proto:
+            proto = self.cache_schema_str(row[1])
+        reg_schema = self.instantiate_registered_schema()
+        reg_schema.copy_schema_from(proto)
+        reg_schema.update_from_dict(rs_d)
+        return reg_schema
+
+    def group_for_name(self, conn, group_name):
+        '''Builds a Group object, with the current schema set, or returns
+        None if the group does not exist.'''
+        if not conn.execute('SELECT 1 FROM groups WHERE name = ?',
+                            (group_name, )).fetchone():
+            return None
+        group = Group(group_name, self.metadata_for_name(conn, group_name))
+        row = conn.execute('SELECT sha256_id FROM versions '
+                           'WHERE group_name = ? ORDER BY version DESC '
+                           'LIMIT 1', (group_name, )).fetchone()
+        if row:
+            group.current_schema = self.schema_for_sha256_id(conn, row[0])
+        return group
+
+    @staticmethod
+    def metadata_for_name(conn, group_name):
+        '''Returns the group metadata dict.'''
+        return dict(conn.execute('SELECT field, val FROM group_metadata '
+                                 'WHERE group_name = ?', (group_name, )))
+
+    def version_range(self, group_name, start, stop):
+        '''Gets the schemas for a range of versions (counting from 1, with
+        stop inclusive).  Each distinct schema is only built once.'''
+        with self.transaction('DEFERRED') as conn:
+            rows = conn.execute('SELECT sha256_id FROM versions '
+                                'WHERE group_name = ? AND version >= ? '
+                                'AND version <= ? ORDER BY version',
+                                (group_name, start, stop)).fetchall()
+            schemas = dict()
+            versions = []
+            for (sha256_id, ) in rows:
+                if not sha256_id in schemas:
+                    schemas[sha256_id] = self.schema_for_sha256_id(conn,
+                                                                   sha256_id)
+                reg_schema = self.instantiate_registered_schema()
+                reg_schema.copy_schema_from(schemas[sha256_id])
+                reg_schema.update_from_schema_metadata(
+                    schemas[sha256_id].as_schema_metadata())
+                versions.append(reg_schema)
+            return versions
+
+    @staticmethod
+    def latest_version(conn, group_name):
+        '''Returns the latest version number for a group (0 if none).'''
+        row = conn.execute('SELECT MAX(version) FROM versions '
+                           'WHERE group_name = ?', (group_name, )).fetchone()
+        return row[0] if row and row[0] else 0
+
+    ##########################################################################
+    # group methods
+    ##########################################################################
+    def get_group_names(self, active_only=False):
+        sql = 'SELECT name FROM groups'
+        if active_only:
+            sql += (' WHERE EXISTS (SELECT 1 FROM versions '
+                    'WHERE versions.group_name = groups.name)')
+        return sorted([row[0] for row in self.connection().execute(sql)],
+                      key=self.group_sort_key)
+
+    def get_groups(self, group_names=None, active_only=False):
+        if group_names is not None and len(group_names) == 0:
+            return []
+        with self.transaction('DEFERRED') as conn:
+            if group_names is None:
+                group_names = [row[0] for row in
+                               conn.execute('SELECT name FROM groups')]
+            groups = []
+            for group_name in group_names:
+                group = self.group_for_name(conn, group_name)
+                if group and (group.current_schema or not active_only):
+                    groups.append(group)
+        groups.sort(key=lambda x: self.group_sort_key(x.name))
+        return groups
+
+    def get_cur_versions(self):
+        conn = self.connection()
+        return dict((u'vid.%s' % group_name, version) for
+                    (group_name, version) in
+                    conn.execute('SELECT group_name, MAX(version) '
+                                 'FROM versions GROUP BY group_name'))
+
+    def lookup_group(self, group_name):
+        self.validate_group_name(group_name)
+        with self.transaction('DEFERRED') as conn:
+            return self.group_for_name(conn, group_name)
+
+    def register_group(self, group_name, metadata_dict=None, validators=None):
+        self.validate_group_name(group_name)
+        with self.transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO groups (name) VALUES (?)',
+                         (group_name, ))
+            conn.execute('INSERT OR IGNORE INTO group_metadata '
+                         '(group_name, field, val) VALUES (?, ?, ?)',
+                         (group_name, 'group_ts', str(long(time.time()))))
+            if metadata_dict:
+                self.upsert_metadata(conn, group_name, metadata_dict)
+            if validators:
+                conn.executemany('INSERT OR IGNORE INTO validators '
+                                 '(group_name, validator) VALUES (?, ?)',
+                                 [(group_name, val) for val in validators])
+
+    @staticmethod
+    def upsert_metadata(conn, group_name, entry_dict):
+        '''Sets the passed group metadata entries.'''
+        conn.executemany('INSERT OR REPLACE INTO group_metadata '
+                         '(group_name, field, val) VALUES (?, ?, ?)',
+                         [(group_name, key, val) for (key, val) in
+                          entry_dict.iteritems()])
+
+    def get_group_metadata(self, group_name):
+        self.validate_group_name(group_name)
+        return self.metadata_for_name(self.connection(), group_name)
+
+    def get_group_validators(self, group_name):
+        self.validate_group_name(group_name)
+        return set(row[0] for row in self.connection().execute(
+            'SELECT validator FROM validators WHERE group_name = ?',
+            (group_name, )))
+
+    def set_group_metadata(self, group_name, entry_dict):
+        self.validate_group_name(group_name)
+        with self.transaction() as conn:
+            self.upsert_metadata(conn, group_name, entry_dict)
+
+    def set_group_metadata_entry(self, group_name, key_name, val):
+        self.set_group_metadata(group_name, {key_name: val})
+
+    def delete_group_metadata_entry(self, group_name, key_name):
+        self.validate_group_name(group_name)
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM group_metadata '
+                         'WHERE group_name = ? AND field = ?',
+                         (group_name, key_name))
+
+    def delete_prefixed_group_metadata_entries(self, group_name, prefix):
+        self.validate_group_name(group_name)
+        with self.transaction() as conn:
+            fields = [field for field in
+                      self.metadata_for_name(conn, group_name).keys()
+                      if field.startswith(prefix)]
+            conn.executemany('DELETE FROM group_metadata '
+                             'WHERE group_name = ? AND field = ?',
+                             [(group_name, field) for field in fields])
+
+    def delete_group(self, group_name, remove_orphans=True):
+        with self.transaction() as conn:
+            if not conn.execute('SELECT 1 FROM groups WHERE name = ?',
+                                (group_name, )).fetchone():
+                raise ValueError("%s not registered." % group_name)
+            sha256_ids = [row[0] for row in
+                          conn.execute('SELECT DISTINCT sha256_id '
+                                       'FROM versions WHERE group_name = ?',
+                                       (group_name, ))]
+            for table in ('versions', 'group_metadata', 'validators',
+                          'master_state'):
+                conn.execute('DELETE FROM %s WHERE group_name = ?' % table,
+                             (group_name, ))
+            conn.execute('DELETE FROM groups WHERE name = ?', (group_name, ))
+            if remove_orphans:
+                for sha256_id in sha256_ids:
+                    conn.execute('DELETE FROM schemas WHERE sha256_id = ? '
+                                 'AND NOT EXISTS (SELECT 1 FROM versions '
+                                 'WHERE sha256_id = ?)',
+                                 (sha256_id, sha256_id))
+        self.invalidate_compat_verdicts(group_name)
+
+    ##########################################################################
+    # schema methods
+    ##########################################################################
+    def register_schema(self, group_name, schema_str):
+        self.validate_group_name(group_name)
+        new_rs = self.instantiate_registered_schema()
+        new_rs.schema_str = schema_str
+        if not new_rs.validate_schema_str():
+            raise ValueError(u'Cannot register_schema invalid schema.')
+        sha256_id = new_rs.sha256_id
+        now = long(time.time())
+        with self.transaction() as conn:
+            created = conn.execute(
+                'INSERT OR IGNORE INTO schemas (sha256_id, md5_id, schema) '
+                'VALUES (?, ?, ?)', (sha256_id, new_rs.md5_id,
+                                     new_rs.canonical_schema_str)).rowcount
+            conn.execute('INSERT OR IGNORE INTO groups (name) VALUES (?)',
+                         (group_name, ))
+            conn.execute('INSERT OR IGNORE INTO group_metadata '
+                         '(group_name, field, val) VALUES (?, ?, ?)',
+                         (group_name, 'group_ts', str(now)))
+            last = conn.execute('SELECT version, sha256_id FROM versions '
+                                'WHERE group_name = ? ORDER BY version DESC '
+                                'LIMIT 1', (group_name, )).fetchone()
+            if not last or last[1] != sha256_id:
+                version = last[0] + 1 if last else 1
+                conn.execute('INSERT INTO versions '
+                             '(group_name, version, sha256_id, ts) '
+                             'VALUES (?, ?, ?, ?)',
+                             (group_name, version, sha256_id, now))
+                created = 1
+                self.invalidate_compat_verdicts(group_name)
+            reg_schema = self.schema_for_sha256_id(conn, sha256_id,
+                                                   proto=new_rs)
+        if not sha256_id in self.schema_cache:
+            self.cache_schema(new_rs)
+        reg_schema.created = bool(created)
+        return reg_schema
+
+    def get_schema_for_group_and_version(self, group_name, version):
+        self.validate_group_name(group_name)
+        version = int(version)
+        if version == 0 or version < -1:
+            # we count from 1, and -1 is a flag for current
+            return None
+        with self.transaction('DEFERRED') as conn:
+            if version == -1:
+                version = self.latest_version(conn, group_name)
+            row = conn.execute('SELECT sha256_id FROM versions '
+                               'WHERE group_name = ? AND version = ?',
+                               (group_name, version)).fetchone()
+            if row:
+                return self.schema_for_sha256_id(conn, row[0])
+
+    def get_schema_for_id_str(self, id_str):
+        base64_id = id_str[3:] if id_str.startswith('id.') else id_str
+        buff = io.BytesIO(base64.b64decode(base64_id))
+        id_type = struct.unpack('>b', buff.read(1))[0]
+        with self.transaction('DEFERRED') as conn:
+            if id_type == MD5_BYTES:
+                row = conn.execute('SELECT sha256_id FROM schemas '
+                                   'WHERE md5_id = ?', (base64_id, ))
+                row = row.fetchone()
+                if not row:
+                    return None
+                base64_id = row[0]
+            elif id_type != SHA256_BYTES:
+                return None
+            return self.schema_for_sha256_id(conn, base64_id)
+
+    def get_schema_for_schema_str(self, schema_str):
+        target_rs = self.instantiate_registered_schema()
+        target_rs.schema_str = schema_str
+        if not target_rs.validate_schema_str():
+            raise ValueError(u'Cannot register_schema invalid schema.')
+        with self.transaction('DEFERRED') as conn:
+            return self.schema_for_sha256_id(conn, target_rs.sha256_id,
+                                             proto=target_rs)
+
+    def get_latest_schema_versions_for_group(self, group_name, max_versions=5):
+        self.validate_group_name(group_name)
+        if max_versions < 0:
+            return self.get_schema_versions_for_group(group_name)
+        latest = self.latest_version(self.connection(), group_name)
+        # we always return at least the latest version
+        start = max(latest - max(max_versions, 1) + 1, 1)
+        return self.version_range(group_name, start, latest)
+
+    def get_schema_versions_for_group(self, group_name, first_version=1,
+                                      last_version=-1):
+        self.validate_group_name(group_name)
+        stop = int(last_version)
+        if stop < 0:
+            stop = self.latest_version(self.connection(), group_name)
+        return self.version_range(group_name, max(int(first_version), 1),
+                                  stop)
+
+    def get_version_sha256_ids_for_group(self, group_name, first_version=1,
+                                         last_version=-1):
+        self.validate_group_name(group_name)
+        stop = int(last_version)
+        if stop < 0:
+            stop = self.latest_version(self.connection(), group_name)
+        return [u'id.%s' % row[0] for row in
+                self.connection().execute('SELECT sha256_id FROM versions '
+                                          'WHERE group_name = ? '
+                                          'AND version >= ? '
+                                          'AND version <= ? '
+                                          'ORDER BY version',
+                                          (group_name,
+                                           max(int(first_version), 1),
+                                           stop))]
+
+    def get_versions_for_id_str_and_group(self, id_str, group_name):
+        self.validate_group_name(group_name)
+        base64_id = id_str[3:] if id_str.startswith('id.') else id_str
+        conn = self.connection()
+        if len(base64_id) == 24:
+            # we have an md5 id, so get the sha256 id
+            row = conn.execute('SELECT sha256_id FROM schemas '
+                               'WHERE md5_id = ?', (base64_id, )).fetchone()
+            base64_id = row[0] if row else None
+        return [row[0] for row in
+                conn.execute('SELECT version FROM versions '
+                             'WHERE group_name = ? AND sha256_id = ? '
+                             'ORDER BY version', (group_name, base64_id))]
+
+    def get_master_state_str(self, group_name):
+        row = self.connection().execute('SELECT state FROM master_state '
+                                        'WHERE group_name = ?',
+                                        (group_name, )).fetchone()
+        return row[0] if row else None
+
+    def set_master_state_str(self, group_name, version, state_str):
+        if self.read_only:
+            # it is derived data, so a read-only node just works it out
+            return
+        with self.transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO master_state '
+                         '(group_name, version, state) VALUES (?, 0, ?)',
+                         (group_name, state_str))
+            conn.execute('UPDATE master_state SET version = ?, state = ? '
+                         'WHERE group_name = ? AND version < ?',
+                         (version, state_str, group_name, version))
+
+
+class SqliteAvroSchemaRepository(SqliteSchemaRepository):
+    '''This is an Avro-specific embedded schema repository class.
+    '''
+    def instantiate_registered_schema(self):
+        '''Returns a RegisteredAvroSchema object, overriding the parent.
+        '''
+        return RegisteredAvroSchema()
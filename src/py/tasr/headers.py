@@ -52,6 +52,9 @@ class SubjectHeaderBot(HeaderBot):
     H_CUR_SHA256 = 'X-TASR-SUBJECT-CURRENT-SCHEMA-SHA256'
     H_MD5_IDS = 'X-TASR-MD5-IDS'
     H_SHA256_IDS = 'X-TASR-SHA256-IDS'
+    H_MASTER_DEPTH = 'X-TASR-SUBJECT-MASTER-DEPTH'
+    H_NEXT_VERSION = 'X-TASR-SUBJECT-NEXT-VERSION'
+    H_NEXT_AFTER = 'X-TASR-SUBJECT-NEXT-AFTER'
 
     @staticmethod
     def extract(label, resp):
@@ -157,6 +160,18 @@ class SubjectHeaderBot(HeaderBot):
             if cur_ts:
                 self.add(SubjectHeaderBot.H_CUR_TS, cur_ts)
 
+    def set_subject_master_depth(self, depth):
+        '''Sets an <H_MASTER_DEPTH>: <versions in master> header'''
+        self.set(SubjectHeaderBot.H_MASTER_DEPTH, depth)
+
+    def set_next_version(self, version):
+        '''Sets an <H_NEXT_VERSION>: <first version of the next page> header'''
+        self.set(SubjectHeaderBot.H_NEXT_VERSION, version)
+
+    def set_next_after(self, subject_name):
+        '''Sets an <H_NEXT_AFTER>: <last subject name in the page> header'''
+        self.set(SubjectHeaderBot.H_NEXT_AFTER, subject_name)
+
     def standard_headers(self, subject=None):
         '''Adds the standard subject headers.'''
         self.add_subject_name(subject)
@@ -13,9 +13,21 @@ import avro.schema
 import collections
 import json
 import logging
+from tasr.cache import LRUCache
 
 MD5_BYTES = 16
 SHA256_BYTES = 32
+CANONICAL_CACHE_ENTRIES = 10000
+CANONICAL_CACHE_BYTES = 32 * 1024 * 1024
+# maps a digest of a raw schema string to its canonical form, so producers
+# sending the same (non-canonical) schema string over and over only cost a
+# digest after the first time
+CANONICAL_CACHE = LRUCache(CANONICAL_CACHE_ENTRIES, CANONICAL_CACHE_BYTES)
+PARSED_CACHE_ENTRIES = 10000
+PARSED_CACHE_BYTES = 64 * 1024 * 1024
+# maps sha256 ids to parsed avro.schema.Schema objects (or parse exceptions);
+# the size of an entry is taken as the size of its canonical schema string
+PARSED_CACHE = LRUCache(PARSED_CACHE_ENTRIES, PARSED_CACHE_BYTES)
 
 
 class SchemaMetadata(object):
@@ -100,14 +112,47 @@ class RegisteredSchema(object):
     that will not affect the parsing of the schema normalized.
 
     The IDs are derivative of the canonical schema string, so they are surfaced
-    with @property methods.
+    with @property methods.  The canonical string and the digests are worked
+    out on first access and kept until the schema_str is reassigned, so a
+    schema served many times is only canonicalized and hashed once.
     '''
+    __slots__ = ('_schema_str', '_canonical', '_md5_bytes', '_sha256_bytes',
+                 '_md5_id', '_sha256_id', 'gv_dict', 'ts_dict', 'created')
+
     def __init__(self):
         self.schema_str = None
         self.gv_dict = dict()
         self.ts_dict = dict()
         self.created = False
 
+    @property
+    def schema_str(self):
+        '''The schema string as set (not canonicalized).'''
+        return self._schema_str
+
+    @schema_str.setter
+    def schema_str(self, val):
+        self._schema_str = val
+        self.clear_derived()
+
+    def clear_derived(self):
+        '''Drops the values derived from the schema string, so they will be
+        worked out again on next access.'''
+        self._canonical = None
+        self._md5_bytes = None
+        self._sha256_bytes = None
+        self._md5_id = None
+        self._sha256_id = None
+
+    def copy_derived_from(self, other):
+        '''Takes the already worked out derived values from another RS object
+        with the same schema string.'''
+        self._canonical = other._canonical
+        self._md5_bytes = other._md5_bytes
+        self._sha256_bytes = other._sha256_bytes
+        self._md5_id = other._md5_id
+        self._sha256_id = other._sha256_id
+
     def update_from_dict(self, rs_dict):
         '''A dict containing a schema and topic-version and topic-timestamp
         entries can be used to update the RS fields.  Note that even if the
@@ -115,7 +160,8 @@ class RegisteredSchema(object):
         as the RS only exposes those as live values calculated from the schema.
         '''
         if rs_dict:
-            self.schema_str = rs_dict.pop('schema', self.schema_str)
+            if 'schema' in rs_dict:
+                self.schema_str = rs_dict.pop('schema')
             self.update_from_schema_metadata(SchemaMetadata(rs_dict))
 
     def update_from_schema_metadata(self, metadata):
@@ -126,6 +172,15 @@ class RegisteredSchema(object):
             self.gv_dict.update(metadata.gv_dict)
             self.ts_dict.update(metadata.ts_dict)
 
+    def copy_schema_from(self, other):
+        '''Sets the schema (and anything derived from it) from another RS
+        object, leaving the topic-version and topic-timestamp fields alone.
+        This lets us reuse cached, immutable schema content for new objects.
+        '''
+        self.schema_str = other.schema_str
+        if type(other) is type(self):
+            self.copy_derived_from(other)
+
     def as_schema_metadata(self):
         '''Creates a new SchemaMetadata object that contains a snapshot of the
         RS object's metadata (IDs, gv_dict and ts_dict).
@@ -147,14 +202,28 @@ class RegisteredSchema(object):
         rs_dict['md5_id'] = 'id.%s' % self.md5_id
         return rs_dict
 
-    @property
-    def canonical_schema_str(self):
+    def canonicalize(self):
         '''The split() and join() normalizes whitespace.'''
-        if not self.schema_str:
-            return None
         elems = self.schema_str.split()
         return ' '.join(elems)
 
+    @property
+    def canonical_schema_str(self):
+        '''The canonical schema string, worked out once per schema_str.'''
+        if self._canonical is None and self.schema_str:
+            self._canonical = self.canonicalize()
+        return self._canonical
+
+    @staticmethod
+    def id_bytes(id_type, digest):
+        '''Prefixes a digest with the id type byte.'''
+        buf = io.BytesIO()
+        buf.write(struct.pack('>b', id_type))
+        buf.write(digest)
+        id_bytes = buf.getvalue()
+        buf.close()
+        return id_bytes
+
     @property
     def md5_id(self):
         '''Access the (base64'd) md5 as a property.
@@ -165,15 +234,15 @@ class RegisteredSchema(object):
     def md5_id_base64(self):
         '''Access the base64'd md5 as a property.
         '''
-        if self.canonical_schema_str == None:
-            return None
-        return base64.b64encode(self.md5_id_bytes)
+        if self._md5_id is None and self.md5_id_bytes is not None:
+            self._md5_id = base64.b64encode(self.md5_id_bytes)
+        return self._md5_id
 
     @property
     def md5_id_hex(self):
         '''Access the hex md5 as a property.
         '''
-        if self.canonical_schema_str == None:
+        if self.md5_id_bytes is None:
             return None
         return binascii.hexlify(self.md5_id_bytes)
 
@@ -181,16 +250,11 @@ class RegisteredSchema(object):
     def md5_id_bytes(self):
         '''Access the md5 bytes as a property.
         '''
-        if self.canonical_schema_str == None:
-            return None
-        buf = io.BytesIO()
-        buf.write(struct.pack('>b', MD5_BYTES))
-        md5 = hashlib.md5()
-        md5.update(self.canonical_schema_str)
-        buf.write(md5.digest())
-        id_bytes = buf.getvalue()
-        buf.close()
-        return id_bytes
+        if self._md5_bytes is None and self.canonical_schema_str is not None:
+            md5 = hashlib.md5()
+            md5.update(self.canonical_schema_str)
+            self._md5_bytes = self.id_bytes(MD5_BYTES, md5.digest())
+        return self._md5_bytes
 
     @property
     def sha256_id(self):
@@ -202,15 +266,15 @@ class RegisteredSchema(object):
     def sha256_id_base64(self):
         '''Access the base64'd sha256 as a property.
         '''
-        if self.canonical_schema_str == None:
-            return None
-        return base64.b64encode(self.sha256_id_bytes)
+        if self._sha256_id is None and self.sha256_id_bytes is not None:
+            self._sha256_id = base64.b64encode(self.sha256_id_bytes)
+        return self._sha256_id
 
     @property
     def sha256_id_hex(self):
         '''Access the hex sha256 as a property.
         '''
-        if self.canonical_schema_str == None:
+        if self.sha256_id_bytes is None:
             return None
         return binascii.hexlify(self.sha256_id_bytes)
 
@@ -218,16 +282,12 @@ class RegisteredSchema(object):
     def sha256_id_bytes(self):
         '''Access the sha256 bytes as a property.
         '''
-        if self.canonical_schema_str == None:
-            return None
-        buf = io.BytesIO()
-        buf.write(struct.pack('>b', SHA256_BYTES))
-        sha = hashlib.sha256()
-        sha.update(self.canonical_schema_str)
-        buf.write(sha.digest())
-        id_bytes = buf.getvalue()
-        buf.close()
-        return id_bytes
+        if (self._sha256_bytes is None and
+                self.canonical_schema_str is not None):
+            sha = hashlib.sha256()
+            sha.update(self.canonical_schema_str)
+            self._sha256_bytes = self.id_bytes(SHA256_BYTES, sha.digest())
+        return self._sha256_bytes
 
     @property
     def group_names(self):
@@ -318,25 +378,98 @@ def ordered_object(obj):
     return obj
 
 
+def canonical_json_str(json_str):
+    '''Returns the canonical form of a JSON document string: the keys of
+    every object alpha-ordered, and the json module's default separators.  It
+    is the same string as json.dumps(ordered_object(json.loads(json_str))),
+    but the sort happens during the (single) serialization pass rather than
+    building OrderedDict objects first.  Results are cached by a digest of
+    the raw string.  Empty documents have no canonical form (None).
+    '''
+    if not json_str:
+        return None
+    raw = json_str
+    if isinstance(json_str, unicode):
+        raw = json_str.encode('utf-8')
+    key = hashlib.sha1(raw).digest()
+    canonical = CANONICAL_CACHE.get(key)
+    if canonical is None:
+        try:
+            jobj = json.loads(json_str)
+        except ValueError as err:
+            # remember bad JSON too, so repeats do not get parsed again
+            CANONICAL_CACHE.put(key, err, len(raw))
+            raise
+        if not jobj:
+            return None
+        canonical = json.dumps(jobj, sort_keys=True)
+        CANONICAL_CACHE.put(key, canonical, len(raw) + len(canonical))
+    elif isinstance(canonical, ValueError):
+        raise canonical
+    return canonical
+
+
+def parse_avro_schema(canonical_str, sha256_id):
+    '''Returns the avro.schema.Schema for a canonical schema string, parsing
+    it at most once per process.  Parsed schemas are cached by sha256 id.  So
+    are parse failures, and the cached exception is raised again on repeats.
+    The returned Schema objects are shared, so treat them as read-only.
+    '''
+    if not sha256_id:
+        return avro.schema.parse(canonical_str)
+    parsed = PARSED_CACHE.get(sha256_id)
+    if parsed is None:
+        try:
+            parsed = avro.schema.parse(canonical_str)
+        except Exception as err:
+            # parsing is deterministic, so a failure will always fail
+            parsed = err
+        PARSED_CACHE.put(sha256_id, parsed, len(canonical_str))
+    if isinstance(parsed, Exception):
+        raise parsed
+    return parsed
+
+
 class RegisteredAvroSchema(RegisteredSchema):
-    '''Adds an Avro schema validation function.'''
-    def __init__(self):
-        super(RegisteredAvroSchema, self).__init__()
+    '''Adds an Avro schema validation function.  The ordered object and the
+    parsed Avro schema are derived from the schema string as well, so they are
+    dropped along with the ids when the schema_str is reassigned.'''
+    __slots__ = ('_ordered', 'schema')
+
+    def clear_derived(self):
+        super(RegisteredAvroSchema, self).clear_derived()
+        self._ordered = None
         self.schema = None
-        self.ordered = None
 
     @property
-    def canonical_schema_str(self):
-        if not self.ordered and self.schema_str:
-            self.ordered = ordered_object(json.loads(self.schema_str))
-        return json.dumps(self.ordered) if self.ordered else None
+    def ordered(self):
+        '''The schema as a (recursively) key-ordered object.'''
+        if self._ordered is None and self.schema_str:
+            self._ordered = ordered_object(json.loads(self.schema_str))
+        return self._ordered
+
+    def canonicalize(self):
+        return canonical_json_str(self.schema_str)
+
+    def copy_schema_from(self, other):
+        '''Also copies the ordered object, the parsed Avro schema and the ids,
+        if set.  These are shared with the other object, so treat them as
+        read-only.
+        '''
+        super(RegisteredAvroSchema, self).copy_schema_from(other)
+        if isinstance(other, RegisteredAvroSchema):
+            self.copy_derived_from(other)
+            self._ordered = other._ordered
+            self.schema = other.schema
 
     def validate_schema_str(self):
         if not super(RegisteredAvroSchema, self).validate_schema_str():
             return False
 
         # a parse exception should bubble up, so don't catch it here
-        self.schema = avro.schema.parse(self.canonical_schema_str)
+        if self.schema is None:
+            self.schema = parse_avro_schema(self.canonical_schema_str,
+                                            self.sha256_id)
 
         # add additional checks?
         return True
@@ -437,6 +570,7 @@ class MasterAvroSchema(RegisteredAvroSchema):
         self.map_fields = dict()
         self.field_name_list = None
         self.deleted_field_names = None
+        self.version_count = 0
         # if one was provided, set it
         self.set_schema_list(slist)
 
@@ -449,129 +583,145 @@ class MasterAvroSchema(RegisteredAvroSchema):
             logging.debug('Not a list.')
             return
 
-        is_first_version = True
         self.schema_list = []
         for elem in slist:
-            ras = None
-            # these can be JSON schema defs or actual RAS objects
-            if isinstance(elem, basestring):
-                ras = RegisteredAvroSchema()
-                ras.schema_str = elem
-            elif isinstance(elem, RegisteredAvroSchema):
-                ras = elem
-            else:
-                raise ValueError('Not a schema string or a RAS')
-            if not ras.canonical_schema_str:  # also ensures ordered available
-                raise ValueError('RAS has no canonical schema string')
-
-            # we use the ordered dict as a convenient way to check the version
-            ver = ras.ordered
-            if not basic_schema_dict_valid(ver, mas=self):
-                raise ValueError('Non-field element mismatch.')
-            if (self.e_namespace == None
-                and self.e_type == None
-                and self.e_name == None):
-                self.e_namespace = ver['namespace']
-                self.e_type = ver['type']
-                self.e_name = ver['name']
-
-            # check present fields
-            self.field_name_list = []
-            for field in ver['fields']:
-                sfield = SchemaField(field, is_first_version)
-                self.field_name_list.append(sfield.name)
-                if sfield.is_complex:
-                    # we don't really check complex fields for compatibility,
-                    # you are on your own in this case
-                    self.complex_fields[sfield.name] = field
-                elif sfield.is_map:
-                    # map values need to remain unchanged to be compatible
-                    if sfield.name in self.map_fields.keys():
-                        old_values = self.map_fields[sfield.name]['values']
-                        if sfield.map_values != old_values:
-                            _msg = 'map values changed (%s)' % sfield.name
-                            raise ValueError(_msg)
-                elif sfield.is_required == False:
-                    # OPT field -- ID -> OPT and PART -> OPT are not allowed
-                    #if self.id_field and field == self.id_field:
-                    #    raise ValueError('ID -> OPT for %s' % sfield.name)
-                    #if self.part_field and field == self.part_field:
-                    #    raise ValueError('PART -> OPT for %s' % sfield.name)
-                    if sfield.name in self.required_fields.keys():
-                        # REQ -> OPT is allowed
-                        old_type = self.required_fields[sfield.name]['type']
-                        if not old_type in sfield.type:
-                            raise ValueError('REQ -> OPT incompatible types')
-                        self.required_fields.pop(sfield.name)
-                        self.opt_fields[sfield.name] = field
-                    elif sfield.name in self.opt_fields.keys():
-                        # OPT -> OPT, so check it's the same
-                        if self.opt_fields[sfield.name] != field:
-                            raise ValueError('OPT field mismatch: %s != %s' %
-                                             (self.opt_fields[sfield.name],
-                                              field))
-                    else:
-                        # new OPT field
-                        self.opt_fields[sfield.name] = field
+            self.fold_version(elem)
+        self.build_schema_str()
+
+    def add_version(self, elem):
+        '''Extends the master with one more (the newest) version.  This only
+        walks the new version's fields, so it does not get slower as the
+        history grows.  As with set_schema_list(), a ValueError is raised for
+        a non-compatible version, and the master should then be discarded.'''
+        if self.schema_list == None:
+            self.schema_list = []
+        self.fold_version(elem)
+        self.build_schema_str()
+
+    def fold_version(self, elem):
+        '''Folds the fields of a version into the master field tables.'''
+        is_first_version = self.version_count == 0
+        ras = None
+        # these can be JSON schema defs or actual RAS objects
+        if isinstance(elem, basestring):
+            ras = RegisteredAvroSchema()
+            ras.schema_str = elem
+        elif isinstance(elem, RegisteredAvroSchema):
+            ras = elem
+        else:
+            raise ValueError('Not a schema string or a RAS')
+        if not ras.canonical_schema_str:  # also ensures ordered available
+            raise ValueError('RAS has no canonical schema string')
 
-                elif sfield.is_required:
-                    if sfield.name in self.required_fields.keys():
-                        # never allow REQ -> REQ' changes
-                        if field != self.required_fields[sfield.name]:
-                            _msg = ('REQ field mismatch: %s != %s' %
-                                    (self.required_fields[sfield.name], field))
-                            raise ValueError(_msg)
-                    elif is_first_version:
-                        # allow new REQ fields in ver 1
-                        self.required_fields[sfield.name] = field
-                    else:
-                        raise ValueError('Cannot add REQ fields after ver 1.')
+        # we use the ordered dict as a convenient way to check the version
+        ver = ras.ordered
+        if not basic_schema_dict_valid(ver, mas=self):
+            raise ValueError('Non-field element mismatch.')
+        if (self.e_namespace == None
+            and self.e_type == None
+            and self.e_name == None):
+            self.e_namespace = ver['namespace']
+            self.e_type = ver['type']
+            self.e_name = ver['name']
+
+        # check present fields
+        self.field_name_list = []
+        for field in ver['fields']:
+            sfield = SchemaField(field, is_first_version)
+            self.field_name_list.append(sfield.name)
+            if sfield.is_complex:
+                # we don't really check complex fields for compatibility,
+                # you are on your own in this case
+                self.complex_fields[sfield.name] = field
+            elif sfield.is_map:
+                # map values need to remain unchanged to be compatible
+                if sfield.name in self.map_fields.keys():
+                    old_values = self.map_fields[sfield.name]['values']
+                    if sfield.map_values != old_values:
+                        _msg = 'map values changed (%s)' % sfield.name
+                        raise ValueError(_msg)
+            elif sfield.is_required == False:
+                # OPT field -- ID -> OPT and PART -> OPT are not allowed
+                #if self.id_field and field == self.id_field:
+                #    raise ValueError('ID -> OPT for %s' % sfield.name)
+                #if self.part_field and field == self.part_field:
+                #    raise ValueError('PART -> OPT for %s' % sfield.name)
+                if sfield.name in self.required_fields.keys():
+                    # REQ -> OPT is allowed
+                    old_type = self.required_fields[sfield.name]['type']
+                    if not old_type in sfield.type:
+                        raise ValueError('REQ -> OPT incompatible types')
+                    self.required_fields.pop(sfield.name)
+                    self.opt_fields[sfield.name] = field
+                elif sfield.name in self.opt_fields.keys():
+                    # OPT -> OPT, so check it's the same
+                    if self.opt_fields[sfield.name] != field:
+                        raise ValueError('OPT field mismatch: %s != %s' %
+                                         (self.opt_fields[sfield.name],
+                                          field))
                 else:
-                    # shouldn't happen
-                    raise ValueError('WTF?  %s' % field)
-                # end of present fields loop -- check for disallowed deletion
-                if self.id_field:
-                    if not self.id_field['name'] in self.field_name_list:
-                        raise ValueError('Cannot delete ID field.')
-                if self.part_field:
-                    if not self.part_field['name'] in self.field_name_list:
-                        raise ValueError('Cannot delete PART field.')
-            is_first_version = False
-            # end of ver loop
-
-            # build deleted fields list
-            self.deleted_field_names = []
-            for fname in self.required_fields.keys():
-                if not fname in self.field_name_list:
-                    self.deleted_field_names.append(fname)
-            for fname in self.opt_fields.keys():
-                if not fname in self.field_name_list:
-                    self.deleted_field_names.append(fname)
-
-            # now create the master schema string
-            mfields = []
-            # add the retained fields in the most recent order
-            for fname in self.field_name_list:
-                if fname in self.required_fields:
-                    mfields.append(self.required_fields[fname])
-                elif fname in self.opt_fields:
-                    mfields.append(self.opt_fields[fname])
-                elif fname in self.complex_fields:
-                    mfields.append(self.complex_fields[fname])
-            # tack the deleted fields on the end
-            for fname in self.deleted_field_names:
-                if fname in self.required_fields:
-                    mfields.append(self.required_fields[fname])
-                elif fname in self.opt_fields:
-                    mfields.append(self.opt_fields[fname])
-            # now create the ordered dict holding it all
-            odict = collections.OrderedDict()
-            odict['namespace'] = self.e_namespace
-            odict['type'] = self.e_type
-            odict['name'] = self.e_name
-            odict['fields'] = mfields
-            # and from that, set the schema_str
-            self.schema_str = json.dumps(odict)
+                    # new OPT field
+                    self.opt_fields[sfield.name] = field
+
+            elif sfield.is_required:
+                if sfield.name in self.required_fields.keys():
+                    # never allow REQ -> REQ' changes
+                    if field != self.required_fields[sfield.name]:
+                        _msg = ('REQ field mismatch: %s != %s' %
+                                (self.required_fields[sfield.name], field))
+                        raise ValueError(_msg)
+                elif is_first_version:
+                    # allow new REQ fields in ver 1
+                    self.required_fields[sfield.name] = field
+                else:
+                    raise ValueError('Cannot add REQ fields after ver 1.')
+            else:
+                # shouldn't happen
+                raise ValueError('WTF?  %s' % field)
+            # end of present fields loop -- check for disallowed deletion
+            if self.id_field:
+                if not self.id_field['name'] in self.field_name_list:
+                    raise ValueError('Cannot delete ID field.')
+            if self.part_field:
+                if not self.part_field['name'] in self.field_name_list:
+                    raise ValueError('Cannot delete PART field.')
+        self.version_count += 1
+
+    def build_schema_str(self):
+        '''Sets the master schema string from the master field tables.'''
+        # build deleted fields list
+        self.deleted_field_names = []
+        for fname in self.required_fields.keys():
+            if not fname in self.field_name_list:
+                self.deleted_field_names.append(fname)
+        for fname in self.opt_fields.keys():
+            if not fname in self.field_name_list:
+                self.deleted_field_names.append(fname)
+
+        # now create the master schema string
+        mfields = []
+        # add the retained fields in the most recent order
+        for fname in self.field_name_list:
+            if fname in self.required_fields:
+                mfields.append(self.required_fields[fname])
+            elif fname in self.opt_fields:
+                mfields.append(self.opt_fields[fname])
+            elif fname in self.complex_fields:
+                mfields.append(self.complex_fields[fname])
+        # tack the deleted fields on the end
+        for fname in self.deleted_field_names:
+            if fname in self.required_fields:
+                mfields.append(self.required_fields[fname])
+            elif fname in self.opt_fields:
+                mfields.append(self.opt_fields[fname])
+        # now create the ordered dict holding it all
+        odict = collections.OrderedDict()
+        odict['namespace'] = self.e_namespace
+        odict['type'] = self.e_type
+        odict['name'] = self.e_name
+        odict['fields'] = mfields
+        # and from that, set the schema_str
+        self.schema_str = json.dumps(odict)
 
     def is_compatible(self, obj):
         '''Tests whether a passed RegisteredAvroSchema object is a compatible
@@ -645,6 +795,291 @@ class MasterAvroSchema(RegisteredAvroSchema):
                 return False
         return True
 
+    def as_state(self):
+        '''Returns the master field tables and non-field elements as a dict
+        that can be serialized as JSON.  The schema string is derived from
+        these, so it is not included.'''
+        state = dict()
+        for attr in MASTER_STATE_ATTRS:
+            state[attr] = getattr(self, attr)
+        return state
+
+    @staticmethod
+    def from_state(state):
+        '''Creates a MasterAvroSchema from a dict made by as_state(), ready
+        for is_compatible() or add_version() calls.'''
+        mas = MasterAvroSchema(None)
+        for attr in MASTER_STATE_ATTRS:
+            val = state.get(attr)
+            if isinstance(val, dict):
+                # the table values stay ordered, the tables become dicts
+                val = dict(val.items())
+            setattr(mas, attr, val)
+        mas.schema_list = []
+        mas.build_schema_str()
+        return mas
+
+
+MASTER_STATE_ATTRS = ['e_namespace', 'e_type', 'e_name', 'id_field',
+                      'part_field', 'required_fields', 'opt_fields',
+                      'complex_fields', 'map_fields', 'field_name_list',
+                      'version_count']
+
+
+def longest_compatible_master(versions):
+    '''Takes a list of versions and creates a "master", containing all the
+    fields from the most recent compatible versions.  That is the master for
+    the longest run of versions, ending with the latest, that makes one.
+    Returns a (depth, master) tuple, where depth is the number of versions
+    included, or (0, None) if even the latest version does not make one.
+
+    Rather than trying a full master for each run, this makes one backward
+    pass, keeping a summary (see prepend_field_use()) of how each field is
+    used by the run so far.  Whether an older version can start the run is
+    then checked against those summaries, using only the older version's
+    fields, so the whole search is linear in the size of the history.  The
+    pass stops as soon as no older version could start a compatible run.
+    '''
+    versions = [as_registered_avro_schema(elem) for elem in versions]
+    summaries = dict()
+    req_led = 0  # the number of field summaries that start with a REQ use
+    run_elems = [set(), set(), set()]  # non-field elements of later versions
+    best_start = None
+    later = None
+    for start in range(len(versions) - 1, -1, -1):
+        ver = master_version_uses(versions[start])
+        if ver is None:
+            break
+        (elems, later_ok, uses) = ver
+        if later and not later[1]:
+            # the next version is only valid as a first version
+            break
+        if (run_elems_match(elems, run_elems) and
+                run_start_ok(uses, summaries, req_led)):
+            best_start = start
+        # now add this version to the run, as a later version
+        for (name, is_req, field) in reversed(uses):
+            cur = summaries.get(name)
+            summary = prepend_field_use(cur, is_req, field)
+            if summary is None:
+                break
+            if summary[0] == 'req' and (cur is None or cur[0] != 'req'):
+                req_led += 1
+            summaries[name] = summary
+        else:
+            for (idx, elem) in enumerate(elems):
+                run_elems[idx].add(json.dumps(elem, sort_keys=True))
+            later = ver
+            continue
+        # no older version could start a compatible run
+        break
+
+    if best_start is None:
+        return (0, None)
+    try:
+        mas = MasterAvroSchema(versions[best_start:])
+        return (len(versions) - best_start, mas)
+    except Exception:
+        # the summaries should never disagree with the master, but if they
+        # do, the master is right
+        logging.warn('master run check mismatch, trying all runs')
+    for start in range(len(versions)):
+        try:
+            mas = MasterAvroSchema(versions[start:])
+            return (len(versions) - start, mas)
+        except Exception:
+            pass
+    return (0, None)
+
+
+def as_registered_avro_schema(elem):
+    '''Versions for a master can be JSON schema defs or actual RAS objects.
+    This makes RAS objects of the former, so they are only parsed once.'''
+    if isinstance(elem, basestring):
+        ras = RegisteredAvroSchema()
+        ras.schema_str = elem
+        return ras
+    return elem
+
+
+def master_version_uses(elem):
+    '''Breaks a version down for longest_compatible_master().  Returns a
+    tuple of the non-field elements (namespace, type and name), whether the
+    version is valid as a later (not first) version and a list of the
+    (name, is_required, field) uses of the fields a master checks.  Returns
+    None for a version that cannot be in a master at all.'''
+    try:
+        if not (isinstance(elem, RegisteredAvroSchema) and
+                elem.canonical_schema_str):
+            return None
+        ver = elem.ordered
+        if not basic_schema_dict_valid(ver):
+            return None
+        uses = []
+        later_ok = True
+        for field in ver['fields']:
+            try:
+                sfield = SchemaField(field)
+            except ValueError:
+                # some legacy fields are only allowed in a first version
+                sfield = SchemaField(field, True)
+                later_ok = False
+            if not (sfield.is_complex or sfield.is_map):
+                uses.append((sfield.name, sfield.is_required, field))
+        return ((ver['namespace'], ver['type'], ver['name']), later_ok, uses)
+    except Exception:
+        return None
+
+
+def prepend_field_use(summary, is_req, field):
+    '''A field's uses in a run of later versions are summarized as either
+    ('opt', None, opt_field), where every use is the same OPT field, or
+    ('req', req_field, opt_field), where the uses are the same REQ field,
+    then (if opt_field is not None) the same OPT field.  Any other run of
+    uses can never be in a master.  This returns the summary with an older
+    use added in front, or None if the run can no longer be in a master.'''
+    if not is_req:
+        if summary is None:
+            return ('opt', None, field)
+        if summary[0] == 'opt' and summary[2] == field:
+            return summary
+        return None
+    if summary is None:
+        return ('req', field, None)
+    if summary[0] == 'opt':
+        if field['type'] in summary[2]['type']:
+            return ('req', field, summary[2])
+        return None
+    return summary if summary[1] == field else None
+
+
+def run_elems_match(elems, run_elems):
+    '''Checks the non-field elements of the later versions in the run against
+    those of a first version, as basic_schema_dict_valid() would.'''
+    for (idx, elem) in enumerate(elems):
+        if elem and run_elems[idx]:
+            if run_elems[idx] != set([json.dumps(elem, sort_keys=True)]):
+                return False
+    return True
+
+
+def run_start_ok(uses, summaries, req_led):
+    '''Checks whether a version with the passed field uses could be the first
+    version for the run of later versions summarized.'''
+    first = dict()
+    for (name, is_req, field) in uses:
+        cur = first.get(name)
+        if cur is None:
+            first[name] = (is_req, field)
+        elif is_req or not cur[0]:
+            # a repeated field has to be the same
+            if cur != (is_req, field):
+                return False
+        elif field['type'] in cur[1]['type']:
+            first[name] = (is_req, field)
+        else:
+            return False
+    matched_req_led = 0
+    for name, (is_req, field) in first.iteritems():
+        summary = summaries.get(name)
+        if summary is None:
+            continue
+        if summary[0] == 'req':
+            # REQ fields cannot be added after the first version
+            matched_req_led += 1
+            if not is_req or summary[1] != field:
+                return False
+        elif is_req:
+            if not field['type'] in summary[2]['type']:
+                return False
+        elif summary[2] != field:
+            return False
+    # and any field first used as a REQ later must be in the first version
+    return matched_req_led == req_led
+
+
+class MasterState(object):
+    '''The master schema state for a group, in a form that can be stored and
+    then extended one version at a time as new versions are registered.  The
+    version is the number of group versions covered.  The master is the one
+    for the longest compatible run of versions ending with the latest (the
+    depth is its length), and the error is why the master for _all_ the
+    versions could not be made (if it could not).  Once the full history has
+    failed, it always will, as adding versions cannot fix an earlier one.
+    '''
+    def __init__(self, version=0, depth=0, master=None, error=None):
+        self.version = version
+        self.depth = depth
+        self.master = master
+        self.error = error
+
+    @staticmethod
+    def build(versions):
+        '''Creates the MasterState for a full list of versions.'''
+        if not versions:
+            return MasterState()
+        try:
+            return MasterState(len(versions), len(versions),
+                               MasterAvroSchema(versions))
+        except Exception as err:
+            (depth, mas) = longest_compatible_master(versions[1:])
+            return MasterState(len(versions), depth, mas, master_error(err))
+
+    def extend(self, new_versions):
+        '''Folds the new versions into the master.  If a new version is not
+        compatible with the current master, the compatible run has to be
+        found again from the full list, so this returns False and leaves the
+        state unchanged.  Otherwise it returns True.'''
+        if self.master:
+            # fold into a copy, so a failure leaves this state as it was
+            mas = MasterAvroSchema.from_state(self.master.as_state())
+        else:
+            mas = MasterAvroSchema(None)
+        try:
+            for ras in new_versions:
+                mas.add_version(ras)
+        except Exception:
+            return False
+        self.version += len(new_versions)
+        self.depth += len(new_versions)
+        self.master = mas
+        return True
+
+    def check_compatible(self, ras):
+        '''Checks whether a new version would be compatible with all the
+        versions covered.  If the covered versions are not compatible with
+        each other, a ValueError is raised with the reason.'''
+        if self.error:
+            raise ValueError(self.error)
+        if not self.master:
+            return True
+        return self.master.is_compatible(ras)
+
+    def as_json(self):
+        '''Serializes the state as a JSON string.'''
+        return json.dumps({'version': self.version,
+                           'depth': self.depth,
+                           'error': self.error,
+                           'master': (self.master.as_state() if self.master
+                                      else None)})
+
+    @staticmethod
+    def from_json(state_str):
+        '''Deserializes a state made by as_json().'''
+        state = json.loads(state_str,
+                           object_pairs_hook=collections.OrderedDict)
+        master = None
+        if state['master']:
+            master = MasterAvroSchema.from_state(state['master'])
+        return MasterState(state['version'], state['depth'], master,
+                           state['error'])
+
+
+def master_error(err):
+    '''A message for an exception raised making a master.'''
+    msg = err.message if isinstance(err, ValueError) else str(err)
+    return msg if msg else 'Incompatible schema.'
+
 
 def basic_schema_dict_valid(sdict, mas=None):
     '''Checks that a schema dict has the basic required elements.  If a MAS is
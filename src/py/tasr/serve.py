@@ -0,0 +1,126 @@
+'''
+The production server for TASR: the app run in gunicorn's pre-fork server,
+with the settings from tasr.cfg.  Install it with the 'serve' extra (which
+pulls in gunicorn), then run:
+
+    tasr-serve --env standard
+
+or, from the project root without installing the script:
+
+    python src/py/tasr/serve.py --env local
+
+The app is loaded once, in the master process, and the workers are forked
+from it, so they start fast and share the loaded code.  Each worker drops the
+Redis (or sqlite) connections and the threads it inherited right after the
+fork, and opens its own on first use.  The server is tuned in tasr.cfg:
+
+  serve_workers: worker processes (0 means one per CPU core)
+  serve_threads: request threads per worker
+  serve_max_requests: requests a worker handles before it is recycled (plus
+                      up to serve_max_requests_jitter more, so the workers do
+                      not all recycle at once)
+  serve_timeout: seconds a stuck worker gets before it is replaced
+  serve_graceful_timeout: seconds workers get to finish on reload or shutdown
+
+Send the master a HUP for a graceful reload (new workers are forked and the
+old ones finish their requests first) and a TERM to shut down.  As the app is
+preloaded, picking up new TASR code needs a full restart.
+'''
+import sys
+import argparse
+import logging
+import multiprocessing
+import tasr.app_subject
+import tasr.app_wsgi
+from tasr.tasr_config import CONFIG
+from tasr.app import TASR_APP
+
+try:
+    import gunicorn.app.base
+    BaseApplication = gunicorn.app.base.BaseApplication
+except ImportError:
+    gunicorn = None
+    BaseApplication = object
+
+ENV = 'standard'
+THREADS = 1
+
+
+def post_fork(server, worker):
+    '''The gunicorn hook run in each new worker, before it serves.'''
+    tasr.app_wsgi.reset_after_fork()
+    tasr.app_subject.reset_batch_pool()
+
+
+def server_options(config, host=None, port=None, workers=None, threads=None,
+                   pidfile=None):
+    '''Builds the gunicorn settings from a TASRConfig.  Passed values override
+    the config ones.'''
+    host = host if host else config.host
+    port = port if port else config.port
+    workers = workers if workers else config.serve_workers
+    threads = threads if threads else config.serve_threads
+    options = {'bind': '%s:%s' % (host, port),
+               'workers': workers if workers else multiprocessing.cpu_count(),
+               'threads': threads if threads else THREADS,
+               'preload_app': True,
+               'post_fork': post_fork,
+               'max_requests': config.serve_max_requests or 0,
+               'max_requests_jitter': config.serve_max_requests_jitter or 0}
+    if config.serve_timeout:
+        options['timeout'] = config.serve_timeout
+    if config.serve_graceful_timeout:
+        options['graceful_timeout'] = config.serve_graceful_timeout
+    if pidfile:
+        options['pidfile'] = pidfile
+    return options
+
+
+class TASRServer(BaseApplication):
+    '''Runs a WSGI app in gunicorn with the passed settings, rather than ones
+    parsed from the command line or a gunicorn config file.'''
+    def __init__(self, app, options):
+        self.application = app
+        self.options = options
+        super(TASRServer, self).__init__()
+
+    def load_config(self):
+        for (key, val) in self.options.iteritems():
+            self.cfg.set(key, val)
+
+    def load(self):
+        return self.application
+
+
+def main(argv=None):
+    '''Parse the args and run the app in the pre-fork server.'''
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--debug', action='store_true')
+    arg_parser.add_argument('--env', default=ENV)
+    arg_parser.add_argument('--host', default=None)
+    arg_parser.add_argument('--port', type=int, default=None)
+    arg_parser.add_argument('--workers', type=int, default=None)
+    arg_parser.add_argument('--threads', type=int, default=None)
+    arg_parser.add_argument('--pidfile', default=None)
+    args = arg_parser.parse_args(argv)
+
+    if gunicorn is None:
+        sys.stderr.write('tasr-serve needs gunicorn (pip install '
+                         'tasr[serve]).\n')
+        sys.exit(1)
+    CONFIG.set_mode(args.env)
+    log_level = 'DEBUG' if args.debug else CONFIG.log_level
+    try:
+        logging.basicConfig(filename=CONFIG.log_file, level=log_level)
+    except IOError:
+        sys.stderr.write("Cannot write logs to %s.\n" % CONFIG.log_file)
+        sys.exit(1)
+    TASR_APP.set_config_mode(args.env)
+    options = server_options(CONFIG, args.host, args.port, args.workers,
+                             args.threads, args.pidfile)
+    logging.info("Starting TASR_APP with %s workers...", options['workers'])
+    TASRServer(TASR_APP, options).run()
+
+
+if __name__ == "__main__":
+    main()
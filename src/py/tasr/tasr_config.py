@@ -59,6 +59,10 @@ class TASRConfig(object):
         val_str = self._get_str_or_none(key)
         return int(val_str) if val_str else None
 
+    def _get_float_or_none(self, key):
+        val_str = self._get_str_or_none(key)
+        return float(val_str) if val_str else None
+
     def _get_bool_or_none(self, key):
         val_str = self._get_str_or_none(key)
         if val_str:
@@ -89,6 +93,190 @@ class TASRConfig(object):
         '''Gets the Redis port for the daemon.'''
         return self._get_int_or_none('redis_port')
 
+    @property
+    def redis_replicas(self):
+        '''Gets the list of Redis read replicas, each either "<host>:<port>"
+        or a unix socket path.  The config value is whitespace or comma
+        delimited.'''
+        val_str = self._get_str_or_none('redis_replicas')
+        if val_str:
+            return val_str.replace(',', ' ').split()
+        return []
+
+    @property
+    def redis_read_your_writes(self):
+        '''Gets the number of seconds after a write that reads should go to
+        the Redis primary rather than a replica.'''
+        return self._get_float_or_none('redis_read_your_writes')
+
+    @property
+    def storage_backend(self):
+        '''Gets the schema store to use, either "redis" (the default) or
+        "sqlite" for the embedded repository.'''
+        backend = self._get_str_or_none('storage_backend')
+        return backend.lower() if backend else 'redis'
+
+    @property
+    def sqlite_path(self):
+        '''Gets the path to the embedded repository's database file.'''
+        return self._get_str_or_none('sqlite_path')
+
+    @property
+    def sqlite_read_only(self):
+        '''Gets the flag to open the embedded repository read-only.'''
+        return self._get_bool_or_none('sqlite_read_only')
+
+    @property
+    def redis_cluster(self):
+        '''Gets the flag to use the Redis Cluster compatible key layout.'''
+        return self._get_bool_or_none('redis_cluster')
+
+    @property
+    def redis_cluster_nodes(self):
+        '''Gets the list of "<host>:<port>" Redis Cluster startup nodes.  The
+        config value is whitespace or comma delimited.'''
+        val_str = self._get_str_or_none('redis_cluster_nodes')
+        if val_str:
+            return val_str.replace(',', ' ').split()
+        return []
+
+    @property
+    def redis_db(self):
+        '''Gets the Redis db number for the daemon.'''
+        return self._get_int_or_none('redis_db')
+
+    @property
+    def redis_unix_socket_path(self):
+        '''Gets the Redis unix socket path.  If set, it is used instead of the
+        Redis host and port.'''
+        return self._get_str_or_none('redis_unix_socket_path')
+
+    @property
+    def redis_max_connections(self):
+        '''Gets the max number of connections in the Redis connection pool.'''
+        return self._get_int_or_none('redis_max_connections')
+
+    @property
+    def redis_socket_timeout(self):
+        '''Gets the Redis socket timeout, in seconds.'''
+        return self._get_float_or_none('redis_socket_timeout')
+
+    @property
+    def redis_socket_connect_timeout(self):
+        '''Gets the Redis socket connect timeout, in seconds.'''
+        return self._get_float_or_none('redis_socket_connect_timeout')
+
+    @property
+    def redis_socket_keepalive(self):
+        '''Gets the flag to turn on TCP keepalive for Redis connections.'''
+        return self._get_bool_or_none('redis_socket_keepalive')
+
+    @property
+    def schema_cache_entries(self):
+        '''Gets the max number of schemas held in the schema cache.'''
+        return self._get_int_or_none('schema_cache_entries')
+
+    @property
+    def schema_cache_bytes(self):
+        '''Gets the max total size of schemas held in the schema cache.'''
+        return self._get_int_or_none('schema_cache_bytes')
+
+    @property
+    def group_cache_entries(self):
+        '''Gets the max number of groups held in the group cache.'''
+        return self._get_int_or_none('group_cache_entries')
+
+    @property
+    def group_cache_ttl(self):
+        '''Gets the max age, in seconds, of group cache entries.  If this is
+        not set (or is 0), groups are not cached.'''
+        return self._get_int_or_none('group_cache_ttl')
+
+    @property
+    def compat_cache_entries(self):
+        '''Gets the max number of compatibility verdicts held in process.'''
+        return self._get_int_or_none('compat_cache_entries')
+
+    @property
+    def compat_cache_redis(self):
+        '''Gets the flag to share compatibility verdicts through Redis.'''
+        return self._get_bool_or_none('compat_cache_redis')
+
+    @property
+    def batch_threads(self):
+        '''Gets the number of threads used to check batches of schemas.'''
+        return self._get_int_or_none('batch_threads')
+
+    @property
+    def response_cache_entries(self):
+        '''Gets the max number of rendered schema responses to cache.'''
+        return self._get_int_or_none('response_cache_entries')
+
+    @property
+    def response_cache_bytes(self):
+        '''Gets the max total size of the cached schema response bodies.'''
+        return self._get_int_or_none('response_cache_bytes')
+
+    @property
+    def max_list_headers(self):
+        '''Gets the longest list that gets a header per item in list
+        responses.  A negative value removes the limit.'''
+        return self._get_int_or_none('max_list_headers')
+
+    @property
+    def serve_workers(self):
+        '''Gets the number of worker processes tasr-serve forks.  Zero (or
+        unset) means one per CPU core.'''
+        return self._get_int_or_none('serve_workers')
+
+    @property
+    def serve_threads(self):
+        '''Gets the number of request threads in each tasr-serve worker.'''
+        return self._get_int_or_none('serve_threads')
+
+    @property
+    def serve_max_requests(self):
+        '''Gets the number of requests a tasr-serve worker handles before it
+        is recycled (replaced by a fresh fork).  Zero disables recycling.'''
+        return self._get_int_or_none('serve_max_requests')
+
+    @property
+    def serve_max_requests_jitter(self):
+        '''Gets the max random addition to serve_max_requests, so the
+        workers do not all recycle at once.'''
+        return self._get_int_or_none('serve_max_requests_jitter')
+
+    @property
+    def serve_timeout(self):
+        '''Gets the seconds a tasr-serve worker can go silent (stuck on a
+        request) before it is killed and replaced.'''
+        return self._get_int_or_none('serve_timeout')
+
+    @property
+    def serve_graceful_timeout(self):
+        '''Gets the seconds tasr-serve workers get to finish their requests
+        on a reload or shutdown.'''
+        return self._get_int_or_none('serve_graceful_timeout')
+
+    @property
+    def compress_min_bytes(self):
+        '''Gets the size (in bytes) a response body must reach before it is
+        compressed for clients accepting gzip or deflate.  A negative value
+        turns compression off.'''
+        return self._get_int_or_none('compress_min_bytes')
+
+    @property
+    def immutable_max_age(self):
+        '''Gets the Cache-Control max-age (in seconds) for responses that
+        never change, such as a schema looked up by id.'''
+        return self._get_int_or_none('immutable_max_age')
+
+    @property
+    def mutable_max_age(self):
+        '''Gets the Cache-Control max-age (in seconds) for responses that can
+        change, such as the latest schema for a subject.'''
+        return self._get_int_or_none('mutable_max_age')
+
     @property
     def webhdfs_url(self):
         '''Gets the webHDFS url for the daemon.'''
@@ -0,0 +1,353 @@
+'''
+Compatibility validators for the schema versions of a group.  A group's
+validators set holds the names of the ones to apply to a new version:
+
+  'MASTER':   the TASR master schema rules (see MasterAvroSchema), used when
+              a group names no validators
+  'BACKWARD': the new schema, as an Avro reader, must be able to read data
+              written with every earlier version
+  'FORWARD':  every earlier version, as an Avro reader, must be able to read
+              data written with the new schema
+  'FULL':     both BACKWARD and FORWARD
+
+The reader/writer rules are the ones in the "Schema Resolution" section of
+the Avro spec.  Aliases are not considered, as the avro package does not
+resolve them either.
+
+The earlier versions are compiled into a per-field lookup once (and extended
+as versions are added), so a check only has to walk the fields of the new
+schema, not all the fields of all the versions.  A validator is not changed
+once it has been handed out, so extend a copy() of it when shared.
+'''
+import logging
+from tasr.registered_schema import MasterState, master_error
+
+MASTER = 'MASTER'
+BACKWARD = 'BACKWARD'
+FORWARD = 'FORWARD'
+FULL = 'FULL'
+DEFAULT_VALIDATORS = (MASTER, )
+RECORD_TYPES = ('record', 'error')
+NAMED_TYPES = ('record', 'error', 'enum', 'fixed')
+# the writer types a reader type can be promoted from
+PROMOTIONS = {'long': ('int', ),
+              'float': ('int', 'long'),
+              'double': ('int', 'long', 'float'),
+              'string': ('bytes', ),
+              'bytes': ('string', )}
+
+
+def type_name(schema):
+    '''A short name for a schema, for messages.'''
+    if schema.type in NAMED_TYPES:
+        return '%s %s' % (schema.type, schema.fullname)
+    return schema.type
+
+
+def resolution_error(writer, reader, seen=None):
+    '''Returns why data written with the writer schema could not be read with
+    the reader schema (both parsed avro.schema.Schema objects), or None if it
+    can be.  The seen set holds the record name pairs already being checked,
+    so recursive types terminate.'''
+    if seen is None:
+        seen = set()
+    if writer.type == 'union':
+        for branch in writer.schemas:
+            err = resolution_error(branch, reader, seen)
+            if err:
+                return err
+        return None
+    if reader.type == 'union':
+        for branch in reader.schemas:
+            if not resolution_error(writer, branch, seen):
+                return None
+        return '%s is not in the reader union' % type_name(writer)
+    if writer.type != reader.type:
+        if writer.type in PROMOTIONS.get(reader.type, ()):
+            return None
+        return '%s cannot be read as %s' % (type_name(writer),
+                                            type_name(reader))
+    if writer.type in NAMED_TYPES and writer.name != reader.name:
+        return '%s cannot be read as %s' % (type_name(writer),
+                                            type_name(reader))
+    if writer.type == 'fixed' and writer.size != reader.size:
+        return '%s size %s cannot be read as size %s' % (
+            type_name(writer), writer.size, reader.size)
+    if writer.type == 'enum':
+        missing = [sym for sym in writer.symbols
+                   if not sym in reader.symbols]
+        if missing:
+            return '%s symbols %s are missing' % (type_name(reader),
+                                                  ', '.join(missing))
+    if writer.type == 'array':
+        return resolution_error(writer.items, reader.items, seen)
+    if writer.type == 'map':
+        return resolution_error(writer.values, reader.values, seen)
+    if writer.type in RECORD_TYPES:
+        pair = (writer.fullname, reader.fullname)
+        if pair in seen:
+            return None
+        seen.add(pair)
+        w_fields = dict((field.name, field) for field in writer.fields)
+        for r_field in reader.fields:
+            w_field = w_fields.get(r_field.name)
+            if w_field:
+                err = resolution_error(w_field.type, r_field.type, seen)
+                if err:
+                    return 'field %s: %s' % (r_field.name, err)
+            elif not r_field.has_default:
+                return ('field %s is not written and has no default' %
+                        r_field.name)
+    return None
+
+
+class SchemaValidator(object):
+    '''The base validator.  Validators are built empty, have the group's
+    versions added in order, then check candidate schemas as the next version.
+    '''
+    name = None
+
+    def __init__(self):
+        self.version = 0
+        self.latest_id = None
+
+    def copy(self):
+        '''Returns a copy that can be extended without changing this one.'''
+        raise NotImplementedError()
+
+    def add_version(self, ras):
+        '''Compiles a RegisteredAvroSchema in as the next version.'''
+        self.version += 1
+        self.latest_id = ras.sha256_id
+
+    def add_versions(self, versions):
+        '''Compiles a list of versions in, in order.'''
+        for ras in versions:
+            self.add_version(ras)
+        return self
+
+    def check(self, ras):
+        '''Checks a RegisteredAvroSchema as the next version.  Returns an
+        (is_compatible, error) tuple, the error being a message (or None).'''
+        raise NotImplementedError()
+
+
+class MasterValidator(SchemaValidator):
+    '''Applies the master schema rules, using a MasterState.  The repository
+    keeps the state for each group, so this wraps that rather than compiling
+    the versions again.'''
+    name = MASTER
+
+    def __init__(self, state):
+        super(MasterValidator, self).__init__()
+        self.state = state
+        self.version = state.version
+
+    def copy(self):
+        state = self.state
+        return MasterValidator(MasterState(state.version, state.depth,
+                                           state.master, state.error))
+
+    def add_version(self, ras):
+        if not self.state.extend([ras, ]):
+            raise ValueError('Version %s is not compatible with the master.' %
+                             (self.version + 1))
+        super(MasterValidator, self).add_version(ras)
+
+    def check(self, ras):
+        try:
+            return (bool(self.state.check_compatible(ras)), None)
+        except ValueError as err:
+            return (False, master_error(err))
+
+
+class ResolutionValidator(SchemaValidator):
+    '''Compiles the versions for the reader/writer resolution checks.  For
+    record versions, the field types are kept by field name (one of each
+    distinct type), along with how many versions have the field and the
+    names of the fields some version has without a default.  Non-record
+    versions (rare, but valid) are kept whole, as are the versions when the
+    candidate is not a record.
+    '''
+    def __init__(self):
+        super(ResolutionValidator, self).__init__()
+        self.schemas = dict()
+        self.record_names = set()
+        self.record_count = 0
+        self.non_records = dict()
+        self.fields = dict()
+        self.defaultless = set()
+
+    def copy(self):
+        other = self.__class__()
+        other.version = self.version
+        other.latest_id = self.latest_id
+        other.schemas = dict(self.schemas)
+        other.record_names = set(self.record_names)
+        other.record_count = self.record_count
+        other.non_records = dict(self.non_records)
+        other.fields = dict((name, (count, dict(types))) for
+                            (name, (count, types)) in self.fields.iteritems())
+        other.defaultless = set(self.defaultless)
+        return other
+
+    def add_version(self, ras):
+        schema = self.parsed(ras)
+        self.schemas[ras.sha256_id] = schema
+        if schema.type in RECORD_TYPES:
+            self.record_names.add(schema.name)
+            self.record_count += 1
+            for field in schema.fields:
+                (count, types) = self.fields.get(field.name, (0, dict()))
+                types.setdefault(str(field.type), field.type)
+                self.fields[field.name] = (count + 1, types)
+                if not field.has_default:
+                    self.defaultless.add(field.name)
+        else:
+            self.non_records[ras.sha256_id] = schema
+        super(ResolutionValidator, self).add_version(ras)
+
+    @staticmethod
+    def parsed(ras):
+        '''The parsed Avro schema for a RegisteredAvroSchema.'''
+        if ras.schema is None and not ras.validate_schema_str():
+            raise ValueError('Invalid schema.')
+        return ras.schema
+
+    def check(self, ras):
+        if not self.version:
+            return (True, None)
+        try:
+            cand = self.parsed(ras)
+        except Exception as err:
+            return (False, master_error(err))
+        if cand.type in RECORD_TYPES and not self.non_records:
+            err = self.record_error(cand)
+        else:
+            err = None
+            for schema in self.schemas.itervalues():
+                err = self.schema_error(schema, cand)
+                if err:
+                    break
+        if err:
+            return (False, 'Incompatible with an earlier version (%s): %s' %
+                    (self.name, err))
+        return (True, None)
+
+    def record_error(self, cand):
+        '''Checks a record candidate against the compiled fields.'''
+        raise NotImplementedError()
+
+    def schema_error(self, schema, cand):
+        '''Checks a candidate against a whole earlier version.'''
+        raise NotImplementedError()
+
+
+class BackwardValidator(ResolutionValidator):
+    '''The candidate (reader) must read data from every version (writer).  A
+    candidate field some version lacks needs a default, and each distinct
+    type the versions gave a field must resolve to the candidate's type.'''
+    name = BACKWARD
+
+    def record_error(self, cand):
+        for name in self.record_names:
+            if name != cand.name:
+                return 'record %s cannot be read as %s' % (name, cand.name)
+        for field in cand.fields:
+            (count, types) = self.fields.get(field.name, (0, None))
+            if count < self.record_count and not field.has_default:
+                return ('field %s is not in every version and has no '
+                        'default' % field.name)
+            if types:
+                for w_type in types.itervalues():
+                    err = resolution_error(w_type, field.type)
+                    if err:
+                        return 'field %s: %s' % (field.name, err)
+        return None
+
+    def schema_error(self, schema, cand):
+        return resolution_error(schema, cand)
+
+
+class ForwardValidator(ResolutionValidator):
+    '''Every version (reader) must read data from the candidate (writer).  A
+    field some version has without a default must be in the candidate, and
+    the candidate's type for each field must resolve to each distinct type
+    the versions gave it.'''
+    name = FORWARD
+
+    def record_error(self, cand):
+        for name in self.record_names:
+            if name != cand.name:
+                return '%s cannot be read as record %s' % (cand.name, name)
+        cand_names = set()
+        for field in cand.fields:
+            cand_names.add(field.name)
+            (_, types) = self.fields.get(field.name, (0, None))
+            if types:
+                for r_type in types.itervalues():
+                    err = resolution_error(field.type, r_type)
+                    if err:
+                        return 'field %s: %s' % (field.name, err)
+        missing = self.defaultless - cand_names
+        if missing:
+            return ('fields %s have no default in an earlier version' %
+                    ', '.join(sorted(missing)))
+        return None
+
+    def schema_error(self, schema, cand):
+        return resolution_error(cand, schema)
+
+
+class FullValidator(SchemaValidator):
+    '''Both the BACKWARD and the FORWARD checks.'''
+    name = FULL
+
+    def __init__(self, backward=None, forward=None):
+        super(FullValidator, self).__init__()
+        self.backward = backward if backward else BackwardValidator()
+        self.forward = forward if forward else ForwardValidator()
+        self.version = self.backward.version
+        self.latest_id = self.backward.latest_id
+
+    def copy(self):
+        return FullValidator(self.backward.copy(), self.forward.copy())
+
+    def add_version(self, ras):
+        self.backward.add_version(ras)
+        self.forward.add_version(ras)
+        super(FullValidator, self).add_version(ras)
+
+    def check(self, ras):
+        verdict = self.backward.check(ras)
+        if verdict[0]:
+            verdict = self.forward.check(ras)
+        return verdict
+
+
+VALIDATORS = dict((cls.name, cls) for cls in
+                  (MasterValidator, BackwardValidator, ForwardValidator,
+                   FullValidator))
+
+
+def is_validator_name(name):
+    '''Checks that a name is one of the known validators.'''
+    return isinstance(name, basestring) and name.upper() in VALIDATORS
+
+
+def selected_validators(names):
+    '''Returns the sorted tuple of known validator names from a group's
+    validators set, or the default if there are none.  Unknown names (such as
+    Java class names stored by older clients) are skipped with a warning.'''
+    selected = set()
+    for name in names if names else []:
+        if is_validator_name(name):
+            selected.add(name.upper())
+        else:
+            logging.warn('Unknown validator %s skipped.', name)
+    return tuple(sorted(selected)) if selected else DEFAULT_VALIDATORS
+
+
+def new_validator(name, versions):
+    '''Builds and compiles a (non-master) validator for a version list.'''
+    return VALIDATORS[name]().add_versions(versions)
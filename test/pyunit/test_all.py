@@ -14,6 +14,11 @@ from test_client_legacy_object import TestTASRLegacyClientObject
 from test_client_methods import TestTASRClientMethods
 from test_client_object import TestTASRClientObject
 from test_registered_schema import TestRegisteredAvroSchema
+from test_cache import TestLRUCache
+from test_cluster import TestClusterLayout
+from test_embedded import TestEmbedded
+from test_validators import TestValidators
+from test_serve import TestServe
 
 
 if __name__ == "__main__":
@@ -26,4 +31,9 @@ if __name__ == "__main__":
     SUITE = TestLoader().loadTestsFromTestCase(TestTASRLegacyClientMethods)
     SUITE = TestLoader().loadTestsFromTestCase(TestTASRLegacyClientObject)
     SUITE = TestLoader().loadTestsFromTestCase(TestRegisteredAvroSchema)
+    SUITE = TestLoader().loadTestsFromTestCase(TestLRUCache)
+    SUITE = TestLoader().loadTestsFromTestCase(TestClusterLayout)
+    SUITE = TestLoader().loadTestsFromTestCase(TestEmbedded)
+    SUITE = TestLoader().loadTestsFromTestCase(TestValidators)
+    SUITE = TestLoader().loadTestsFromTestCase(TestServe)
     TextTestRunner(verbosity=2).run(SUITE)
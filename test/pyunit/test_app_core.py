@@ -11,7 +11,11 @@ import unittest
 from webtest import TestApp
 import tasr.app
 import StringIO
+import gzip
 import json
+import bottle
+import webob
+import zlib
 import tasr.registered_schema
 
 APP = tasr.app.TASR_APP
@@ -53,6 +57,27 @@ class TestTASRCoreApp(TASRTestCase):
                                      expect_errors=expect_errors,
                                      body=schema_str)
 
+    @staticmethod
+    def raw_get(url, headers):
+        '''GETs without webtest, which decodes compressed bodies.'''
+        return webob.Request.blank(url, headers=headers).get_response(APP)
+
+    ###########################################################################
+    # shared repository
+    ###########################################################################
+    def test_mounted_apps_share_repository(self):
+        '''All mounted apps use one ASR (and so one Redis connection pool)'''
+        APP.set_config_mode('local')
+        for subapp in APP.mounted.values():
+            self.assertIs(APP.ASR, subapp.ASR, u'Unshared ASR.')
+        pool = APP.ASR.redis.connection_pool
+        self.assertEqual(APP.config.redis_max_connections,
+                         pool.max_connections, u'Pool not configured.')
+        # setting the same mode again reuses the ASR
+        asr = APP.ASR
+        APP.set_config_mode('local')
+        self.assertIs(asr, APP.ASR, u'ASR rebuilt for an unchanged mode.')
+
     ###########################################################################
     # /id app
     ###########################################################################
@@ -108,6 +133,199 @@ class TestTASRCoreApp(TASRTestCase):
         self.assertEqual(canonicalized_schema_str, get_resp.body,
                          u'Unexpected body: %s' % get_resp.body)
 
+    def test_lookup_by_sha256_id__not_modified(self):
+        '''GET /tasr/id/<SHA256 ID> - a matching If-None-Match is a 304'''
+        put_resp = self.register_schema(self.event_type, self.schema_str)
+        smeta = SchemaHeaderBot.extract_metadata(put_resp)
+        url = "%s/id/%s" % (self.url_prefix, smeta.sha256_id)
+        get_resp = self.tasr_app.request(url, method='GET')
+        self.abort_diff_status(get_resp, 200)
+        etag = get_resp.headers['ETag']
+        self.assertEqual('"%s"' % smeta.sha256_id, etag)
+        self.assertEqual('public, max-age=%s' % APP.config.immutable_max_age,
+                         get_resp.headers['Cache-Control'])
+        # the sha256 id is in the URL, so Redis is not needed for the 304
+        APP.ASR.redis.flushdb()
+        get_resp = self.tasr_app.request(url, method='GET',
+                                         headers={'If-None-Match': etag})
+        self.abort_diff_status(get_resp, 304)
+        self.assertEqual('', get_resp.body)
+        self.assertEqual(etag, get_resp.headers['ETag'])
+
+    def test_lookup_by_md5_id__not_modified(self):
+        '''GET /tasr/id/<MD5 ID> - a matching If-None-Match is a 304'''
+        put_resp = self.register_schema(self.event_type, self.schema_str)
+        smeta = SchemaHeaderBot.extract_metadata(put_resp)
+        url = "%s/id/%s" % (self.url_prefix, smeta.md5_id)
+        etag = '"%s"' % smeta.sha256_id
+        get_resp = self.tasr_app.request(url, method='GET',
+                                         headers={'If-None-Match': etag})
+        self.abort_diff_status(get_resp, 304)
+        get_resp = self.tasr_app.request(url, method='GET',
+                                         headers={'If-None-Match': '"bob"'})
+        self.abort_diff_status(get_resp, 200)
+
+    def test_lookup_by_sha256_id__not_modified_wildcard(self):
+        '''GET /tasr/id/<SHA256 ID> - "*" only matches a found schema'''
+        put_resp = self.register_schema(self.event_type, self.schema_str)
+        smeta = SchemaHeaderBot.extract_metadata(put_resp)
+        url = "%s/id/%s" % (self.url_prefix, smeta.sha256_id)
+        get_resp = self.tasr_app.request(url, method='GET',
+                                         headers={'If-None-Match': '*'})
+        self.abort_diff_status(get_resp, 304)
+        unreg_schema = tasr.registered_schema.RegisteredAvroSchema()
+        unreg_schema.schema_str = self.schema_str.replace(
+            'tagged.events', 'tagged.events.alt', 1)
+        url = "%s/id/%s" % (self.url_prefix, unreg_schema.sha256_id)
+        get_resp = self.tasr_app.request(url, method='GET',
+                                         headers={'If-None-Match': '*'},
+                                         expect_errors=True)
+        self.abort_diff_status(get_resp, 404)
+
+    def test_lookup_by_sha256_id__rendered_once(self):
+        '''GET /tasr/id/<SHA256 ID> - the body is rendered once, then cached'''
+        put_resp = self.register_schema(self.event_type, self.schema_str)
+        smeta = SchemaHeaderBot.extract_metadata(put_resp)
+        url = "%s/id/%s" % (self.url_prefix, smeta.sha256_id)
+        APP.response_cache.clear()
+        hits = APP.response_cache.hits
+        bodies = []
+        for _ in range(3):
+            get_resp = self.tasr_app.request(url, method='GET')
+            self.abort_diff_status(get_resp, 200)
+            bodies.append(get_resp.body)
+            meta = SchemaHeaderBot.extract_metadata(get_resp)
+            self.assertEqual(smeta.md5_id, meta.md5_id)
+            self.assertEqual(1, meta.group_version(self.event_type))
+        self.assertEqual(put_resp.body, bodies[0])
+        self.assertEqual(1, len(set(bodies)))
+        self.assertEqual(hits + 2, APP.response_cache.hits)
+        # a pretty body is a different rendering
+        get_resp = self.tasr_app.request('%s?pretty' % url, method='GET')
+        self.assertNotEqual(bodies[0], get_resp.body)
+        self.assertEqual(2, len(APP.response_cache))
+
+    def test_lookup_by_sha256_id__gzip(self):
+        '''GET /tasr/id/<SHA256 ID> - gzip is negotiated, cached and tagged'''
+        put_resp = self.register_schema(self.event_type, self.schema_str)
+        smeta = SchemaHeaderBot.extract_metadata(put_resp)
+        url = "%s/id/%s" % (self.url_prefix, smeta.sha256_id)
+        APP.response_cache.clear()
+        headers = {'Accept-Encoding': 'gzip, deflate'}
+        get_resp = self.raw_get(url, headers)
+        self.abort_diff_status(get_resp, 200)
+        self.assertEqual('gzip', get_resp.headers['Content-Encoding'])
+        self.assertIn('Accept-Encoding', get_resp.headers['Vary'])
+        etag = get_resp.headers['ETag']
+        self.assertEqual('"%s-gzip"' % smeta.sha256_id, etag)
+        gz_file = gzip.GzipFile(fileobj=StringIO.StringIO(get_resp.body))
+        self.assertEqual(put_resp.body, gz_file.read())
+        # the plain and the gzip renderings are both cached
+        self.assertEqual(2, len(APP.response_cache))
+        again = self.raw_get(url, headers)
+        self.assertEqual(get_resp.body, again.body)
+        self.assertEqual(2, len(APP.response_cache))
+        # the gzip ETag validates the plain representation too
+        get_resp = self.tasr_app.request(url, method='GET',
+                                         headers={'If-None-Match': etag})
+        self.abort_diff_status(get_resp, 304)
+        self.assertEqual(etag, get_resp.headers['ETag'])
+
+    def test_lookup_by_sha256_id__deflate(self):
+        '''GET /tasr/id/<SHA256 ID> - deflate when gzip is not acceptable'''
+        put_resp = self.register_schema(self.event_type, self.schema_str)
+        smeta = SchemaHeaderBot.extract_metadata(put_resp)
+        url = "%s/id/%s" % (self.url_prefix, smeta.sha256_id)
+        headers = {'Accept-Encoding': 'gzip;q=0, deflate'}
+        get_resp = self.raw_get(url, headers)
+        self.abort_diff_status(get_resp, 200)
+        self.assertEqual('deflate', get_resp.headers['Content-Encoding'])
+        self.assertEqual(put_resp.body, zlib.decompress(get_resp.body))
+
+    def test_lookup_by_sha256_id__small_not_compressed(self):
+        '''GET /tasr/id/<SHA256 ID> - bodies under the threshold are plain'''
+        put_resp = self.register_schema(self.event_type, '"string"')
+        smeta = SchemaHeaderBot.extract_metadata(put_resp)
+        url = "%s/id/%s" % (self.url_prefix, smeta.sha256_id)
+        get_resp = self.raw_get(url, {'Accept-Encoding': 'gzip'})
+        self.abort_diff_status(get_resp, 200)
+        self.assertNotIn('Content-Encoding', get_resp.headers)
+        self.assertEqual(put_resp.body, get_resp.body)
+
+    def test_resolve_schemas(self):
+        '''POST /tasr/schemas/resolve - mixed references, in order'''
+        put_resp = self.register_schema(self.event_type, self.schema_str)
+        smeta = SchemaHeaderBot.extract_metadata(put_resp)
+        refs = [smeta.sha256_id, {'subject': self.event_type, 'version': 1},
+                {'id': smeta.md5_id}, {'subject': self.event_type},
+                {'subject': self.event_type, 'version': 2}, 'bob',
+                {'subject': 'bad name', 'version': 1}, 17]
+        resp = self.tasr_app.request('%s/schemas/resolve' % self.url_prefix,
+                                     method='POST',
+                                     content_type=self.content_type,
+                                     body=json.dumps(refs))
+        self.abort_diff_status(resp, 200)
+        results = json.loads(resp.body)['results']
+        self.assertEqual(len(refs), len(results))
+        for (ref, result) in zip(refs, results):
+            self.assertEqual(ref, result['ref'])
+        for result in results[:4]:
+            self.assertTrue(result['found'])
+            self.assertEqual(None, result['error'])
+            self.assertEqual('id.%s' % smeta.sha256_id, result['sha256_id'])
+            self.assertEqual(put_resp.body, result['schema'])
+            self.assertEqual(1, result['vid.%s' % self.event_type])
+        self.assertFalse(results[4]['found'])
+        self.assertEqual(None, results[4]['error'])
+        for result in results[5:]:
+            self.assertFalse(result['found'])
+            self.assertNotEqual(None, result['error'])
+
+    def test_resolve_schemas__large_body(self):
+        '''POST /tasr/schemas/resolve - a body big enough for bottle to spool
+        it to a temp file'''
+        put_resp = self.register_schema(self.event_type, self.schema_str)
+        smeta = SchemaHeaderBot.extract_metadata(put_resp)
+        refs = [smeta.sha256_id] * 100
+        # JSON whitespace pads the body past bottle's in-memory limit
+        body = json.dumps(refs, indent=bottle.BaseRequest.MEMFILE_MAX / 100)
+        self.assertTrue(len(body) > bottle.BaseRequest.MEMFILE_MAX)
+        resp = self.tasr_app.request('%s/schemas/resolve' % self.url_prefix,
+                                     method='POST',
+                                     content_type=self.content_type,
+                                     body=body)
+        self.abort_diff_status(resp, 200)
+        results = json.loads(resp.body)['results']
+        self.assertEqual(100, len(results))
+        self.assertTrue(all(result['found'] for result in results))
+
+    def test_resolve_schemas__bad_body(self):
+        '''POST /tasr/schemas/resolve - the body must be a JSON list'''
+        url = '%s/schemas/resolve' % self.url_prefix
+        resp = self.tasr_app.request(url, method='POST',
+                                     content_type=self.content_type,
+                                     body='{"id": "bob"}', expect_errors=True)
+        self.abort_diff_status(resp, 400)
+        resp = self.tasr_app.request(url, method='POST',
+                                     content_type=self.content_type,
+                                     body='[', expect_errors=True)
+        self.abort_diff_status(resp, 400)
+
+    def test_cache_stats(self):
+        '''GET /tasr/stats - the cache counters as JSON'''
+        put_resp = self.register_schema(self.event_type, self.schema_str)
+        smeta = SchemaHeaderBot.extract_metadata(put_resp)
+        url = "%s/id/%s" % (self.url_prefix, smeta.sha256_id)
+        self.tasr_app.request(url, method='GET')
+        self.tasr_app.request(url, method='GET')
+        resp = self.tasr_app.request('%s/stats' % self.url_prefix,
+                                     method='GET')
+        self.abort_diff_status(resp, 200)
+        stats = json.loads(resp.body)
+        for name in ('response', 'schema', 'compat', 'parsed'):
+            self.assertIn('hit_rate', stats[name])
+        self.assertTrue(stats['response']['hits'] > 0)
+
     def test_lookup_by_sha256_id_str__bad_id(self):
         '''GET /tasr/id/<id str> - fail on bad ID'''
         resp = self.register_schema(self.event_type, self.schema_str)
@@ -389,6 +607,72 @@ class TestTASRCoreApp(TASRTestCase):
         self.assertListEqual(sorted(sub_dict.keys()), sorted(meta_dict.keys()),
                              'Expected group_names in body to match headers.')
 
+    def test_all_subject_names__paged(self):
+        '''GET /tasr/collection/subjects/all - after and limit'''
+        for name in ('alice', 'bob', 'carol', 'dave'):
+            self.register_subject(name)
+        get_url = '%s/collection/subjects/all' % self.url_prefix
+        resp = self.tasr_app.request('%s?limit=3' % get_url, method='GET')
+        self.abort_diff_status(resp, 200)
+        self.assertListEqual(['alice', 'bob', 'carol'], resp.body.split())
+        self.assertListEqual(['alice', 'bob', 'carol'], sorted(
+            SubjectHeaderBot.extract_metadata(resp).keys()))
+        after = resp.headers[SubjectHeaderBot.H_NEXT_AFTER]
+        self.assertEqual('carol', after)
+        resp = self.tasr_app.request('%s?limit=3&after=%s' %
+                                     (get_url, after), method='GET')
+        self.assertListEqual(['dave'], resp.body.split())
+        self.assertNotIn(SubjectHeaderBot.H_NEXT_AFTER, resp.headers)
+
+    def test_all_subject_names__paged_by_case(self):
+        '''GET /tasr/collection/subjects/all - names differing in case'''
+        for name in ('foo', 'Foo', 'FOO', 'bar'):
+            self.register_subject(name)
+        get_url = '%s/collection/subjects/all' % self.url_prefix
+        names = []
+        after = ''
+        while after is not None:
+            resp = self.tasr_app.request('%s?limit=1&after=%s' %
+                                         (get_url, after), method='GET')
+            self.abort_diff_status(resp, 200)
+            names.extend(resp.body.split())
+            after = resp.headers.get(SubjectHeaderBot.H_NEXT_AFTER)
+        self.assertListEqual(['bar', 'FOO', 'Foo', 'foo'], names)
+
+    def test_active_subject_names__paged(self):
+        '''GET /tasr/collection/subjects/active - inactive subjects skipped'''
+        for name in ('aaa', 'bbb', 'ccc', 'ddd', 'eee'):
+            self.register_subject(name)
+        for name in ('ccc', 'eee'):
+            self.abort_diff_status(self.register_schema(name,
+                                                        self.schema_str), 201)
+        get_url = '%s/collection/subjects/active' % self.url_prefix
+        resp = self.tasr_app.request('%s?limit=1' % get_url, method='GET')
+        self.abort_diff_status(resp, 200)
+        self.assertListEqual(['ccc'], resp.body.split())
+        after = resp.headers[SubjectHeaderBot.H_NEXT_AFTER]
+        self.assertEqual('ccc', after)
+        resp = self.tasr_app.request('%s?limit=1&after=%s' %
+                                     (get_url, after), method='GET')
+        self.abort_diff_status(resp, 200)
+        self.assertListEqual(['eee'], resp.body.split())
+        self.assertNotIn(SubjectHeaderBot.H_NEXT_AFTER, resp.headers)
+        resp = self.tasr_app.request('%s?limit=1&after=aaa' % get_url,
+                                     method='GET')
+        self.assertListEqual(['ccc'], resp.body.split())
+
+    def test_all_subject_names__ndjson(self):
+        '''GET /tasr/collection/subjects/all - a subject dict per line'''
+        self.register_subject('alice')
+        self.register_subject('bob')
+        get_url = '%s/collection/subjects/all?stream' % self.url_prefix
+        resp = self.tasr_app.request(get_url, method='GET')
+        self.abort_diff_status(resp, 200)
+        self.assertEqual('application/x-ndjson', resp.content_type)
+        self.assertListEqual(['alice', 'bob'],
+                             [json.loads(line)['subject_name'] for line in
+                              resp.body.splitlines()])
+
     def test_active_subjects(self):
         '''GET /tasr/collection/subjects/active - gets _active_ subjects (that
         is, ones with at least one schema), as expected'''
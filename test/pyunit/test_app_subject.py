@@ -11,8 +11,11 @@ import unittest
 from webtest import TestApp
 import tasr.app
 import json
+import bottle
 import StringIO
+import gzip
 import requests
+import webob
 
 APP = tasr.app.TASR_APP
 APP.set_config_mode('local')
@@ -234,6 +237,62 @@ class TestTASRSubjectApp(TASRTestCase):
                                  expect_errors=True)
         self.abort_diff_status(resp, 409)
 
+    def test_register_subject_with_validators(self):
+        '''PUT /tasr/subject - validators are applied to new versions'''
+        resp = self.tasr_app.put(self.subject_url,
+                                 {'validators': 'backward'},
+                                 expect_errors=False)
+        self.abort_diff_status(resp, 201)
+        self.assertEqual({}, APP.ASR.lookup_group(self.event_type).config)
+        resp = self.tasr_app.put(self.subject_url,
+                                 {'validators': 'BACKWARD, FORWARD'},
+                                 expect_errors=True)
+        self.abort_diff_status(resp, 409)
+        targ = '{"name": "source__timestamp", "type": "long"}'
+        replacement = '{"name": "source__timestamp", "type": "int"}'
+        resp = self.register_schema(self.event_type,
+                                    self.schema_str.replace(targ,
+                                                            replacement))
+        self.abort_diff_status(resp, 201)
+        # the master rules reject the type change, but an int can be read as
+        # a long, so BACKWARD does not
+        resp = self.register_schema(self.event_type, self.schema_str)
+        self.abort_diff_status(resp, 201)
+
+    def test_non_master_subject_skips_master_rules(self):
+        '''POST /tasr/subject/<subject>/schema - only MASTER subjects get
+        the master rules, so all the endpoints agree for the others'''
+        resp = self.tasr_app.put(self.subject_url,
+                                 {'validators': 'backward'},
+                                 expect_errors=False)
+        self.abort_diff_status(resp, 201)
+        resp = self.register_schema(self.event_type, self.schema_str)
+        self.abort_diff_status(resp, 201)
+        field = ('{"name": "multi", "type": ["null", "int", "string"], '
+                 '"default": null}, ')
+        multi_str = self.schema_str.replace('"fields": [',
+                                            '"fields": [%s' % field, 1)
+        self.assertNotEqual(self.schema_str, multi_str)
+        resp = self.tasr_app.request('%s/schema' % self.subject_url,
+                                     method='POST',
+                                     content_type=self.content_type,
+                                     expect_errors=True, body=multi_str)
+        self.abort_diff_status(resp, 404)
+        resp = self.post_batch('%s/compatibility/batch' % self.subject_url,
+                               [multi_str, ])
+        self.abort_diff_status(resp, 200)
+        result = json.loads(resp.body)['results'][0]
+        self.assertTrue(result['compatible'], result['error'])
+        resp = self.register_schema(self.event_type, multi_str)
+        self.abort_diff_status(resp, 201)
+
+    def test_register_subject_with_unknown_validator(self):
+        '''PUT /tasr/subject - unknown validator names are a 400'''
+        resp = self.tasr_app.put(self.subject_url,
+                                 {'validators': 'com.foo.Validator'},
+                                 expect_errors=True)
+        self.abort_diff_status(resp, 400)
+
     def test_reg_and_rereg_subject(self):
         '''PUT /tasr/subject - registers the subject (not the schema), then
         re-registers the same subject.  The second reg should return a 200.'''
@@ -442,6 +501,144 @@ class TestTASRSubjectApp(TASRTestCase):
         buff.close()
         self.assertListEqual(versions, all_vers, 'Bad versions list.')
 
+    def register_versions(self, count):
+        '''Registers count versions for the subject, returning the bodies.'''
+        versions = []
+        for v in range(1, count + 1):
+            ver_schema_str = self.get_schema_permutation(self.schema_str,
+                                                         "fn_%s" % v)
+            resp = self.register_schema(self.event_type, ver_schema_str)
+            self.abort_diff_status(resp, 201)
+            versions.append(resp.body.strip())
+        return versions
+
+    def test_all_subject_ids__paged(self):
+        '''GET /tasr/subject/<subject>/all_ids - from_version and limit'''
+        self.register_versions(5)
+        url = '%s/all_ids' % self.subject_url
+        all_ids = self.tasr_app.get(url).body.split()
+        resp = self.tasr_app.get('%s?from_version=2&limit=2' % url)
+        self.assertListEqual(all_ids[1:3], resp.body.split())
+        meta = SubjectHeaderBot.extract_metadata(resp)[self.event_type]
+        self.assertListEqual(all_ids[1:3], meta.sha256_id_list)
+        self.assertEqual('4', resp.headers[SubjectHeaderBot.H_NEXT_VERSION])
+        resp = self.tasr_app.get('%s?from_version=4&limit=2' % url)
+        self.assertListEqual(all_ids[3:], resp.body.split())
+        self.assertNotIn(SubjectHeaderBot.H_NEXT_VERSION, resp.headers)
+        resp = self.tasr_app.get('%s?from_version=9' % url)
+        self.assertEqual('', resp.body)
+        resp = self.tasr_app.get('%s?limit=0' % url, expect_errors=True)
+        self.abort_diff_status(resp, 400)
+
+    def test_all_subject_ids__headers_capped(self):
+        '''GET /tasr/subject/<subject>/all_ids - no ID headers for long lists
+        '''
+        self.register_versions(3)
+        url = '%s/all_ids' % self.subject_url
+        mode = APP.config.mode
+        orig_val = APP.config.config.get(mode, 'max_list_headers')
+        APP.config.config.set(mode, 'max_list_headers', '2')
+        try:
+            resp = self.tasr_app.get(url)
+            self.assertEqual(3, len(resp.body.split()))
+            meta = SubjectHeaderBot.extract_metadata(resp)[self.event_type]
+            self.assertEqual(None, meta.sha256_id_list)
+            resp = self.tasr_app.get('%s?limit=2' % url)
+            meta = SubjectHeaderBot.extract_metadata(resp)[self.event_type]
+            self.assertEqual(2, len(meta.sha256_id_list))
+        finally:
+            # reset max_list_headers to its original value
+            APP.config.config.set(mode, 'max_list_headers', orig_val)
+
+    def test_all_subject_schemas__ndjson(self):
+        '''GET /tasr/subject/<subject>/all_schemas - streamed as NDJSON'''
+        versions = self.register_versions(5)
+        url = '%s/all_schemas' % self.subject_url
+        resp = self.tasr_app.get(url, headers={'Accept':
+                                               'application/x-ndjson'})
+        self.assertEqual('application/x-ndjson', resp.content_type)
+        self.assertListEqual(versions, resp.body.splitlines())
+        meta = SubjectHeaderBot.extract_metadata(resp)[self.event_type]
+        self.assertEqual(None, meta.sha256_id_list)
+        resp = self.tasr_app.get('%s?stream&from_version=3' % url)
+        self.assertListEqual(versions[2:], resp.body.splitlines())
+        for line in resp.body.splitlines():
+            self.assertEqual('record', json.loads(line)['type'])
+
+    def test_all_subject_ids__ndjson(self):
+        '''GET /tasr/subject/<subject>/all_ids - a JSON string per line'''
+        self.register_versions(2)
+        url = '%s/all_ids' % self.subject_url
+        all_ids = self.tasr_app.get(url).body.split()
+        resp = self.tasr_app.get('%s?stream' % url)
+        self.assertListEqual(all_ids, [json.loads(line) for line in
+                                       resp.body.splitlines()])
+
+    def test_all_subject_schemas__gzip(self):
+        '''GET /tasr/subject/<subject>/all_schemas - compressed on request'''
+        for v in range(1, 5):
+            ver_schema_str = self.get_schema_permutation(self.schema_str,
+                                                         "fn_%s" % v)
+            resp = self.register_schema(self.event_type, ver_schema_str)
+            self.abort_diff_status(resp, 201)
+        url = '%s/all_schemas' % self.subject_url
+        plain = self.tasr_app.get(url)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        # webtest decodes compressed bodies, so go to the app directly
+        req = webob.Request.blank(url, headers={'Accept-Encoding': 'gzip'})
+        resp = req.get_response(APP)
+        self.assertEqual('gzip', resp.headers['Content-Encoding'])
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertTrue(len(resp.body) < len(plain.body))
+        gz_file = gzip.GzipFile(fileobj=StringIO.StringIO(resp.body))
+        self.assertEqual(plain.body, gz_file.read())
+
+    def test_lookup_latest_many(self):
+        '''POST /tasr/subjects/latest - latest schemas for many subjects'''
+        self.register_versions(2)
+        alt_resp = self.register_schema('alt', self.schema_str)
+        self.abort_diff_status(alt_resp, 201)
+        self.register_subject('bare')
+        latest = self.tasr_app.get('%s/latest' % self.subject_url)
+        url = '%s/subjects/latest' % self.url_prefix
+        names = [self.event_type, 'alt', 'bare', 'bob']
+        resp = self.tasr_app.request(url, method='POST',
+                                     content_type=self.content_type,
+                                     body=json.dumps(names))
+        self.abort_diff_status(resp, 200)
+        body = json.loads(resp.body)
+        self.assertListEqual(sorted(names), sorted(body.keys()))
+        gold = body[self.event_type]
+        self.assertEqual(2, gold['current_schema_version'])
+        self.assertEqual(latest.body, gold['schema'])
+        self.assertEqual(
+            latest.headers[SchemaHeaderBot.H_SHA256],
+            gold['current_schema_sha256_id'])
+        self.assertEqual(1, body['alt']['current_schema_version'])
+        self.assertEqual(None, body['bare'])
+        self.assertEqual(None, body['bob'])
+        metas = SubjectHeaderBot.extract_metadata(resp)
+        self.assertEqual(2, metas[self.event_type].current_version)
+
+    def test_get_latest_many(self):
+        '''GET /tasr/subjects/latest - subjects as repeated query args'''
+        self.register_versions(1)
+        url = '%s/subjects/latest?subject=%s&subject=bob' % (self.url_prefix,
+                                                             self.event_type)
+        resp = self.tasr_app.get(url)
+        self.abort_diff_status(resp, 200)
+        body = json.loads(resp.body)
+        self.assertEqual(1, body[self.event_type]['current_schema_version'])
+        self.assertEqual(None, body['bob'])
+        self.assertEqual('public, max-age=%s' % APP.config.mutable_max_age,
+                         resp.headers['Cache-Control'])
+        resp = self.tasr_app.get('%s/subjects/latest' % self.url_prefix,
+                                 expect_errors=True)
+        self.abort_diff_status(resp, 400)
+        resp = self.tasr_app.get('%s/subjects/latest?subject=a-b' %
+                                 self.url_prefix, expect_errors=True)
+        self.abort_diff_status(resp, 400)
+
     ###########################################################################
     # schema tests
     ###########################################################################
@@ -700,6 +897,53 @@ class TestTASRSubjectApp(TASRTestCase):
             self.assertEqual(schemas[v - 1], get_resp.body,
                              u'Unexpected body: %s' % get_resp.body)
 
+    def test_lookup_by_subject_and_version_not_modified(self):
+        '''GET /tasr/subject/<subject>/version/<version> - ETag and 304'''
+        resp = self.register_schema(self.event_type, self.schema_str)
+        self.abort_diff_status(resp, 201)
+        meta = SchemaHeaderBot.extract_metadata(resp)
+        get_url = '%s/version/1' % self.subject_url
+        get_resp = self.tasr_app.request(get_url, method='GET')
+        self.abort_diff_status(get_resp, 200)
+        etag = get_resp.headers['ETag']
+        self.assertEqual('"%s"' % meta.sha256_id, etag)
+        self.assertEqual('public, max-age=%s' % APP.config.immutable_max_age,
+                         get_resp.headers['Cache-Control'])
+        get_resp = self.tasr_app.request(get_url, method='GET',
+                                         headers={'If-None-Match': etag})
+        self.abort_diff_status(get_resp, 304)
+        self.assertEqual('', get_resp.body)
+
+    def test_lookup_by_subject_and_latest_version_short_max_age(self):
+        '''GET /tasr/subject/<subject>/version/-1 - short max-age'''
+        resp = self.register_schema(self.event_type, self.schema_str)
+        self.abort_diff_status(resp, 201)
+        get_resp = self.tasr_app.request('%s/version/-1' % self.subject_url,
+                                         method='GET')
+        self.abort_diff_status(get_resp, 200)
+        self.assertEqual('public, max-age=%s' % APP.config.mutable_max_age,
+                         get_resp.headers['Cache-Control'])
+
+    def test_lookup_latest_short_max_age(self):
+        '''GET /tasr/subject/<subject>/latest - short max-age, new ETag'''
+        resp = self.register_schema(self.event_type, self.schema_str)
+        self.abort_diff_status(resp, 201)
+        get_url = '%s/latest' % self.subject_url
+        get_resp = self.tasr_app.request(get_url, method='GET')
+        self.assertEqual('public, max-age=%s' % APP.config.mutable_max_age,
+                         get_resp.headers['Cache-Control'])
+        etag = get_resp.headers['ETag']
+        get_resp = self.tasr_app.request(get_url, method='GET',
+                                         headers={'If-None-Match': etag})
+        self.abort_diff_status(get_resp, 304)
+        schema_str_2 = self.get_schema_permutation(self.schema_str)
+        resp = self.register_schema(self.event_type, schema_str_2)
+        self.abort_diff_status(resp, 201)
+        get_resp = self.tasr_app.request(get_url, method='GET',
+                                         headers={'If-None-Match': etag})
+        self.abort_diff_status(get_resp, 200)
+        self.assertNotEqual(etag, get_resp.headers['ETag'])
+
     def test_fail_lookup_for_subject_and_version_on_bad_version(self):
         '''GET /tasr/subject/<subject>/version/<version> - fail on bad ver'''
         resp = self.register_schema(self.event_type, self.schema_str)
@@ -823,6 +1067,7 @@ class TestTASRSubjectApp(TASRTestCase):
         # grab the master and check that all the expected fields are there
         resp = self.tasr_app.get('%s/master' % self.subject_url)
         self.abort_diff_status(resp, 200)
+        self.assertEqual('3', SubjectHeaderBot.extract('H_MASTER_DEPTH', resp))
         master_fnames = []
         for mfield in json.loads(resp.body)['fields']:
             master_fnames.append(mfield['name'])
@@ -869,6 +1114,9 @@ class TestTASRSubjectApp(TASRTestCase):
                                           expect_errors=True,
                                           body=None)
             self.abort_diff_status(resp2, 409)
+            # the incompatible first version is not in the master
+            self.assertEqual('3', SubjectHeaderBot.extract('H_MASTER_DEPTH',
+                                                           resp2))
             master_fnames = []
             for mfield in json.loads(resp2.body)['fields']:
                 master_fnames.append(mfield['name'])
@@ -885,6 +1133,46 @@ class TestTASRSubjectApp(TASRTestCase):
             # reset expose_force_register to its original value
             APP.config.config.set(mode, 'expose_force_register', orig_val)
 
+    def test_master_schema_depth(self):
+        '''GET /tasr/subject/<subject>/master - the depth header'''
+        mode = APP.config.mode
+        orig_val = APP.config.config.get(mode, 'expose_force_register')
+        APP.config.config.set(mode, 'expose_force_register', 'True')
+        try:
+            targ = '{"name": "source__timestamp", "type": "long"}'
+            replacement = '{"name": "source__timestamp", "type": "int"}'
+            incompat_schema_str = self.schema_str.replace(targ, replacement, 1)
+            # a compatible history for bob: the master covers every version
+            for v in range(1, 4):
+                ver_schema_str = self.get_schema_permutation(self.schema_str,
+                                                             "fn_%s" % v)
+                resp = self.register_schema('bob', ver_schema_str)
+                self.abort_diff_status(resp, 201)
+            resp = self.tasr_app.get('%s/subject/bob/master' %
+                                     self.url_prefix)
+            self.abort_diff_status(resp, 200)
+            self.assertEqual('3', resp.headers['X-TASR-SUBJECT-MASTER-DEPTH'])
+            # a break at version 2: the master only covers versions 2 and 3
+            reg_url = '%s/force_register' % self.subject_url
+            for schema_str in (self.schema_str, incompat_schema_str,
+                               self.get_schema_permutation(incompat_schema_str,
+                                                           "fn_1")):
+                resp = self.tasr_app.request(reg_url, method='PUT',
+                                             content_type=self.content_type,
+                                             body=schema_str)
+                self.abort_diff_status(resp, 201)
+            resp = self.tasr_app.get('%s/master' % self.subject_url,
+                                     expect_errors=True)
+            self.abort_diff_status(resp, 409)
+            depth = int(resp.headers['X-TASR-SUBJECT-MASTER-DEPTH'])
+            self.assertEqual(2, depth)
+            resp = self.tasr_app.get('%s/latest' % self.subject_url)
+            meta = SchemaHeaderBot.extract_metadata(resp)
+            self.assertTrue(depth < meta.group_version(self.event_type))
+        finally:
+            # reset expose_force_register to its original value
+            APP.config.config.set(mode, 'expose_force_register', orig_val)
+
     def test_hdfs_master_schema_for_subject(self):
         '''GET /tasr/subject/<subject>/master - as expected, check hdfs'''
         mode = APP.config.mode
@@ -926,6 +1214,93 @@ class TestTASRSubjectApp(TASRTestCase):
             # reset expose_force_register to its original value
             APP.config.config.set(mode, 'push_masters_to_hdfs', orig_val)
 
+    def post_batch(self, url, body, expect_errors=False):
+        return self.tasr_app.request(url, method='POST',
+                                     content_type=self.content_type,
+                                     expect_errors=expect_errors,
+                                     body=json.dumps(body))
+
+    def test_compatibility_batch(self):
+        '''POST /tasr/subject/<subject>/compatibility/batch - as expected'''
+        resp = self.register_schema(self.event_type, self.schema_str)
+        self.abort_diff_status(resp, 201)
+        compat_str = self.get_schema_permutation(self.schema_str)
+        targ = '{"name": "source__timestamp", "type": "long"}'
+        replacement = '{"name": "source__timestamp", "type": "int"}'
+        incompat_str = self.schema_str.replace(targ, replacement, 1)
+        candidates = [compat_str, json.loads(compat_str), incompat_str,
+                      '%s }' % self.schema_str]
+        resp = self.post_batch('%s/compatibility/batch' % self.subject_url,
+                               candidates)
+        self.abort_diff_status(resp, 200)
+        body = json.loads(resp.body)
+        self.assertEqual(self.event_type, body['subject'])
+        results = body['results']
+        self.assertEqual(4, len(results))
+        self.assertEqual([True, True, False, False],
+                         [res['compatible'] for res in results])
+        self.assertEqual(None, results[0]['error'])
+        self.assertEqual(results[0]['sha256_id'], results[1]['sha256_id'])
+        self.assertTrue(results[0]['md5_id'])
+        self.assertTrue(results[2]['error'])
+        self.assertTrue(results[2]['sha256_id'])
+        self.assertTrue(results[3]['error'].startswith('Invalid schema'))
+        self.assertEqual(None, results[3]['sha256_id'])
+        # the verdicts match the single candidate lookups
+        resp = self.tasr_app.request('%s/schema' % self.subject_url,
+                                     method='POST',
+                                     content_type=self.content_type,
+                                     expect_errors=True, body=incompat_str)
+        self.abort_diff_status(resp, 409)
+
+    def test_compatibility_batch__large_body(self):
+        '''POST /tasr/subject/<subject>/compatibility/batch - a body big
+        enough for bottle to spool it to a temp file'''
+        resp = self.register_schema(self.event_type, self.schema_str)
+        self.abort_diff_status(resp, 201)
+        candidates = [self.schema_str] * 100
+        self.assertTrue(len(json.dumps(candidates)) >
+                        bottle.BaseRequest.MEMFILE_MAX)
+        resp = self.post_batch('%s/compatibility/batch' % self.subject_url,
+                               candidates)
+        self.abort_diff_status(resp, 200)
+        results = json.loads(resp.body)['results']
+        self.assertEqual(100, len(results))
+        self.assertTrue(all(res['compatible'] for res in results))
+
+    def test_compatibility_batch_cross_subject(self):
+        '''POST /tasr/subject/compatibility/batch - as expected'''
+        resp = self.register_schema(self.event_type, self.schema_str)
+        self.abort_diff_status(resp, 201)
+        targ = '{"name": "source__timestamp", "type": "long"}'
+        replacement = '{"name": "source__timestamp", "type": "int"}'
+        incompat_str = self.schema_str.replace(targ, replacement, 1)
+        body = {self.event_type: [incompat_str, self.schema_str],
+                'bob': [incompat_str]}
+        resp = self.post_batch('%s/subject/compatibility/batch' %
+                               self.url_prefix, body)
+        self.abort_diff_status(resp, 200)
+        results = json.loads(resp.body)
+        self.assertEqual(set([self.event_type, 'bob']), set(results.keys()))
+        self.assertEqual([False, True], [res['compatible'] for res in
+                                         results[self.event_type]])
+        # no versions yet, so anything valid is compatible
+        self.assertTrue(results['bob'][0]['compatible'])
+
+    def test_fail_compatibility_batch_on_bad_body(self):
+        '''POST /tasr/subject/<subject>/compatibility/batch - bad bodies'''
+        url = '%s/compatibility/batch' % self.subject_url
+        resp = self.post_batch(url, {'not': 'a list'}, expect_errors=True)
+        self.abort_diff_status(resp, 400)
+        resp = self.tasr_app.request(url, method='POST',
+                                     content_type=self.content_type,
+                                     expect_errors=True, body='[ oops')
+        self.abort_diff_status(resp, 400)
+        resp = self.post_batch('%s/subject/compatibility/batch' %
+                               self.url_prefix, {'gold': 'not a list'},
+                               expect_errors=True)
+        self.abort_diff_status(resp, 400)
+
 
 if __name__ == "__main__":
     SUITE = unittest.TestLoader().loadTestsFromTestCase(TestTASRSubjectApp)
@@ -224,6 +224,20 @@ class TestTASRTopicApp(TASRTestCase):
         smeta = SchemaHeaderBot.extract_metadata(get_resp)
         self.assertEqual(1, smeta.group_version(self.event_type), 'bad ver')
 
+    def test_get_for_version_cache_control(self):
+        '''GET /tasr/topic/<topic name>/version/<version> - max-ages'''
+        put_resp = self.register_schema(self.schema_str)
+        self.abort_diff_status(put_resp, 201)
+        get_resp = self.tasr_app.request('%s/version/1' % self.topic_url,
+                                         method='GET')
+        self.assertEqual('public, max-age=%s' % APP.config.immutable_max_age,
+                         get_resp.headers['Cache-Control'])
+        get_resp = self.tasr_app.request('%s/version/-1' % self.topic_url,
+                                         method='GET')
+        self.abort_diff_status(get_resp, 200)
+        self.assertEqual('public, max-age=%s' % APP.config.mutable_max_age,
+                         get_resp.headers['Cache-Control'])
+
 
 if __name__ == "__main__":
     SUITE = unittest.TestLoader().loadTestsFromTestCase(TestTASRTopicApp)
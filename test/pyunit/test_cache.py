@@ -0,0 +1,77 @@
+from tasr_test import TASRTestCase
+
+import unittest
+import time
+from tasr.cache import LRUCache, deep_size
+
+
+class TestLRUCache(TASRTestCase):
+
+    def test_get_and_put(self):
+        '''get(), put() - as expected'''
+        cache = LRUCache(10)
+        cache.put('a', 1)
+        self.assertEqual(1, cache.get('a'), 'expected cached value')
+        self.assertEqual(None, cache.get('b'), 'expected a miss')
+        self.assertEqual(1, cache.hits, 'expected one hit')
+        self.assertEqual(1, cache.misses, 'expected one miss')
+
+    def test_evict_on_entries(self):
+        '''put() - least recently used entry evicted at max_entries'''
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')  # makes 'b' the least recently used
+        cache.put('c', 3)
+        self.assertIn('a', cache, 'recently used entry evicted')
+        self.assertNotIn('b', cache, 'least recently used entry retained')
+        self.assertEqual(2, len(cache), 'expected 2 entries')
+
+    def test_evict_on_bytes(self):
+        '''put() - entries evicted to stay within max_bytes'''
+        cache = LRUCache(10, max_bytes=10)
+        cache.put('a', 'a', 6)
+        cache.put('b', 'b', 6)
+        self.assertNotIn('a', cache, 'expected oldest entry evicted')
+        self.assertEqual(6, cache.total_bytes, 'bad byte count')
+        cache.put('c', 'c', 11)
+        self.assertNotIn('c', cache, 'oversized entry should not be added')
+
+    def test_disabled(self):
+        '''put() - a cache with no entries allowed holds nothing'''
+        cache = LRUCache(0)
+        cache.put('a', 1)
+        self.assertFalse(cache.enabled, 'expected a disabled cache')
+        self.assertEqual(None, cache.get('a'), 'expected a miss')
+
+    def test_ttl(self):
+        '''get() - entries older than the ttl are misses'''
+        cache = LRUCache(10, ttl=0.05)
+        cache.put('a', 1, 4)
+        self.assertEqual(1, cache.get('a'), 'expected a hit')
+        time.sleep(0.06)
+        self.assertEqual(None, cache.get('a'), 'expected an expired miss')
+        self.assertEqual(0, cache.total_bytes, 'expired bytes not released')
+
+    def test_pop_if(self):
+        '''pop_if() - only matching entries are removed'''
+        cache = LRUCache(10)
+        for (key, val) in (('a', 1), ('b', 2), ('c', 3)):
+            cache.put(key, val, 1)
+        self.assertEqual(2, cache.pop_if(lambda val: val > 1))
+        self.assertIn('a', cache, 'non-matching entry removed')
+        self.assertEqual(1, len(cache), 'expected 1 entry')
+        self.assertEqual(1, cache.total_bytes, 'bad byte count')
+
+    def test_deep_size(self):
+        '''deep_size() - counts what an object refers to, once'''
+        val = 'x' * 1000
+        self.assertTrue(deep_size([val]) > 1000)
+        self.assertTrue(deep_size({'a': [val]}) > deep_size([val]))
+        self.assertTrue(deep_size([val, val]) < deep_size([val, val + 'y']))
+        self.assertTrue(deep_size(LRUCache) < 1000)
+
+
+if __name__ == "__main__":
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(TestLRUCache)
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
@@ -341,6 +341,35 @@ class TestTASRClientObject(TestTASRAppClient):
         self.assertEqual(1, rs.current_version(self.event_type),
                         'Expected different current version value.')
 
+    def test_obj_lookup_latest_many(self):
+        '''TASRClientSV.lookup_latest_many() - many subjects in one request'''
+        self.obj_register_schema_skeleton(self.schema_str)
+        rs2 = self.obj_register_schema_skeleton(
+            self.get_schema_permutation(self.schema_str, "fn_2"))
+        with httmock.HTTMock(self.route_to_testapp):
+            client = tasr.client.TASRClientSV(self.host, self.port)
+            client.register_subject('bare')
+            schemas = client.lookup_latest_many([self.event_type, 'bare'])
+            self.assertEqual({self.event_type: rs2, 'bare': None}, schemas)
+            self.assertEqual(2, schemas[self.event_type].current_version(
+                self.event_type))
+
+    def test_obj_resolve_schemas(self):
+        '''TASRClientSV.resolve_schemas() - ids and versions in one request'''
+        rs1 = self.obj_register_schema_skeleton(self.schema_str)
+        rs2 = self.obj_register_schema_skeleton(
+            self.get_schema_permutation(self.schema_str, "fn_2"))
+        with httmock.HTTMock(self.route_to_testapp):
+            client = tasr.client.TASRClientSV(self.host, self.port)
+            schemas = client.resolve_schemas([rs2.sha256_id,
+                                              (self.event_type, 1),
+                                              rs1.md5_id,
+                                              (self.event_type, 3)])
+            self.assertListEqual([rs2, rs1, rs1, None], schemas)
+            self.assertEqual(2, schemas[0].current_version(self.event_type))
+            self.assertRaises(tasr.client.TASRError, client.resolve_schemas,
+                              ['bob'])
+
     def test_obj_lookup_by_sha256_id_str(self):
         '''TASRClientSV.lookup_by_id_str() - multiple versions, as expected'''
         sha256_ids = []
@@ -0,0 +1,76 @@
+import unittest
+import redis
+import tasr
+import test_tasr
+from tasr.cluster import ClusterAvroSchemaRepository, migrate_to_cluster_layout
+
+APP = test_tasr.APP
+
+
+def cluster_asr(**kwargs):
+    '''A single Redis node can hold the cluster layout, so we test the
+    slot-local scripts and the client-side fan-out against the test Redis.'''
+    client = redis.StrictRedis(host=APP.config.redis_host,
+                               port=APP.config.redis_port)
+    return ClusterAvroSchemaRepository(redis_client=client, **kwargs)
+
+
+class TestClusterLayout(test_tasr.TestTASR):
+    '''Runs all the repository tests against the cluster layout, plus a few
+    layout-specific ones.'''
+
+    def setUp(self):
+        super(TestClusterLayout, self).setUp()
+        self.asr = cluster_asr()
+
+    def group_cache_asr(self, ttl=30):
+        return cluster_asr(group_cache_ttl=ttl)
+
+    def compat_redis_asr(self):
+        return cluster_asr(compat_cache_redis=True)
+
+    def replica_asr(self, read_your_writes=0):
+        pools = [tasr.create_connection_pool(host=APP.config.redis_host,
+                                             port=APP.config.redis_port)
+                 for _ in range(2)]
+        return cluster_asr(replica_pools=pools,
+                           read_your_writes=read_your_writes)
+
+    def test_group_keys_hash_tagged(self):
+        '''register_schema() - group keys share the group's hash tag'''
+        rs = self.asr.register_schema(self.event_type, self.schema_str)
+        for key in ('g.{gold}', 'vid.{gold}', 'vts.{gold}', 'topic.{gold}',
+                    'id.%s' % rs.sha256_id, 'id.%s' % rs.md5_id):
+            self.assertTrue(self.asr.redis.exists(key), u'No %s key.' % key)
+        self.assertFalse(self.asr.redis.exists('vid.gold'),
+                         u'Untagged group key added.')
+        self.assertEqual(1, rs.current_version(self.event_type))
+
+    def test_register_repairs_missing_version_fields(self):
+        '''register_schema() - a retry sets fields a failed call missed'''
+        rs = self.asr.register_schema(self.event_type, self.schema_str)
+        sha256_key = 'id.%s' % rs.sha256_id
+        self.asr.redis.hdel(sha256_key, 'vid.gold', 'vts.gold')
+        rs2 = self.asr.register_schema(self.event_type, self.schema_str)
+        self.assertEqual(1, rs2.current_version(self.event_type))
+        self.assertEqual(1, self.asr.redis.llen('vid.{gold}'),
+                         u'The retry should not add a version.')
+
+    def test_migrate_to_cluster_layout(self):
+        '''migrate_to_cluster_layout() - standard layout keys are renamed'''
+        std_asr = tasr.AvroSchemaRepository(host=APP.config.redis_host,
+                                            port=APP.config.redis_port)
+        rs = std_asr.register_schema(self.event_type, self.schema_str)
+        std_asr.register_group('bob')
+        self.assertEqual(2, migrate_to_cluster_layout(self.asr.redis))
+        self.assertFalse(self.asr.redis.exists('vid.gold'))
+        self.assertEqual(rs, self.asr.get_latest_schema_for_group('gold'))
+        self.assertEqual(['bob', 'gold'],
+                         [g.name for g in self.asr.get_all_groups()])
+        # a second run has nothing to do
+        self.assertEqual(0, migrate_to_cluster_layout(self.asr.redis))
+
+
+if __name__ == "__main__":
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(TestClusterLayout)
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
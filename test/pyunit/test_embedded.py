@@ -0,0 +1,94 @@
+import unittest
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import test_tasr
+from tasr_test import TASRTestCase
+from tasr.embedded import SqliteAvroSchemaRepository
+
+# these tests check the Redis keys or Redis-only features directly
+REDIS_ONLY_TESTS = ['test_non_sequential_rereg_lists_aligned',
+                    'test_legacy_topic_list_matches_vid_list',
+                    'test_group_index_maintained',
+                    'test_rebuild_group_index',
+                    'test_prune_group_index',
+                    'test_group_cache_invalidated_by_register',
+                    'test_group_cache_invalidated_by_metadata_change',
+                    'test_group_cache_invalidated_by_cross_registration',
+                    'test_group_cache_invalidated_by_delete',
+                    'test_group_cache_ttl',
+                    'test_group_cache_disabled_without_ttl',
+                    'test_reads_round_robin_across_replicas',
+                    'test_read_your_writes',
+                    'test_compat_verdict_shared_through_redis',
+                    'test_after_fork_restarts_listener']
+
+
+class TestEmbedded(test_tasr.TestTASR):
+    '''Runs the repository tests against the embedded sqlite repository, plus
+    a few embedded-specific ones.  No Redis is needed.'''
+
+    def setUp(self):
+        self.event_type = "gold"
+        fix_rel_path = "schemas/%s.avsc" % (self.event_type)
+        self.avsc_file = TASRTestCase.get_fixture_file(fix_rel_path, "r")
+        self.schema_str = self.avsc_file.read()
+        self.schema_version = 0
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'tasr.db')
+        self.asr = SqliteAvroSchemaRepository(self.db_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_wal_mode(self):
+        '''readers should not block on the writer'''
+        mode = self.asr.connection().execute('PRAGMA journal_mode')
+        self.assertEqual('wal', mode.fetchone()[0].lower())
+
+    def test_persists_across_instances(self):
+        '''a second repository on the same file sees the registrations'''
+        rs = self.asr.register_schema(self.event_type, self.schema_str)
+        asr2 = SqliteAvroSchemaRepository(self.db_path)
+        self.assertEqual(rs, asr2.get_latest_schema_for_group(self.event_type))
+        self.assertEqual(rs, asr2.get_schema_for_id_str(rs.md5_id))
+
+    def test_read_only(self):
+        '''a read-only repository serves reads and rejects writes'''
+        rs = self.asr.register_schema(self.event_type, self.schema_str)
+        ro_asr = SqliteAvroSchemaRepository(self.db_path, read_only=True)
+        self.assertEqual(rs, ro_asr.get_schema_for_id_str(rs.sha256_id))
+        self.assertEqual(1, len(ro_asr.get_active_groups()))
+        self.assertRaises(sqlite3.OperationalError, ro_asr.register_group,
+                          'bob')
+
+    def test_register_from_threads(self):
+        '''each thread gets its own connection, and versions do not collide'''
+        schema_strs = [self.schema_str.replace('tagged.events',
+                                               'tagged.events.%s' % i, 1)
+                       for i in range(8)]
+        threads = [threading.Thread(target=self.asr.register_schema,
+                                    args=(self.event_type, schema_str))
+                   for schema_str in schema_strs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        versions = self.asr.get_schema_versions_for_group(self.event_type)
+        self.assertEqual(8, len(versions))
+        self.assertEqual(range(1, 9),
+                         [rs.current_version(self.event_type)
+                          for rs in versions])
+
+
+for test_name in REDIS_ONLY_TESTS:
+    setattr(TestEmbedded, test_name,
+            unittest.skip('Redis only')(getattr(test_tasr.TestTASR,
+                                                test_name)))
+
+
+if __name__ == "__main__":
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(TestEmbedded)
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
@@ -9,7 +9,11 @@ from tasr_test import TASRTestCase
 import unittest
 import logging
 import json
+import avro.schema
+import tasr.registered_schema
 from tasr.registered_schema import RegisteredAvroSchema, MasterAvroSchema
+from tasr.registered_schema import ordered_object, canonical_json_str
+from tasr.registered_schema import MasterState
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -31,6 +35,105 @@ class TestRegisteredAvroSchema(TASRTestCase):
         ras.schema_str = self.schema_str
         self.assertEqual(self.expect_sha256_id, ras.sha256_id, 'unexpected ID')
 
+    def test_derived_fields_memoized(self):
+        '''The canonical string and ids are worked out once.'''
+        ras = RegisteredAvroSchema()
+        ras.schema_str = self.schema_str
+        canonical = ras.canonical_schema_str
+        self.assertIs(canonical, ras.canonical_schema_str,
+                      'expected the same canonical string object')
+        self.assertIs(ras.sha256_id_bytes, ras.sha256_id_bytes,
+                      'expected the same id bytes object')
+        self.assertIs(ras.md5_id, ras.md5_id, 'expected the same id object')
+        self.assertFalse(hasattr(ras, '__dict__'), 'expected __slots__ only')
+
+    def test_derived_fields_reset_on_schema_str(self):
+        '''Assigning the schema_str drops the old derived values.'''
+        ras = RegisteredAvroSchema()
+        ras.schema_str = self.schema_str
+        self.assertTrue(ras.validate_schema_str())
+        old_md5_id = ras.md5_id
+        ras.schema_str = self.get_schema_permutation(self.schema_str)
+        self.assertEqual(None, ras.schema, 'expected parsed schema dropped')
+        self.assertNotEqual(self.expect_sha256_id, ras.sha256_id,
+                            'stale sha256 id')
+        self.assertNotEqual(old_md5_id, ras.md5_id, 'stale md5 id')
+        self.assertIn('"extra"', ras.canonical_schema_str)
+
+    def test_copy_schema_from_shares_derived_fields(self):
+        '''A copy reuses the digests already worked out by the original.'''
+        ras = RegisteredAvroSchema()
+        ras.schema_str = self.schema_str
+        self.assertEqual(self.expect_sha256_id, ras.sha256_id, 'unexpected ID')
+        copy = RegisteredAvroSchema()
+        copy.copy_schema_from(ras)
+        self.assertIs(ras.sha256_id, copy.sha256_id)
+        self.assertIs(ras.canonical_schema_str, copy.canonical_schema_str)
+
+    def canonical_corpus(self):
+        '''The fixture schemas, plus some with the harder JSON bits (unicode,
+        floats, nested and empty objects, arrays of objects) and whitespace
+        or key order changes.'''
+        corpus = []
+        for name in ('gold', 'envelope', 'skeleton', 'unreadable_event'):
+            fix_rel_path = "schemas/%s.avsc" % name
+            corpus.append(TASRTestCase.get_fixture_file(fix_rel_path,
+                                                        "r").read())
+        corpus.append(self.get_schema_permutation(self.schema_str))
+        corpus.append(json.dumps(json.loads(self.schema_str), indent=7))
+        corpus.append(u'{"type": "record", "name": "caf\u00e9", "doc": '
+                      u'"na\u00efve \\"q\\"", "fields": [{"name": "f", '
+                      u'"type": "double", "default": 1.1}, {"name": "g", '
+                      u'"type": {"type": "map", "values": "long"}, '
+                      u'"default": {}}, {"name": "h", "type": {"type": '
+                      u'"array", "items": {"type": "record", "name": "z", '
+                      u'"fields": []}}, "default": [{}, {"b": 2, "a": 1}]}, '
+                      u'{"name": "e", "type": {"type": "enum", "name": "E", '
+                      u'"symbols": ["B", "A"]}, "default": "B", '
+                      u'"aliases": [], "order": "ignore"}]}')
+        corpus.append('{"zz": 1e100, "aa": [null, true, false, -0.5, 3]}')
+        return corpus
+
+    def test_canonical_json_str_matches_ordered_object(self):
+        '''The single pass canonical form is byte-identical to the old one.'''
+        for schema_str in self.canonical_corpus():
+            expected = json.dumps(ordered_object(json.loads(schema_str)))
+            self.assertEqual(expected, canonical_json_str(schema_str))
+            # and again, from the cache
+            self.assertEqual(expected, canonical_json_str(schema_str))
+
+    def test_canonical_json_str_empty(self):
+        '''Empty documents have no canonical form.'''
+        self.assertEqual(None, canonical_json_str(None))
+        self.assertEqual(None, canonical_json_str('{}'))
+        self.assertRaises(ValueError, canonical_json_str, '{"bad": ')
+
+    def test_parsed_schema_cached(self):
+        '''A schema is parsed once, then shared.'''
+        ras = RegisteredAvroSchema()
+        ras.schema_str = self.schema_str
+        self.assertTrue(ras.validate_schema_str())
+        ras2 = RegisteredAvroSchema()
+        ras2.schema_str = json.dumps(json.loads(self.schema_str), indent=2)
+        hits = tasr.registered_schema.PARSED_CACHE.hits
+        self.assertTrue(ras2.is_valid)
+        self.assertIs(ras.schema, ras2.schema, 'expected a shared schema')
+        self.assertEqual(hits + 1, tasr.registered_schema.PARSED_CACHE.hits)
+
+    def test_parse_failure_cached(self):
+        '''Bad schemas keep failing, but are only parsed once.'''
+        bad_str = '{"type": "record", "name": "no_fields"}'
+        for _ in range(2):
+            ras = RegisteredAvroSchema()
+            ras.schema_str = bad_str
+            self.assertRaises(avro.schema.SchemaParseException,
+                              ras.validate_schema_str)
+        self.assertIsInstance(tasr.registered_schema.PARSED_CACHE.get(
+            ras.sha256_id), avro.schema.SchemaParseException)
+        self.assertFalse(RegisteredAvroSchema.is_valid_avro_schema(bad_str))
+        self.assertFalse(RegisteredAvroSchema.is_valid_avro_schema('{"x": '))
+        self.assertFalse(RegisteredAvroSchema.is_valid_avro_schema('{"x": '))
+
     def test_compatible_with_self(self):
         '''A schema should always be back-compatible with itself.'''
         ras = RegisteredAvroSchema()
@@ -266,6 +369,103 @@ class TestRegisteredAvroSchema(TASRTestCase):
         self.assertTrue(opt_ras.back_compatible_with(req_ras),
                         'expected schema to be back-compatible with self')
 
+    def master_history(self):
+        '''A version list with a break: an incompatible REQ field type change
+        at version 2, then compatible OPT field additions.'''
+        targ = '{"name": "source__timestamp", "type": "long"}'
+        replacement = '{"name": "source__timestamp", "type": "int"}'
+        versions = [self.schema_str,
+                    self.schema_str.replace(targ, replacement, 1)]
+        for fnum in range(3):
+            versions.append(self.get_schema_permutation(versions[-1],
+                                                        "fn_%s" % fnum))
+        return versions
+
+    def test_master_state_extend_matches_build(self):
+        '''Extending a master one version at a time matches a rebuild.'''
+        versions = self.master_history()[2:]
+        state = MasterState()
+        for ver in versions:
+            self.assertTrue(state.extend([ver]))
+            # and through a round trip, as it would be stored
+            state = MasterState.from_json(state.as_json())
+        built = MasterState.build(versions)
+        self.assertEqual((3, 3, None), (state.version, state.depth,
+                                        state.error))
+        self.assertEqual(built.master.canonical_schema_str,
+                         state.master.canonical_schema_str)
+        self.assertTrue(state.check_compatible(built.master))
+
+    def test_master_state_with_break(self):
+        '''A break in the history keeps the error and the compatible run.'''
+        versions = self.master_history()
+        state = MasterState.build(versions[:2])
+        self.assertEqual((2, 1), (state.version, state.depth))
+        self.assertTrue(state.error)
+        self.assertTrue(state.extend(versions[2:]))
+        self.assertEqual((5, 4), (state.version, state.depth))
+        built = MasterState.build(versions)
+        self.assertEqual((built.version, built.depth, built.error),
+                         (state.version, state.depth, state.error))
+        self.assertRaises(ValueError, state.check_compatible, built.master)
+        # a version that breaks the run cannot be folded in
+        bad = MasterState.build(versions[:1])
+        self.assertFalse(bad.extend(versions[1:2]))
+        self.assertEqual((1, 1, None), (bad.version, bad.depth, bad.error))
+
+    @staticmethod
+    def full_search_master(versions):
+        '''The longest compatible run, trying each run in turn.'''
+        for start in range(len(versions)):
+            try:
+                return (len(versions) - start,
+                        MasterAvroSchema(versions[start:]))
+            except ValueError:
+                pass
+        return (0, None)
+
+    def assert_same_master(self, versions):
+        (depth, mas) = tasr.registered_schema.longest_compatible_master(
+            versions)
+        (full_depth, full_mas) = self.full_search_master(versions)
+        self.assertEqual(full_depth, depth)
+        if full_mas:
+            self.assertEqual(full_mas.canonical_schema_str,
+                             mas.canonical_schema_str)
+        else:
+            self.assertEqual(None, mas)
+
+    def test_longest_compatible_master_matches_full_search(self):
+        '''The backward pass finds the same run as trying every run.'''
+        versions = self.master_history()
+        for start in range(len(versions)):
+            for end in range(start + 1, len(versions) + 1):
+                self.assert_same_master(versions[start:end])
+        self.assert_same_master([])
+        # a first-version-only field does not stop the run at its version
+        nullless = self.schema_str.replace(
+            '"gold__bonus_amount", "type": ["null", "int"]',
+            '"gold__bonus_amount", "type": ["string", "int"]', 1)
+        self.assertNotEqual(self.schema_str, nullless)
+        self.assert_same_master([versions[1], nullless, versions[2]])
+        self.assert_same_master([versions[1], nullless, nullless])
+
+    def test_longest_compatible_master_restored_req_field(self):
+        '''A REQ field that is removed and then restored needs the version
+        it was added in, so the run is not cut at the removal.'''
+        jd = json.loads(self.schema_str)
+        removed = dict(jd, fields=jd['fields'][1:])
+        changed = dict(jd, fields=[dict(jd['fields'][0], type='int')] +
+                       jd['fields'][1:])
+        versions = [json.dumps(changed), self.schema_str,
+                    json.dumps(removed), self.schema_str]
+        (depth, mas) = tasr.registered_schema.longest_compatible_master(
+            versions)
+        self.assertEqual(3, depth)
+        self.assertEqual(MasterAvroSchema(versions[1:]).canonical_schema_str,
+                         mas.canonical_schema_str)
+        self.assert_same_master(versions)
+
 
 if __name__ == "__main__":
     LOADER = unittest.TestLoader()
@@ -0,0 +1,78 @@
+from tasr_test import TASRTestCase
+
+import multiprocessing
+import unittest
+import tasr.app
+import tasr.app_subject
+import tasr.app_wsgi
+import tasr.serve
+
+APP = tasr.app.TASR_APP
+APP.set_config_mode('local')
+
+
+class TestServe(TASRTestCase):
+
+    def set_config(self, key, val):
+        '''Sets a config value for the test, returning the original.'''
+        mode = APP.config.mode
+        orig_val = APP.config.config.get(mode, key)
+        APP.config.config.set(mode, key, val)
+        return orig_val
+
+    def test_options_from_config(self):
+        '''server_options() - the settings come from tasr.cfg'''
+        options = tasr.serve.server_options(APP.config)
+        self.assertEqual('%s:%s' % (APP.config.host, APP.config.port),
+                         options['bind'])
+        self.assertEqual(APP.config.serve_workers, options['workers'])
+        self.assertEqual(APP.config.serve_threads, options['threads'])
+        self.assertEqual(APP.config.serve_max_requests,
+                         options['max_requests'])
+        self.assertEqual(APP.config.serve_max_requests_jitter,
+                         options['max_requests_jitter'])
+        self.assertEqual(APP.config.serve_timeout, options['timeout'])
+        self.assertTrue(options['preload_app'])
+        self.assertIs(tasr.serve.post_fork, options['post_fork'])
+        self.assertNotIn('pidfile', options)
+
+    def test_options_overridden(self):
+        '''server_options() - passed values win over the config ones'''
+        options = tasr.serve.server_options(APP.config, '0.0.0.0', 9090, 3, 2,
+                                            '/tmp/tasr.pid')
+        self.assertEqual('0.0.0.0:9090', options['bind'])
+        self.assertEqual(3, options['workers'])
+        self.assertEqual(2, options['threads'])
+        self.assertEqual('/tmp/tasr.pid', options['pidfile'])
+
+    def test_workers_default_to_cores(self):
+        '''server_options() - zero workers means one per CPU core'''
+        orig_val = self.set_config('serve_workers', '0')
+        try:
+            options = tasr.serve.server_options(APP.config)
+            self.assertEqual(multiprocessing.cpu_count(), options['workers'])
+        finally:
+            self.set_config('serve_workers', orig_val)
+
+    def test_post_fork_resets(self):
+        '''post_fork() - shared locks and the batch pool are replaced'''
+        lock = tasr.app_wsgi.ASR_LOCK
+        tasr.app_subject.batch_pool()
+        tasr.serve.post_fork(None, None)
+        self.assertIsNot(lock, tasr.app_wsgi.ASR_LOCK)
+        self.assertEqual(None, tasr.app_subject.BATCH_POOL)
+        self.assertTrue(tasr.app_subject.batch_pool())
+
+    @unittest.skipIf(tasr.serve.gunicorn is None, 'gunicorn not installed')
+    def test_server_config(self):
+        '''TASRServer - the options are loaded into the gunicorn config'''
+        options = tasr.serve.server_options(APP.config, workers=3)
+        server = tasr.serve.TASRServer(APP, options)
+        self.assertEqual(3, server.cfg.workers)
+        self.assertTrue(server.cfg.preload_app)
+        self.assertIs(APP, server.load())
+
+
+if __name__ == "__main__":
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(TestServe)
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
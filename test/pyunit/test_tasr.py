@@ -7,9 +7,12 @@ Created on Apr 8, 2014
 from tasr_test import TASRTestCase
 
 import unittest
+import os
 import time
+import tasr
 import tasr.app
 from tasr import AvroSchemaRepository
+from tasr.cache import deep_size
 from tasr.group import InvalidGroupException
 
 APP = tasr.app.TASR_APP
@@ -100,6 +103,32 @@ class TestTASR(TASRTestCase):
         re_rs = self.asr.register_schema(self.event_type, self.schema_str)
         self.assertEqual(rs, re_rs, u'Re-registered schema different.')
 
+    def test_reg_and_rereg_created_flag(self):
+        '''register_schema() - created set for new versions only'''
+        rs = self.asr.register_schema(self.event_type, self.schema_str)
+        self.assertTrue(rs.created, u'Expected created on first reg.')
+        re_rs = self.asr.register_schema(self.event_type, self.schema_str)
+        self.assertFalse(re_rs.created, u'Expected no creation on re-reg.')
+        self.assertEqual(1, re_rs.current_version(self.event_type),
+                         u'Re-reg of latest should not add a version.')
+
+    def test_non_sequential_rereg_lists_aligned(self):
+        '''register_schema() - vid.*, vts.* and topic.* lists stay aligned'''
+        schema_str_2 = self.schema_str.replace('tagged.events',
+                                               'tagged.events.alt', 1)
+        self.asr.register_schema(self.event_type, self.schema_str)
+        self.asr.register_schema(self.event_type, schema_str_2)
+        rs3 = self.asr.register_schema(self.event_type, self.schema_str)
+        self.assertTrue(rs3.created, u'Reverting should create a version.')
+        self.assertEqual(3, rs3.current_version(self.event_type),
+                         u'Expected the reverted schema to be version 3.')
+        vids = self.asr.redis.lrange(self.asr.vid_key(self.event_type), 0, -1)
+        tids = self.asr.redis.lrange(self.asr.topic_key(self.event_type), 0,
+                                     -1)
+        vtss = self.asr.redis.lrange(self.asr.vts_key(self.event_type), 0, -1)
+        self.assertListEqual(vids, tids, u'vid.* and topic.* out of sync.')
+        self.assertEqual(3, len(vtss), u'Expected a timestamp per version.')
+
     def test_reg_1_schema_for_2_topics(self):
         '''register_schema() - same schema for two topics'''
         rs = self.asr.register_schema(self.event_type, self.schema_str)
@@ -170,8 +199,6 @@ class TestTASR(TASRTestCase):
     def test_get_for_id(self):
         '''schema_for_id_str() - as expected'''
         rs = self.asr.register_schema(self.event_type, self.schema_str)
-        rs.version = None
-        rs.topic = None
         self.assertEqual(rs, self.asr.get_schema_for_id_str(rs.md5_id),
                          u'MD5 ID retrieved unequal registered schema')
         self.assertEqual(rs, self.asr.get_schema_for_id_str(rs.sha256_id),
@@ -192,6 +219,56 @@ class TestTASR(TASRTestCase):
         self.assertEqual(rs, self.asr.get_schema_for_id_str(rs.sha256_id),
                          u'SHA256 ID retrieved unequal registered schema')
 
+    def test_get_for_id_from_schema_cache(self):
+        '''schema_for_id_str() - cached schema with refreshed metadata'''
+        rs = self.asr.register_schema(self.event_type, self.schema_str)
+        self.assertIn(rs.sha256_id, self.asr.schema_cache,
+                      u'Expected registered schema in the cache.')
+        self.assertIn(rs.md5_id, self.asr.schema_cache,
+                      u'Expected registered schema in the cache.')
+        # register for a second group -- cached lookups must reflect it
+        self.asr.register_schema('bob', self.schema_str)
+        misses = self.asr.schema_cache.misses
+        for id_str in (rs.sha256_id, rs.md5_id):
+            re_rs = self.asr.get_schema_for_id_str(id_str)
+            self.assertEqual(rs.canonical_schema_str,
+                             re_rs.canonical_schema_str, u'Bad schema.')
+            self.assertEqual(1, re_rs.current_version('bob'),
+                             u'Stale version metadata from the cache.')
+        self.assertEqual(misses, self.asr.schema_cache.misses,
+                         u'Expected both lookups to hit the cache.')
+        re_rs = self.asr.get_schema_for_group_and_version('bob', 1)
+        self.assertEqual(rs.sha256_id, re_rs.sha256_id, u'Bad schema.')
+
+    def test_schema_cache_md5_alias(self):
+        '''cache_schema() - the md5 id is an alias, so it goes with the schema
+        '''
+        rs = self.asr.register_schema(self.event_type, self.schema_str)
+        cache = self.asr.schema_cache
+        self.assertEqual(rs.sha256_id, cache.get(rs.md5_id))
+        # the size counts all the prototype holds, not just the schema string
+        self.assertEqual(deep_size(cache.get(rs.sha256_id)) +
+                         deep_size((rs.md5_id, rs.sha256_id)),
+                         cache.total_bytes)
+        cache.pop(rs.sha256_id)
+        self.assertEqual(None, self.asr.cached_schema(rs.md5_id))
+        self.assertEqual(rs, self.asr.get_schema_for_id_str(rs.md5_id))
+        self.assertEqual(rs.sha256_id,
+                         self.asr.cached_schema(rs.md5_id).sha256_id)
+
+    def test_get_for_id_with_cold_schema_cache(self):
+        '''schema_for_id_str() - populates an empty cache'''
+        rs = self.asr.register_schema(self.event_type, self.schema_str)
+        self.asr.schema_cache.clear()
+        re_rs = self.asr.get_schema_for_group_and_version(self.event_type, 1)
+        self.assertEqual(rs, re_rs, u'Retrieved schema unequal.')
+        self.assertIn(rs.sha256_id, self.asr.schema_cache,
+                      u'Expected retrieved schema in the cache.')
+        # a deleted schema must not be served from the cache
+        self.asr.delete_group(self.event_type)
+        self.assertEqual(None, self.asr.get_schema_for_id_str(rs.sha256_id),
+                         u'Expected no schema after the delete.')
+
     def test_get_for_schema_str(self):
         '''schema_for_schema_str() - as expected'''
         rs = self.asr.register_schema(self.event_type, self.schema_str)
@@ -228,6 +305,107 @@ class TestTASR(TASRTestCase):
         self.assertEqual(rs2, rs_list[1], 'Expecting RS2 as second entry.')
         self.assertEqual(rs3, rs_list[2], 'Expecting RS3 as third entry.')
 
+    def test_get_versions_for_topic_with_rereg(self):
+        '''get_schema_versions_for_group() - re-registered schema included
+        at each of its versions, ranges as expected'''
+        rs1 = self.asr.register_schema(self.event_type, self.schema_str)
+        schema_str_2 = self.schema_str.replace('tagged.events',
+                                               'tagged.events.2', 1)
+        rs2 = self.asr.register_schema(self.event_type, schema_str_2)
+        rs3 = self.asr.register_schema(self.event_type, self.schema_str)
+        rs_list = self.asr.get_schema_versions_for_group(self.event_type)
+        self.assertEqual(3, len(rs_list), 'Expected a list of length 3.')
+        self.assertEqual(rs1.sha256_id, rs_list[0].sha256_id, 'Bad version 1.')
+        self.assertEqual(rs2, rs_list[1], 'Expecting RS2 as second entry.')
+        self.assertEqual(rs3, rs_list[2], 'Expecting RS3 as third entry.')
+        self.assertFalse(rs_list[0] is rs_list[2], 'Expected distinct objects.')
+        rs_list = self.asr.get_schema_versions_for_group(self.event_type, 2, 2)
+        self.assertEqual(1, len(rs_list), 'Expected a list of length 1.')
+        self.assertEqual(rs2, rs_list[0], 'Expecting RS2 as only entry.')
+        self.assertListEqual([], self.asr.get_schema_versions_for_group('bob'),
+                             'Expected no versions for missing group.')
+
+    def test_iter_schema_versions_in_batches(self):
+        '''iter_schema_versions_for_group() - all versions, batch by batch'''
+        rs_list = []
+        for ver in range(5):
+            schema_str = self.schema_str.replace('tagged.events',
+                                                 'tagged.events.%s' % ver, 1)
+            rs_list.append(self.asr.register_schema(self.event_type,
+                                                    schema_str))
+        versions = self.asr.iter_schema_versions_for_group(self.event_type,
+                                                           batch_size=2)
+        self.assertListEqual(rs_list, list(versions))
+        versions = self.asr.iter_schema_versions_for_group(self.event_type,
+                                                           2, 4, 2)
+        self.assertListEqual(rs_list[1:4], list(versions))
+        self.assertListEqual([], list(
+            self.asr.iter_schema_versions_for_group('bob')))
+
+    def test_get_version_sha256_ids_range(self):
+        '''get_version_sha256_ids_for_group() - ranges as expected'''
+        rs1 = self.asr.register_schema(self.event_type, self.schema_str)
+        schema_str_2 = self.schema_str.replace('tagged.events',
+                                               'tagged.events.2', 1)
+        rs2 = self.asr.register_schema(self.event_type, schema_str_2)
+        keys = ['id.%s' % rs1.sha256_id, 'id.%s' % rs2.sha256_id]
+        asr = self.asr
+        self.assertListEqual(
+            keys, asr.get_all_version_sha256_ids_for_group(self.event_type))
+        self.assertListEqual(
+            keys[1:], asr.get_version_sha256_ids_for_group(self.event_type, 2))
+        self.assertListEqual(
+            keys[:1], asr.get_version_sha256_ids_for_group(self.event_type,
+                                                           1, 1))
+
+    def test_get_group_names(self):
+        '''get_group_names() - all the names, sorted like get_groups()'''
+        for name in ('bob', 'Alice', 'carol'):
+            self.asr.register_group(name)
+        self.assertListEqual(['Alice', 'bob', 'carol'],
+                             self.asr.get_group_names())
+
+    def test_get_group_names__active_only(self):
+        '''get_group_names() - only the names of groups with schemas'''
+        for name in ('bob', 'Alice', 'carol'):
+            self.asr.register_group(name)
+        self.asr.register_schema('carol', self.schema_str)
+        self.asr.register_schema(self.event_type, self.schema_str)
+        self.assertListEqual(['carol', self.event_type],
+                             self.asr.get_group_names(active_only=True))
+
+    def test_get_schemas_for_refs(self):
+        '''get_schemas_for_refs() - mixed ids and versions, in order'''
+        rs1 = self.asr.register_schema(self.event_type, self.schema_str)
+        schema_str_2 = self.schema_str.replace('tagged.events',
+                                               'tagged.events.2', 1)
+        rs2 = self.asr.register_schema(self.event_type, schema_str_2)
+        refs = [rs2.md5_id, (self.event_type, 1), 'id.%s' % rs1.sha256_id,
+                (self.event_type, -1), (self.event_type, 3), ('bob', 1),
+                (self.event_type, 0), 'bob', rs1.sha256_id]
+        self.assertListEqual([rs2, rs1, rs1, rs2, None, None, None, None,
+                              rs1], self.asr.get_schemas_for_refs(refs))
+        # the second time, the schemas come from the cache
+        schemas = self.asr.get_schemas_for_refs(refs)
+        self.assertEqual(2, schemas[0].current_version(self.event_type))
+        self.assertListEqual([], self.asr.get_schemas_for_refs([]))
+
+    def test_get_schemas_for_refs_rereg_version(self):
+        '''get_schemas_for_refs() - a version ref gets the version asked for
+        '''
+        self.asr.register_schema(self.event_type, self.schema_str)
+        schema_str_2 = self.schema_str.replace('tagged.events',
+                                               'tagged.events.2', 1)
+        self.asr.register_schema(self.event_type, schema_str_2)
+        rs3 = self.asr.register_schema(self.event_type, self.schema_str)
+        refs = [(self.event_type, 1), (self.event_type, '1'),
+                (self.event_type, -1), rs3.sha256_id]
+        for _ in range(2):
+            schemas = self.asr.get_schemas_for_refs(refs)
+            self.assertListEqual([1, 1, 3, 3],
+                                 [rs.current_version(self.event_type)
+                                  for rs in schemas])
+
     def test_legacy_topic_list_matches_vid_list(self):
         '''Check that the old topic.* list matches the vid.* list with multiple
         schema versions for a group registered'''
@@ -239,8 +417,10 @@ class TestTASR(TASRTestCase):
                                                'tagged.events.3', 1)
         self.asr.register_schema(self.event_type, schema_str_3)
         for ver in range(1, 3):
-            t_val = self.asr.redis.lindex('topic.%s' % self.event_type, ver)
-            v_val = self.asr.redis.lindex('vid.%s' % self.event_type, ver)
+            t_val = self.asr.redis.lindex(self.asr.topic_key(self.event_type),
+                                          ver)
+            v_val = self.asr.redis.lindex(self.asr.vid_key(self.event_type),
+                                          ver)
             self.assertEqual(t_val, v_val, 'Mismatch at index %s' % ver)
 
     def test_get_all_groups(self):
@@ -275,6 +455,58 @@ class TestTASR(TASRTestCase):
         self.assertEqual(1, len(self.asr.get_all_groups()), 'should have 1')
         self.assertEqual(1, len(self.asr.get_active_groups()), 'should be 1')
 
+    def test_get_groups_for_names(self):
+        '''get_groups() - named groups with current schemas in one call'''
+        rs = self.asr.register_schema(self.event_type, self.schema_str)
+        self.asr.register_group('bob')
+        groups = self.asr.get_groups([self.event_type, 'bob', 'missing'])
+        self.assertListEqual(['bob', self.event_type],
+                             [group.name for group in groups],
+                             'expected the two registered groups, sorted')
+        self.assertEqual(None, groups[0].current_schema,
+                         'bare group should have no current schema')
+        self.assertEqual(rs, groups[1].current_schema,
+                         'current schema unequal registered schema')
+        self.assertEqual(1, len(self.asr.get_groups(active_only=True)),
+                         'expected only one active group')
+
+    def test_group_index_maintained(self):
+        '''register_group(), register_schema(), delete_group() - index'''
+        self.asr.register_group('bob')
+        self.asr.register_schema(self.event_type, self.schema_str)
+        self.assertSetEqual(set([self.event_type, 'bob']),
+                            self.asr.redis.smembers(tasr.GROUP_INDEX_KEY),
+                            'expected both groups in the index')
+        self.asr.delete_group('bob')
+        self.assertSetEqual(set([self.event_type]),
+                            self.asr.redis.smembers(tasr.GROUP_INDEX_KEY),
+                            'expected deleted group out of the index')
+
+    def test_rebuild_group_index(self):
+        '''rebuild_group_index() - as expected'''
+        self.asr.register_group('bob')
+        self.asr.register_schema(self.event_type, self.schema_str)
+        # drop the index, add a stale entry, and confirm the lists are empty
+        self.asr.redis.delete(tasr.GROUP_INDEX_KEY)
+        self.asr.redis.sadd(tasr.GROUP_INDEX_KEY, 'stale')
+        self.assertEqual(0, len(self.asr.get_all_groups()),
+                         'should not find any indexed groups')
+        self.assertEqual(2, self.asr.rebuild_group_index(),
+                         'expected 2 groups indexed')
+        self.assertEqual(2, len(self.asr.get_all_groups()), 'should have 2')
+        self.assertEqual(1, len(self.asr.get_active_groups()), 'should be 1')
+
+    def test_prune_group_index(self):
+        '''prune_group_index LUA - only names without a group hash go'''
+        self.asr.register_group('bob')
+        self.asr.redis.sadd(tasr.GROUP_INDEX_KEY, 'stale')
+        for (name, removed) in (('bob', 0), ('stale', 1)):
+            self.assertEqual(removed, self.asr.lua_prune_group_index(
+                keys=[tasr.GROUP_INDEX_KEY, self.asr.get_group_key(name), ],
+                args=[name, ]))
+        self.assertSetEqual(set(['bob']),
+                            self.asr.redis.smembers(tasr.GROUP_INDEX_KEY))
+
     def test_multi_version_for_topic(self):
         '''get_versions_for_id_str_and_group() - as expected'''
         rs = self.asr.register_schema(self.event_type, self.schema_str)
@@ -293,15 +525,168 @@ class TestTASR(TASRTestCase):
         self.assertEqual(1, vlist[0], u'Expected first version to be 1.')
         self.assertEqual(3, vlist[1], u'Expected second version to be 3.')
 
+    def test_group_master_stored_and_extended(self):
+        '''get_group_master() - stored, then extended by new versions'''
+        self.assertEqual(0, self.asr.get_group_master(self.event_type).version)
+        self.asr.register_schema(self.event_type, self.schema_str)
+        state = self.asr.get_group_master(self.event_type)
+        self.assertEqual((1, 1, None), (state.version, state.depth,
+                                        state.error))
+        self.assertTrue(self.asr.get_master_state_str(self.event_type))
+        schema_str_2 = self.get_schema_permutation(self.schema_str)
+        rs2 = self.asr.register_schema(self.event_type, schema_str_2)
+        state = self.asr.get_group_master(self.event_type)
+        self.assertEqual((2, 2), (state.version, state.depth))
+        self.assertTrue(state.check_compatible(rs2))
+        self.assertIn('"extra"', state.master.canonical_schema_str)
+        # an older state is never stored over a newer one
+        self.asr.set_master_state_str(self.event_type, 1, '{}')
+        self.assertEqual(state.as_json(),
+                         self.asr.get_master_state_str(self.event_type))
+
+    def test_group_master_rebuilt_after_break(self):
+        '''get_group_master() - an incompatible version shortens the run'''
+        self.asr.register_schema(self.event_type, self.schema_str)
+        self.asr.get_group_master(self.event_type)
+        targ = '{"name": "source__timestamp", "type": "long"}'
+        replacement = '{"name": "source__timestamp", "type": "int"}'
+        self.asr.register_schema(self.event_type,
+                                 self.schema_str.replace(targ, replacement))
+        state = self.asr.get_group_master(self.event_type)
+        self.assertEqual((2, 1), (state.version, state.depth))
+        self.assertTrue(state.error)
+
+    def test_compat_verdict_cached(self):
+        '''check_group_compatible() - cached until a new version'''
+        self.asr.register_schema(self.event_type, self.schema_str)
+        candidate = self.asr.instantiate_registered_schema()
+        candidate.schema_str = self.get_schema_permutation(self.schema_str)
+        self.assertTrue(self.asr.check_group_compatible(self.event_type,
+                                                        candidate))
+        hits = self.asr.compat_cache.hits
+        self.assertTrue(self.asr.check_group_compatible(self.event_type,
+                                                        candidate))
+        self.assertEqual(hits + 1, self.asr.compat_cache.hits)
+        self.assertEqual(1, len(self.asr.compat_cache))
+        # a new version drops the group's verdicts
+        self.asr.register_schema(self.event_type, candidate.schema_str)
+        self.assertEqual(0, len(self.asr.compat_cache))
+        targ = '{"name": "source__timestamp", "type": "long"}'
+        replacement = '{"name": "source__timestamp", "type": "int"}'
+        incompat = self.asr.instantiate_registered_schema()
+        incompat.schema_str = self.schema_str.replace(targ, replacement)
+        self.assertFalse(self.asr.check_group_compatible(self.event_type,
+                                                         incompat))
+        self.assertFalse(self.asr.check_group_compatible(self.event_type,
+                                                         incompat))
+
+    def test_compat_verdict_error_cached(self):
+        '''check_group_compatible() - a broken history error is cached'''
+        self.asr.register_schema(self.event_type, self.schema_str)
+        targ = '{"name": "source__timestamp", "type": "long"}'
+        replacement = '{"name": "source__timestamp", "type": "int"}'
+        self.asr.register_schema(self.event_type,
+                                 self.schema_str.replace(targ, replacement))
+        candidate = self.asr.instantiate_registered_schema()
+        candidate.schema_str = self.schema_str
+        for _ in range(2):
+            self.assertRaises(ValueError, self.asr.check_group_compatible,
+                              self.event_type, candidate)
+        self.assertEqual(1, self.asr.compat_cache.hits)
+
+    def test_sha256_id_for_id_str(self):
+        '''sha256_id_for_id_str() - worked out without the store'''
+        rs = self.asr.register_schema(self.event_type, self.schema_str)
+        self.assertEqual(rs.sha256_id,
+                         self.asr.sha256_id_for_id_str(rs.sha256_id))
+        self.assertEqual(rs.sha256_id,
+                         self.asr.sha256_id_for_id_str(u'id.%s' % rs.md5_id))
+        self.asr.schema_cache.clear()
+        self.assertEqual(None, self.asr.sha256_id_for_id_str(rs.md5_id))
+        self.assertEqual(None, self.asr.sha256_id_for_id_str('not base64'))
+
+    def test_group_validators(self):
+        '''check_group_compatible() - the group's validators are applied'''
+        targ = '{"name": "source__timestamp", "type": "long"}'
+        replacement = '{"name": "source__timestamp", "type": "int"}'
+        self.asr.register_group(self.event_type, validators=['BACKWARD', ])
+        self.assertEqual(set(['BACKWARD', ]),
+                         self.asr.get_group_validators(self.event_type))
+        self.asr.register_schema(self.event_type,
+                                 self.schema_str.replace(targ, replacement))
+        # the int can be read as a long, but the master rules say no
+        candidate = self.asr.instantiate_registered_schema()
+        candidate.schema_str = self.schema_str
+        self.assertTrue(self.asr.check_group_compatible(self.event_type,
+                                                        candidate))
+        self.asr.register_group('bob', validators=['FORWARD', ])
+        self.asr.register_schema('bob',
+                                 self.schema_str.replace(targ, replacement))
+        self.assertRaises(ValueError, self.asr.check_group_compatible,
+                          'bob', candidate)
+        self.asr.register_schema('alice',
+                                 self.schema_str.replace(targ, replacement))
+        self.assertFalse(self.asr.check_group_compatible('alice', candidate))
+
+    def test_group_validator_extended(self):
+        '''get_group_validator() - compiled once, extended by new versions'''
+        self.asr.register_group(self.event_type, validators=['FULL', ])
+        rs1 = self.asr.register_schema(self.event_type, self.schema_str)
+        validator = self.asr.get_group_validator(self.event_type, 'FULL', rs1)
+        self.assertIs(validator, self.asr.get_group_validator(
+            self.event_type, 'FULL', rs1))
+        rs2 = self.asr.register_schema(
+            self.event_type, self.get_schema_permutation(self.schema_str))
+        extended = self.asr.get_group_validator(self.event_type, 'FULL', rs2)
+        self.assertEqual(1, validator.version)
+        self.assertEqual(2, extended.version)
+        self.assertEqual(rs2.sha256_id, extended.latest_id)
+
+    def compat_redis_asr(self):
+        '''Returns a second repository sharing verdicts through Redis.'''
+        return AvroSchemaRepository(host=APP.config.redis_host,
+                                    port=APP.config.redis_port,
+                                    compat_cache_redis=True)
+
+    def test_compat_verdict_shared_through_redis(self):
+        '''check_group_compatible() - verdicts shared through Redis'''
+        self.asr.compat_cache_redis = True
+        rs1 = self.asr.register_schema(self.event_type, self.schema_str)
+        candidate = self.asr.instantiate_registered_schema()
+        candidate.schema_str = self.get_schema_permutation(self.schema_str)
+        self.assertTrue(self.asr.check_group_compatible(self.event_type,
+                                                        candidate))
+        compat_key = self.asr.compat_key(self.event_type)
+        verdict_key = u'%s:%s' % (rs1.sha256_id, candidate.sha256_id)
+        self.assertEqual('1', self.asr.redis.hget(compat_key, 'version'))
+        self.assertEqual('[true, null]',
+                         self.asr.redis.hget(compat_key, verdict_key))
+        # another process sees the shared verdict
+        asr2 = self.compat_redis_asr()
+        self.asr.redis.hset(compat_key, verdict_key, '[false, null]')
+        self.assertFalse(asr2.check_group_compatible(self.event_type,
+                                                     candidate))
+        # a verdict for a new version drops the old ones
+        self.asr.register_schema(self.event_type, candidate.schema_str)
+        self.assertTrue(asr2.check_group_compatible(self.event_type,
+                                                    candidate))
+        self.assertEqual('2', self.asr.redis.hget(compat_key, 'version'))
+        self.assertEqual(None, self.asr.redis.hget(compat_key, verdict_key))
+        self.asr.delete_group(self.event_type)
+        self.assertFalse(self.asr.redis.exists(compat_key))
+
     # deletion tests
     def test_delete_group(self):
         '''Test that a group delete works.'''
         self.asr.register_schema(self.event_type, self.schema_str)
         self.assertTrue(self.asr.lookup_group(self.event_type),
                         'Group should be registered.')
+        self.asr.get_group_master(self.event_type)
         self.asr.delete_group(self.event_type)
         self.assertFalse(self.asr.lookup_group(self.event_type),
                          'Group should not be registered any more.')
+        self.assertEqual(None, self.asr.get_master_state_str(self.event_type),
+                         'Master state should be deleted with the group.')
 
     def test_delete_group_with_cross_registered_schema(self):
         '''Test that deleting a group with a schema version that is also
@@ -320,6 +705,154 @@ class TestTASR(TASRTestCase):
         self.assertTrue(self.asr.lookup_group(alt_group_name),
                         'Group should be registered.')
 
+    def group_cache_asr(self, ttl=30):
+        '''Returns a second repository with the group cache enabled.'''
+        return AvroSchemaRepository(host=APP.config.redis_host,
+                                    port=APP.config.redis_port,
+                                    group_cache_ttl=ttl)
+
+    def wait_for_eviction(self, asr, group_name, timeout=5):
+        '''Waits for the subscriber thread to evict the group.'''
+        deadline = time.time() + timeout
+        while group_name in asr.group_cache and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_group_cache_invalidated_by_register(self):
+        '''register_schema() in one process evicts the cached group in
+        another.'''
+        cached_asr = self.group_cache_asr()
+        self.asr.register_schema(self.event_type, self.schema_str)
+        rs1 = cached_asr.get_latest_schema_for_group(self.event_type)
+        self.assertEqual(1, rs1.current_version(self.event_type))
+        self.assertTrue(self.event_type in cached_asr.group_cache)
+        # the second lookup comes from the cache
+        hits = cached_asr.group_cache.hits
+        cached_asr.lookup_group(self.event_type)
+        self.assertEqual(hits + 1, cached_asr.group_cache.hits)
+
+        schema_str_2 = self.schema_str.replace('tagged.events',
+                                               'tagged.events.alt', 1)
+        self.asr.register_schema(self.event_type, schema_str_2)
+        self.wait_for_eviction(cached_asr, self.event_type)
+        rs2 = cached_asr.get_latest_schema_for_group(self.event_type)
+        self.assertEqual(2, rs2.current_version(self.event_type))
+        self.assertEqual(schema_str_2, rs2.schema_str)
+
+    def test_group_cache_invalidated_by_metadata_change(self):
+        '''set_group_metadata_entry() evicts the cached group.'''
+        cached_asr = self.group_cache_asr()
+        self.asr.register_group(self.event_type)
+        group = cached_asr.lookup_group(self.event_type)
+        self.assertFalse('default_foo' in group.metadata)
+        self.asr.set_group_metadata_entry(self.event_type,
+                                          'default_foo', 'bar')
+        self.wait_for_eviction(cached_asr, self.event_type)
+        group = cached_asr.lookup_group(self.event_type)
+        self.assertEqual('bar', group.metadata.get('default_foo'))
+
+    def test_group_cache_invalidated_by_cross_registration(self):
+        '''Registering a group's latest schema for another group updates the
+        version fields of the cached latest schema.'''
+        cached_asr = self.group_cache_asr()
+        self.asr.register_schema(self.event_type, self.schema_str)
+        cached_asr.lookup_group(self.event_type)
+        self.asr.register_schema('bob', self.schema_str)
+        self.wait_for_eviction(cached_asr, self.event_type)
+        rs = cached_asr.get_latest_schema_for_group(self.event_type)
+        self.assertEqual(1, rs.current_version('bob'))
+
+    def test_group_cache_invalidated_by_delete(self):
+        '''delete_group() clears the group cache.'''
+        cached_asr = self.group_cache_asr()
+        self.asr.register_schema(self.event_type, self.schema_str)
+        self.assertTrue(cached_asr.lookup_group(self.event_type))
+        self.asr.delete_group(self.event_type)
+        self.wait_for_eviction(cached_asr, self.event_type)
+        self.assertEqual(None, cached_asr.lookup_group(self.event_type))
+
+    def test_group_cache_ttl(self):
+        '''Unpublished changes are picked up once the TTL expires.'''
+        cached_asr = self.group_cache_asr(ttl=1)
+        self.asr.register_group(self.event_type)
+        cached_asr.lookup_group(self.event_type)
+        # change the hash directly, so no invalidation is published
+        self.asr.redis.hset(self.asr.get_group_key(self.event_type),
+                            'default_foo', 'bar')
+        group = cached_asr.lookup_group(self.event_type)
+        self.assertFalse('default_foo' in group.metadata)
+        time.sleep(1.1)
+        group = cached_asr.lookup_group(self.event_type)
+        self.assertEqual('bar', group.metadata.get('default_foo'))
+
+    def test_group_cache_disabled_without_ttl(self):
+        '''No TTL means no group cache (and no subscriber thread).'''
+        self.asr.register_group(self.event_type)
+        self.assertTrue(self.asr.lookup_group(self.event_type))
+        self.assertFalse(self.asr.group_cache.enabled)
+        self.assertEqual(None, self.asr.listener)
+
+    def replica_asr(self, read_your_writes=0):
+        '''Returns a repository with two "replicas" -- really just separate
+        connection pools to the test Redis.'''
+        pools = [tasr.create_connection_pool(host=APP.config.redis_host,
+                                             port=APP.config.redis_port)
+                 for _ in range(2)]
+        return AvroSchemaRepository(host=APP.config.redis_host,
+                                    port=APP.config.redis_port,
+                                    replica_pools=pools,
+                                    read_your_writes=read_your_writes)
+
+    def test_reads_round_robin_across_replicas(self):
+        '''reader() - reads alternate between the replicas'''
+        replica_asr = self.replica_asr()
+        rs = replica_asr.register_schema(self.event_type, self.schema_str)
+        readers = [replica_asr.reader() for _ in range(4)]
+        self.assertNotIn(replica_asr.redis, readers)
+        self.assertIs(readers[0], readers[2])
+        self.assertIsNot(readers[0], readers[1])
+        self.assertEqual(rs, replica_asr.get_latest_schema_for_group(
+            self.event_type))
+        self.assertEqual(rs, replica_asr.get_schema_for_id_str(rs.md5_id))
+        self.assertTrue(replica_asr.lookup_group(self.event_type))
+
+    def test_read_your_writes(self):
+        '''reader() - reads go to the primary right after a write'''
+        replica_asr = self.replica_asr(read_your_writes=0.2)
+        self.assertIsNot(replica_asr.redis, replica_asr.reader())
+        replica_asr.register_group(self.event_type)
+        self.assertIs(replica_asr.redis, replica_asr.reader())
+        time.sleep(0.25)
+        self.assertIsNot(replica_asr.redis, replica_asr.reader())
+
+    def test_after_fork(self):
+        '''after_fork() - a forked child reads on its own connections'''
+        rs = self.asr.register_schema(self.event_type, self.schema_str)
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self.asr.after_fork()
+                latest = self.asr.get_latest_schema_for_group(self.event_type)
+                status = 0 if latest == rs else 2
+            finally:
+                os._exit(status)
+        self.assertEqual(0, os.waitpid(pid, 0)[1])
+        self.assertEqual(rs, self.asr.get_latest_schema_for_group(
+            self.event_type))
+
+    def test_after_fork_restarts_listener(self):
+        '''after_fork() - the pools are emptied and the listener restarts'''
+        cached_asr = self.group_cache_asr()
+        self.asr.register_group(self.event_type)
+        cached_asr.lookup_group(self.event_type)
+        self.assertTrue(cached_asr.listener.is_alive())
+        cached_asr.after_fork()
+        self.assertEqual(None, cached_asr.listener)
+        pool = cached_asr.redis.connection_pool
+        self.assertEqual(0, pool._created_connections)
+        cached_asr.lookup_group(self.event_type)
+        self.assertTrue(cached_asr.listener.is_alive())
+
 
 if __name__ == "__main__":
     SUITE = unittest.TestLoader().loadTestsFromTestCase(TestTASR)
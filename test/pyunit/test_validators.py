@@ -0,0 +1,134 @@
+from tasr_test import TASRTestCase
+
+import json
+import unittest
+import avro.schema
+from tasr.registered_schema import RegisteredAvroSchema
+from tasr.validators import BackwardValidator, ForwardValidator
+from tasr.validators import FullValidator, resolution_error
+from tasr.validators import selected_validators, DEFAULT_VALIDATORS
+
+
+def record(fields, name='Rec'):
+    '''A RegisteredAvroSchema for a record with the passed fields.'''
+    ras = RegisteredAvroSchema()
+    ras.schema_str = json.dumps({'type': 'record', 'name': name,
+                                 'namespace': 'tagged.events',
+                                 'fields': fields})
+    return ras
+
+
+def parse(obj):
+    '''A parsed Avro schema for a JSON-able object.'''
+    return avro.schema.parse(json.dumps(obj))
+
+
+A_INT = {'name': 'a', 'type': 'int'}
+A_LONG = {'name': 'a', 'type': 'long'}
+B_STR = {'name': 'b', 'type': 'string'}
+B_OPT = {'name': 'b', 'type': ['null', 'string'], 'default': None}
+B_NULLABLE = {'name': 'b', 'type': ['null', 'string']}
+
+
+class TestValidators(TASRTestCase):
+
+    def test_resolution_promotions(self):
+        '''resolution_error() - writer types promote to wider reader types'''
+        self.assertEqual(None, resolution_error(parse('int'), parse('long')))
+        self.assertEqual(None, resolution_error(parse('float'),
+                                                parse('double')))
+        self.assertEqual(None, resolution_error(parse('bytes'),
+                                                parse('string')))
+        self.assertNotEqual(None, resolution_error(parse('long'),
+                                                   parse('int')))
+
+    def test_resolution_unions(self):
+        '''resolution_error() - each writer branch needs a reader branch'''
+        self.assertEqual(None, resolution_error(parse('int'),
+                                                parse(['null', 'long'])))
+        self.assertEqual(None, resolution_error(parse(['null', 'int']),
+                                                parse(['null', 'long'])))
+        self.assertNotEqual(None, resolution_error(parse(['null', 'int']),
+                                                   parse('int')))
+
+    def test_resolution_enums(self):
+        '''resolution_error() - writer symbols must be reader symbols'''
+        small = parse({'type': 'enum', 'name': 'E', 'symbols': ['A']})
+        big = parse({'type': 'enum', 'name': 'E', 'symbols': ['A', 'B']})
+        self.assertEqual(None, resolution_error(small, big))
+        self.assertNotEqual(None, resolution_error(big, small))
+
+    def test_resolution_recursive(self):
+        '''resolution_error() - recursive records terminate'''
+        node = parse({'type': 'record', 'name': 'Node', 'fields': [
+            {'name': 'next', 'type': ['null', 'Node'], 'default': None}]})
+        self.assertEqual(None, resolution_error(node, node))
+
+    def test_backward(self):
+        '''BackwardValidator - the new schema reads the old data'''
+        validator = BackwardValidator().add_versions([record([A_INT]), ])
+        self.assertTrue(validator.check(record([A_LONG]))[0])
+        self.assertTrue(validator.check(record([A_INT, B_OPT]))[0])
+        (is_compatible, error) = validator.check(record([A_INT, B_STR]))
+        self.assertFalse(is_compatible)
+        self.assertIn('field b', error)
+        self.assertFalse(validator.check(record([A_INT], 'Other'))[0])
+
+    def test_forward(self):
+        '''ForwardValidator - the old schemas read the new data'''
+        validator = ForwardValidator().add_versions([record([A_LONG]), ])
+        self.assertTrue(validator.check(record([A_INT]))[0])
+        self.assertTrue(validator.check(record([A_INT, B_STR]))[0])
+        (is_compatible, error) = validator.check(record([B_STR]))
+        self.assertFalse(is_compatible)
+        self.assertIn('fields a', error)
+
+    def test_full(self):
+        '''FullValidator - both ways'''
+        validator = FullValidator().add_versions([record([A_INT]), ])
+        self.assertTrue(validator.check(record([A_INT, B_OPT]))[0])
+        self.assertFalse(validator.check(record([A_LONG]))[0])
+        self.assertFalse(validator.check(record([A_INT, B_STR]))[0])
+
+    def test_compiled_across_versions(self):
+        '''BackwardValidator - every version is checked, not just the last'''
+        validator = BackwardValidator().add_versions(
+            [record([A_INT, B_STR]), record([A_INT, B_OPT])])
+        self.assertEqual(2, validator.version)
+        # every version has b, so it does not need a default...
+        self.assertTrue(validator.check(record([A_INT, B_NULLABLE]))[0])
+        # ...but the string b in version 1 can not be read as an int
+        self.assertFalse(validator.check(record(
+            [A_INT, {'name': 'b', 'type': 'int'}]))[0])
+
+    def test_copy_leaves_original(self):
+        '''copy() - extending a copy does not change the original'''
+        validator = ForwardValidator().add_versions([record([A_INT]), ])
+        extended = validator.copy().add_versions([record([A_INT, B_STR]), ])
+        self.assertEqual(1, validator.version)
+        self.assertEqual(2, extended.version)
+        self.assertTrue(validator.check(record([A_INT]))[0])
+        self.assertFalse(extended.check(record([A_INT]))[0])
+
+    def test_non_record_versions(self):
+        '''check() - non-record versions are checked whole'''
+        ras = RegisteredAvroSchema()
+        ras.schema_str = '"int"'
+        validator = BackwardValidator().add_versions([ras, ])
+        cand = RegisteredAvroSchema()
+        cand.schema_str = '"long"'
+        self.assertTrue(validator.check(cand)[0])
+        self.assertFalse(validator.check(record([A_INT]))[0])
+
+    def test_selected_validators(self):
+        '''selected_validators() - known names only, or the default'''
+        self.assertEqual(DEFAULT_VALIDATORS, selected_validators(None))
+        self.assertEqual(DEFAULT_VALIDATORS,
+                         selected_validators(['com.foo.Validator']))
+        self.assertEqual(('BACKWARD', 'FORWARD'),
+                         selected_validators(['forward', 'BACKWARD']))
+
+
+if __name__ == "__main__":
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(TestValidators)
+    unittest.TextTestRunner(verbosity=2).run(SUITE)